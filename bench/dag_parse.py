@@ -0,0 +1,60 @@
+"""
+Benchmark pkg.dag.parse_stan on synthetic Stan programs with thousands of declarations and statements.
+  $ python bench/dag_parse.py [--sizes 500 1000 2000 4000 8000] [--repeat 3]
+Prints the best time of each parsing stage per size; time per declaration should stay flat as size grows.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from pkg import dag
+
+def synthetic_model(n):
+    """
+    A hierarchical model with `n` groups: per group, a data vector, a location and a scale parameter,
+    a transformed parameter assigned over several lines, and a sampling statement.
+    """
+    data = ["int<lower=1> N;"] + ["vector[N] y_%d;" % i for i in range(n)]
+    params = ["real mu;", "real<lower=0> tau;"]
+    params += ["real theta_%d;" % i for i in range(n)] + ["real<lower=0> sigma_%d;" % i for i in range(n)]
+    tparams = ["real scaled_%d;" % i for i in range(n)]
+    tparams += ["scaled_%d <- theta_%d\n  * sigma_%d\n  + mu;" % (i, i, i) for i in range(n)]
+    model = ["mu ~ normal(0, 10);", "tau ~ cauchy(0, 5);"]
+    model += ["theta_%d ~ normal(mu, tau);" % i for i in range(n)]
+    model += ["y_%d ~ normal(scaled_%d, sigma_%d); // group %d" % (i, i, i, i) for i in range(n)]
+    blocks = [("data", data), ("parameters", params), ("transformed parameters", tparams), ("model", model)]
+    return "\n".join("%s {\n  %s\n}" % (name, "\n  ".join(lines)) for name, lines in blocks)
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        times.append(time.time() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000, 4000, 8000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print "%8s %8s %10s %10s %10s %10s %10s %10s %12s" % (
+        "groups", "lines", "blocks", "nodes", "edges", "graph", "total", "cached", "us/decl")
+    for n in args.sizes:
+        code = synthetic_model(n)
+        t_blocks, blocks = best_of(args.repeat, dag.get_blocks, code)
+        t_nodes, nodes_dict = best_of(args.repeat, dag.build_nodes, blocks)
+        t_edges, edges = best_of(args.repeat, dag.build_edges, blocks, nodes_dict)
+        t_graph, _ = best_of(args.repeat, dag.DAG, nodes_dict.values(), edges)
+        dag.parse_cache.clear()
+        t_total, _ = best_of(1, dag.parse_stan, code)
+        t_cached, _ = best_of(args.repeat, dag.parse_stan, code)
+        print "%8d %8d %9.3fs %9.3fs %9.3fs %9.3fs %9.3fs %9.6fs %12.1f" % (
+            n, code.count("\n") + 1, t_blocks, t_nodes, t_edges, t_graph, t_total, t_cached,
+            1e6 * t_total / len(nodes_dict))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Benchmark the flan pipeline stage by stage, recording time and peak memory to a JSON history and
+comparing each run with the last comparable one.
+  $ python bench/run.py [--scales 8 200 2000] [--iter 1000] [--repeat 3] [--quick] [--stages REGEX]
+Stages, each run `--repeat` times in a fresh forked process:
+  parse_stan/*        pkg.dag.parse_stan on the example models and a synthetic 2000-group program
+  compile/*           eight_schools through the compiled model cache: a hit, and (without --quick) a miss
+  build_data/*        hkjc/v001's build_stan_data on a synthetic results frame, no DB needed
+  check/draws_layout  spilled draws and Laplace pseudo-draws of matrix / array parameters against
+                      fit.extract(permuted=False); fails if any element is out of place
+  sample/J*           eight_schools with J synthetic schools per `--scales`
+  post/J*/*           write_draws, diagnostics and the standard plots of those draws
+  flan/J*/*           flan.py pages, API responses and an on-demand plot, through the Flask test client
+A stage is a regression if it got `--threshold` slower (or its memory grew by as much) beyond a noise floor.
+Runs offline: models compile locally and all data is generated.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+os.environ.setdefault("MPLBACKEND", "Agg")
+import numpy as np
+from pkg import conf
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+history_fn = os.path.join(bench_dir, "history.json")
+# differences under these are noise, whatever the ratio
+min_seconds = 0.02
+min_mb = 5.
+
+# ----- inputs ----- #
+def model_code(category, model_name):
+    with open(os.path.join(conf.models_dir, category, model_name, "model.stan"), "r") as f:
+        return f.read()
+
+def schools_data(J, seed=0):
+    """eight_schools data with `J` synthetic schools, drawn from the model's own generative process"""
+    rng = np.random.RandomState(seed)
+    sigma = rng.uniform(5., 20., J)
+    theta = 8. + 6. * rng.randn(J)
+    return {"J": J, "y": theta + sigma * rng.randn(J), "sigma": sigma}
+
+def synthetic_results(n_races, n_horses, seed=0):
+    """
+    A results frame shaped like hkjc's: indexed by (field size, race id, position), with horse_id,
+    horse_race_num and rank columns, a third of the races with 14 runners and the rest 12.
+    """
+    import pandas as pd
+    rng = np.random.RandomState(seed)
+    # 12-runner races first, so the frame is sorted by field size as `df.loc[field_size]` expects
+    field_sizes = np.sort(np.where(np.arange(n_races) % 3 == 0, 14, 12))
+    race_ids = np.repeat(["2014%06d" % i for i in range(n_races)], field_sizes)
+    positions = np.concatenate([np.arange(n) for n in field_sizes])
+    ranks = np.concatenate([rng.permutation(n) + 1 for n in field_sizes])
+    horses = np.concatenate([rng.choice(n_horses, n, replace=False) for n in field_sizes])
+    df = pd.DataFrame({
+        "fs": np.repeat(field_sizes, field_sizes),
+        "race": race_ids,
+        "pos": positions,
+        "horse_id": ["H%05d" % h for h in horses],
+        "horse_race_num": rng.randint(1, 40, len(horses)),
+        "rank": ranks,
+    })
+    return df.set_index(["fs", "race", "pos"])
+
+def model_dir(workdir, J):
+    return os.path.join(workdir, "static", "bench", "eight_schools_J%d" % J)
+
+def group_params(J):
+    return ["eta[%d]" % (j + 1) for j in range(min(J, conf.group_plot_page_size))]
+
+# ----- stages ----- #
+class Stage(object):
+    """
+    A timed `run(setup(ctx))`. `setup` and `teardown(ctx, result)` run in the same process but aren't timed.
+    """
+    def __init__(self, name, run, setup=None, teardown=None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.teardown = teardown
+
+def parse_stage(name, code):
+    from pkg import dag
+
+    def run(code):
+        dag.parse_cache.clear()
+        return dag.parse_stan(code)
+    return Stage("parse_stan/%s" % name, run, setup=lambda ctx: code)
+
+def compile_stages(ctx, quick):
+    from pkg.cache import CompiledModelCache
+    code = model_code("example", "eight_schools_001")
+    stages = [Stage("compile/cached", lambda cache: cache.get(code),
+                    setup=lambda ctx: _warm_cache(CompiledModelCache(), code))]
+    if not quick:
+        stages.append(Stage("compile/uncached", lambda cache: cache.get(code),
+                            setup=lambda ctx: CompiledModelCache(cache_dir=tempfile.mkdtemp(dir=ctx["workdir"]))))
+    return stages
+
+def _warm_cache(cache, code):
+    cache.get(code)
+    return cache
+
+def build_data_stage(n_races, n_horses):
+    from pkg.models.hkjc.v001.data import build_stan_data
+    return Stage("build_data/hkjc_%d_races" % n_races, build_stan_data,
+                 setup=lambda ctx: synthetic_results(n_races, n_horses))
+
+layout_model = """
+parameters { matrix[2, 3] a; vector[3] v[2]; real s; }
+model { to_vector(a) ~ normal(0, 1); for (i in 1:2) v[i] ~ normal(i, 1); s ~ normal(0, 1); }
+"""
+
+def layout_check_stage():
+    """
+    Both map the fit's column-major flat elements to C-ordered arrays: the draws spilled by DrawsStore
+    (in tiny blocks, so every block boundary is crossed) and `pkg.approx.unflatten` of `constrain_pars`
+    """
+    from pkg.cache import CompiledModelCache
+    from pkg.draws import DrawsStore
+    from pkg.approx import layout, unflatten
+
+    def setup(ctx):
+        model = CompiledModelCache().get(layout_model, model_name="layout_check")
+        return model.sampling(iter=200, chains=2, seed=1, refresh=0), tempfile.mkdtemp(dir=ctx["workdir"])
+
+    def run(args):
+        fit, spill_dir = args
+        draws = DrawsStore(fit, spill_dir=spill_dir, spill_min_bytes=0, spill_chunk_bytes=64)
+        params = layout(fit)
+        for param, dims, _ in params:
+            expected = np.swapaxes(fit.extract(pars=[param], permuted=False)[param], 0, 1)
+            if not np.array_equal(draws.chains(param), expected):
+                raise AssertionError("spilled draws of %s are out of place" % param)
+            for i in range(3):
+                values = dict((p, fit.extract(pars=[p], permuted=False)[p][i, 0]) for p, _, _ in params)
+                flat = np.array([fit.constrain_pars(fit.unconstrain_pars(values))])
+                if not np.allclose(unflatten(flat, params)[param][0], values[param]):
+                    raise AssertionError("unflattened draws of %s are out of place" % param)
+        draws.clear()
+    return Stage("check/draws_layout", run, setup=setup)
+
+def sample_stage(J, n_iter):
+    from pkg.cache import CompiledModelCache
+    from pkg.draws import DrawsStore, write_draws, draws_dirname
+
+    def setup(ctx):
+        return CompiledModelCache().get(model_code("example", "eight_schools_001")), schools_data(J)
+
+    def run(args):
+        model, data = args
+        return model.sampling(data=data, iter=n_iter, chains=2, n_jobs=1, seed=1, refresh=0)
+
+    def teardown(ctx, fit):
+        # persisted as a run would, for the post processing and flan stages
+        out = model_dir(ctx["workdir"], J)
+        if os.path.exists(out):
+            shutil.rmtree(out)
+        os.makedirs(out)
+        draws = DrawsStore(fit)
+        spec_plots = {"single_params": ["mu", "tau"], "param_pairs": [["mu", "tau"]],
+                      "param_groups": {"eta": group_params(J)}}
+        write_draws(draws, draws.params, os.path.join(out, draws_dirname), category="bench",
+                    model_name=os.path.basename(out), plots=spec_plots)
+    return Stage("sample/J%d" % J, run, setup=setup, teardown=teardown)
+
+def post_stages(J):
+    from pkg.draws import load_draws, write_draws
+    from pkg.diagnostics import write_diagnostics, diagnostics_fn
+    from pkg.render import ElementDraws
+    from pkg import plots
+
+    def load(ctx):
+        # diagnostics go where flan.py will find them
+        return load_draws(model_dir(ctx["workdir"], J)), model_dir(ctx["workdir"], J)
+
+    def scratch(ctx):
+        return load_draws(model_dir(ctx["workdir"], J)), tempfile.mkdtemp(dir=ctx["workdir"])
+
+    def on_draws(func):
+        return lambda args: func(*args)
+
+    return [
+        Stage("post/J%d/write_draws" % J, on_draws(lambda draws, out: write_draws(draws, draws.params, out)), setup=scratch),
+        Stage("post/J%d/diagnostics" % J, on_draws(lambda draws, out: write_diagnostics(draws, os.path.join(out, diagnostics_fn))),
+              setup=load),
+        Stage("post/J%d/single_plot" % J, on_draws(lambda draws, out: plots.single_param_plot(draws, "mu", out)), setup=scratch),
+        Stage("post/J%d/pair_plot" % J, on_draws(lambda draws, out: plots.param_pair_plot(draws, ("mu", "tau"), out)),
+              setup=scratch),
+        Stage("post/J%d/group_plot" % J,
+              on_draws(lambda draws, out: plots.param_group_plot(ElementDraws(draws), "eta", group_params(J), out)),
+              setup=scratch),
+    ]
+
+def flan_stages(J):
+    model_url = "/bench/eight_schools_J%d/" % J
+
+    def setup(ctx):
+        # point flan.py's catalog and render cache at the benchmark's outputs before it builds them
+        conf.static_dir = os.path.join(ctx["workdir"], "static")
+        conf.publish_log_fn = os.path.join(conf.static_dir, "published.log")
+        conf.render_cache_dir = tempfile.mkdtemp(dir=ctx["workdir"])
+        import flan
+        client = flan.app.test_client()
+        client.get(model_url)
+        return client
+
+    def get(url):
+        def run(client):
+            response = client.get(url)
+            assert response.status_code == 200, "%s: %d" % (url, response.status_code)
+            return response.data
+        return run
+
+    return [Stage("flan/J%d/%s" % (J, name), get(url), setup=setup) for name, url in [
+        ("home", "/"),
+        ("model_page", model_url),
+        ("api_summary", model_url + "api/summary"),
+        ("api_draws", model_url + "api/draws/eta?max_draws=100"),
+        ("plot_single", model_url + "plot/single/tau.png"),
+    ]]
+
+def all_stages(args, ctx):
+    from dag_parse import synthetic_model
+    stages = [
+        parse_stage("eight_schools", model_code("example", "eight_schools_001")),
+        parse_stage("hkjc_v001", model_code("hkjc", "v001")),
+        parse_stage("synthetic_2000", synthetic_model(2000)),
+    ]
+    stages += compile_stages(ctx, args.quick)
+    stages += [build_data_stage(n, n // 2) for n in [1000, 10000]]
+    stages.append(layout_check_stage())
+    for J in args.scales:
+        stages.append(sample_stage(J, args.iter))
+        stages += post_stages(J)
+        stages += flan_stages(J)
+    return stages
+
+# ----- measurement ----- #
+def current_rss_mb():
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024. ** 2
+
+def measure(stage, ctx, conn):
+    """child process: set up, time the run, tear down, and send back seconds and memory"""
+    # keep the table readable: compiler, sampler and plotting output goes nowhere
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        arg = stage.setup(ctx) if stage.setup else ctx
+        start_mb = current_rss_mb()
+        start = time.time()
+        result = stage.run(arg)
+        seconds = time.time() - start
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        if stage.teardown:
+            stage.teardown(ctx, result)
+        conn.send({"seconds": seconds, "peak_mb": peak_mb, "delta_mb": max(peak_mb - start_mb, 0.)})
+    except Exception as e:
+        conn.send({"error": "%s: %s" % (type(e).__name__, e)})
+    finally:
+        conn.close()
+
+def run_stage(stage, ctx, repeat):
+    """best time, and the largest memory, over `repeat` runs each in its own process"""
+    runs = []
+    for _ in range(repeat):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(target=measure, args=(stage, ctx, child_conn))
+        p.start()
+        child_conn.close()
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            result = {"error": "worker exited with code %s" % p.exitcode}
+        p.join()
+        if "error" in result:
+            return result
+        runs.append(result)
+    return {
+        "seconds": min(r["seconds"] for r in runs),
+        "peak_mb": max(r["peak_mb"] for r in runs),
+        "delta_mb": max(r["delta_mb"] for r in runs),
+    }
+
+# ----- history ----- #
+def load_history(fn):
+    if not os.path.exists(fn):
+        return []
+    with open(fn, "r") as f:
+        return json.load(f)
+
+def git_commit():
+    try:
+        out = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        return out.strip() or None
+    except OSError:
+        return None
+
+def baseline_for(history, config):
+    """the most recent recorded run with the same settings, or None"""
+    for run in reversed(history):
+        if run["config"] == config:
+            return run
+    return None
+
+def compare(result, base, threshold):
+    """flags for a stage's result against its baseline"""
+    if base is None or "error" in result or "error" in base:
+        return []
+    flags = []
+    if result["seconds"] > base["seconds"] * (1 + threshold) and result["seconds"] - base["seconds"] > min_seconds:
+        flags.append("slower")
+    if result["delta_mb"] > base["delta_mb"] * (1 + threshold) and result["delta_mb"] - base["delta_mb"] > min_mb:
+        flags.append("more memory")
+    return flags
+
+def change(value, base):
+    return "%+7.1f%%" % (100. * (value - base) / base) if base else "%8s" % "-"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[8, 200, 2000], help="schools per synthetic model")
+    parser.add_argument("--iter", type=int, default=1000, help="sampling iterations per chain")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="skip the uncached compile")
+    parser.add_argument("--stages", default=None, help="only run stages whose name matches this regex")
+    parser.add_argument("--history", default=history_fn)
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--no-record", action="store_true", help="compare without appending to the history")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on any regression or failed stage")
+    args = parser.parse_args()
+
+    ctx = {"workdir": tempfile.mkdtemp(prefix="flan_bench_")}
+    config = {"scales": args.scales, "iter": args.iter, "repeat": args.repeat, "host": socket.gethostname()}
+    history = load_history(args.history)
+    baseline = baseline_for(history, config)
+    stage_re = re.compile(args.stages) if args.stages else None
+    results = {}
+    n_regressions = 0
+    n_failures = 0
+    print "%-32s %10s %9s %10s %9s %10s  %s" % ("stage", "seconds", "change", "peak MB", "delta MB", "change", "")
+    try:
+        for stage in all_stages(args, ctx):
+            # sampling feeds the stages after it, so it runs whatever the filter
+            if stage_re and not stage_re.search(stage.name) and not stage.name.startswith("sample/"):
+                continue
+            result = results[stage.name] = run_stage(stage, ctx, args.repeat)
+            if "error" in result:
+                print "%-32s failed: %s" % (stage.name, result["error"])
+                n_failures += 1
+                continue
+            base = baseline["results"].get(stage.name) if baseline else None
+            flags = compare(result, base, args.threshold)
+            n_regressions += bool(flags)
+            ok_base = base is not None and "error" not in base
+            print "%-32s %10.4f %9s %10.1f %9.1f %10s  %s" % (
+                stage.name, result["seconds"], change(result["seconds"], base["seconds"]) if ok_base else "-",
+                result["peak_mb"], result["delta_mb"], change(result["delta_mb"], base["delta_mb"]) if ok_base else "-",
+                "REGRESSION: " + ", ".join(flags) if flags else "")
+    finally:
+        shutil.rmtree(ctx["workdir"])
+
+    if baseline:
+        print "compared with run of %s (commit %s)" % (time.ctime(baseline["time"]), baseline.get("commit"))
+    else:
+        print "no earlier run with these settings to compare with"
+    print "%d regression(s), %d failed stage(s)" % (n_regressions, n_failures)
+    if not args.no_record:
+        history.append({"time": time.time(), "commit": git_commit(), "config": config, "results": results})
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=2)
+        print "recorded in < %s >" % args.history
+    if args.fail_on_regression and (n_regressions or n_failures):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
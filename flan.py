@@ -1,27 +1,33 @@
 import os
-import pkg.conf as conf
-from flask import Flask, render_template
-app = Flask(__name__)
+import re
+from pkg.catalog import Catalog
+from pkg.api import init_api, diagnostics_query
+from pkg.diagnostics import columns as diagnostics_columns, select
+from pkg.render import RenderCache
+from pkg.stream import read_live
+from pkg.images import ImageCache, content_hash, compressed_format, mimetypes
+from pkg import conf
+from flask import Flask, render_template, request, send_file, abort, safe_join
+# static/ is served by `static_file` below, with content-hash ETags
+app = Flask(__name__, static_folder=None)
 
-def get_category_dirs():
-    category_dirs = [os.path.join(conf.static_dir, cat) for cat in os.listdir(conf.static_dir)]
-    return [cd for cd in filter(os.path.isdir, category_dirs) if cd.split("/")[-1] not in ["css", "js"]]
-
-def get_models(category_dir):
-    model_dirs = [os.path.join(category_dir, model) for model in os.listdir(category_dir)]
-    model_dirs = filter(os.path.isdir, model_dirs)
-    return [model_dir.split("/")[-1] for model_dir in model_dirs]
+# index of static/<category>/<model_name>/, refreshed when StanAnalysis publishes new outputs
+catalog = Catalog()
+# JSON endpoints under /<category>/<model_name>/api/
+init_api(app, catalog)
+# plots rendered from persisted draws on first view, for runs with `lazy_plots` or parameters nobody listed
+render_cache = RenderCache()
+# thumbnails and recompressed copies of the pngs under static/
+image_cache = ImageCache()
 
 def categorys():
-    return [cat.split("/")[-1] for cat in get_category_dirs()]
+    return catalog.categories()
 
 @app.route("/")
 def home():
     """navigate all models"""
     # tuples of (category, models list)
-    cat_model_tups = []
-    for category_dir in get_category_dirs():
-        cat_model_tups.append((category_dir.split("/")[-1], get_models(category_dir)))
+    cat_model_tups = [(category, catalog.models(category)) for category in catalog.categories()]
     kw = {
         "cat_model_tups": cat_model_tups, 
         "categorys": categorys(),
@@ -32,7 +38,7 @@ def home():
 def category_page(category):
     """models within a single category"""
     kw = {
-        "cat_model_tups": [(category, get_models(os.path.join(conf.static_dir, category)))],
+        "cat_model_tups": [(category, catalog.models(category))],
         "categorys": categorys(),
     }
     return render_template("home.html", **kw)
@@ -40,50 +46,125 @@ def category_page(category):
 @app.route("/<category>/<model_name>/")
 def model_page(category, model_name):
     """aggregate the outputs from this model's analysis"""
-    model_dir = os.path.join(conf.static_dir, category, model_name)
     kw = {"categorys": categorys(), "category": category, "model_name": model_name,}
 
+    # a sweep's page lists its variants, each a model page of its own
+    sweep = catalog.sweep(category, model_name)
+    if sweep is not None:
+        kw.update(sweep.page_kw())
+        return render_template("sweep.html", **kw)
+
     # short-circuit if no model exists
-    no_model = not os.path.exists(model_dir)
-    if no_model:
-        kw["no_model"] = no_model
+    entry = catalog.model(category, model_name)
+    if entry is None:
+        kw["no_model"] = True
         return render_template("model.html", **kw)
 
-    # notes and fit print
-    notes_fn = os.path.join(model_dir, "notes.txt")
-    fit_print_fn = os.path.join(model_dir, "fit_stats.txt")
-    if os.path.exists(notes_fn):
-        with open(notes_fn, "r") as f:
-            kw["notes"] = f.read()
+    kw.update(entry.page_kw())
+    # a streaming run's progress, read fresh: it changes without publishing
+    kw["live"] = read_live(entry.model_dir)
+    kw["live_refresh_seconds"] = max(conf.stream_poll_seconds, 1)
+
+    # diagnostics table, sorted and filtered by the query string
+    query = diagnostics_query(request.args)
+    try:
+        rows, n_matching = select(entry.diagnostics(), **query)
+    except re.error as e:
+        rows, n_matching = [], 0
+        kw["diagnostics_error"] = "bad filter: %s" % e
+    kw.update({
+        "diagnostics_columns": diagnostics_columns,
+        "diagnostics": rows,
+        "diagnostics_query": query,
+        "n_diagnostics": len(entry.diagnostics()),
+        "n_matching": n_matching,
+    })
+    return render_template("model.html", **kw)
+
+@app.route("/<category>/<model_name>/plot/single/<param>.png")
+@app.route("/<category>/<model_name>/plot/pair/<param>/<param_y>.png")
+@app.route("/<category>/<model_name>/plot/group/<name>.png")
+def model_plot(category, model_name, param=None, param_y=None, name=None):
+    """
+    render a standard plot of any persisted parameters, or elements like theta[3], on demand:
+      plot/single/<param>.png, plot/pair/<x>/<y>.png,
+      plot/group/<name>.png for one of the spec's groups, or with ?params=a,b,c for any others,
+      and ?page=N for page N of a group too wide for one page
+    """
+    entry = catalog.model(category, model_name)
+    draws = entry.draws_store() if entry else None
+    if draws is None:
+        abort(404)
+    if name is not None:
+        params = request.args.get("params")
+        params = params.split(",") if params else draws.manifest.get("plots", {}).get("param_groups", {}).get(name)
+        if not params:
+            abort(404)
+        job = ("group", name, params, request.args.get("page", 1, type=int))
+    elif param_y is not None:
+        job = ("pair", (param, param_y))
     else:
-        kw["notes"] = "No model notes."
-    if os.path.exists(fit_print_fn):
-        with open(fit_print_fn, "r") as f:
-            kw["fit_stats"] = f.read()
+        job = ("single", param)
+    try:
+        fn = render_cache.render(draws, job)
+    except KeyError:
+        abort(404)
+    except ValueError:
+        abort(400)
+    # the url stays the same across runs, so browsers revalidate it each time, against the render key
+    return send_png(fn, os.path.splitext(os.path.basename(fn))[0])
+
+def image_format():
+    """`conf.image_format` if it can be written and the browser accepts it, else "png" """
+    fmt = compressed_format()
+    if fmt is None or (fmt != "jpeg" and mimetypes[fmt] not in [m for m, _ in request.accept_mimetypes]):
+        return "png"
+    return fmt
+
+def send_png(fn, version, thumbnail=False):
+    """the png `fn` (or a thumbnail of it) in the browser's format, with `version` as ETag; see `send_versioned`"""
+    fmt = image_format()
+    path = fn
+    if thumbnail:
+        path = image_cache.thumbnail(fn, fmt)
+    elif fmt != "png":
+        path = image_cache.compressed(fn, fmt)
+    response = send_versioned(path, "%s-%s%s" % (version, "thumb-" if thumbnail else "", fmt), version, mimetypes[fmt])
+    response.vary.add("Accept")
+    return response
+
+def send_versioned(path, etag, version, mimetype=None):
+    """
+    a file with `etag` as ETag, so a repeat view is a 304; cached for `conf.static_max_age` if the url carries
+    its `version` (`?v=<version>`, see `pkg.catalog.ModelEntry.image`), else revalidated on every view
+    """
+    response = send_file(path, mimetype=mimetype, add_etags=False, conditional=False)
+    response.set_etag(etag)
+    if request.args.get("v") == version:
+        response.headers["Cache-Control"] = "public, max-age=%d, immutable" % conf.static_max_age
     else:
-        kw["fit_stats"] = "No model fit stats."
-
-    # graphviz
-    if os.path.join(model_dir, "graphviz.png"):
-        kw["has_graphviz"] = True
-
-    # filter for filenames of each plot type to make list of static urls
-    fns = os.listdir(model_dir)
-    single_param_fns = [fn for fn in fns if "trace" in fn]
-    param_pair_fns = [fn for fn in fns if "-" in fn]
-    param_group_fns = [fn for fn in fns if "pairplot" in fn]
-    supplemental_png_fns = set([fn for fn in fns if ".png" in fn])
-    supplemental_png_fns -= set(single_params_fns)
-    supplemental_png_fns -= set(param_pair_fns)
-    supplemental_png_fns -= set(param_group_fns)
-    supplemental_png_fns = list(supplemental_png_fns)
-    # format filenames into (title, fn)
-    kw["single_params"] = [(fn.replace("_trace.png", ""), fn) for fn in single_param_fns]
-    kw["param_pairs"] = [("%s vs %s" % tuple(fn.replace(".png", "").split("-")[::-1]), fn) for fn in param_pair_fns]
-    kw["param_groups"] = [(fn.replace("_pairplot.png", ""), fn) for fn in param_group_fns]
-    kw["supplemental"] = [(fn.replace(".png", ""), fn) for fn in supplemental_png_fns]
+        response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
-    return render_template("model.html", **kw)
+def send_static(filename, thumbnail=False):
+    """a file under static/ (or a thumbnail of a png there), versioned by its content hash"""
+    fn = safe_join(conf.static_dir, filename)
+    if fn is None or not os.path.isfile(fn) or (thumbnail and not fn.endswith(".png")):
+        abort(404)
+    version = content_hash(fn)
+    if fn.endswith(".png"):
+        return send_png(fn, version, thumbnail)
+    return send_versioned(fn, version, version)
+
+@app.route("/static/<path:filename>")
+def static_file(filename):
+    """model outputs and assets; pngs in `conf.image_format` for browsers that accept it"""
+    return send_static(filename)
+
+@app.route("/thumb/<path:filename>")
+def thumbnail(filename):
+    """a thumbnail of a png under static/, at most `conf.thumbnail_max_px` on its longer side"""
+    return send_static(filename, thumbnail=True)
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    app.run()
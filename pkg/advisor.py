@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import numpy as np
+
+from .warmstart import resolve
+from . import dag
+
+# Performance advice for a Stan program: statements inside `for` loops that Stan could run as one
+# vectorized statement, with the line they start on and how many times (and over how many elements)
+# they run per log density evaluation, from the loop extents and declared sizes resolved against the data.
+# Each NUTS iteration evaluates the log density and its gradient once per leapfrog step, so the
+# transformed parameters and model blocks dominate; generated quantities run once per draw.
+
+advice_fn = "advice.json"
+block_names = ["functions", "data", "transformed data", "parameters", "transformed parameters", "model",
+               "generated quantities"]
+block_re = re.compile("^(%s)$" % "|".join(block_names))
+for_re = re.compile("^for\s*\(\s*(\w+)\s+in\s+(.+?)\s*:\s*(.+)\)$")
+clause_re = re.compile("^(for|if|while|else\s+if)\s*\(")
+function_re = re.compile("^\s*\w+(?:\s*\[[\s,]*\])?\s+(\w+)\s*\([^)]*\)\s*{", re.M)
+call_re = re.compile("(\w+)\s*\(")
+statement_re = re.compile("^([^=<>~!]+?)\s*(<-|~|\+=|-=|\*=|/=|=)\s*(.+)$")
+# how often each block runs
+block_runs = {
+    "transformed parameters": "gradient",
+    "model": "gradient",
+    "generated quantities": "draw",
+    "functions": "call",
+}
+
+def strip_comments(code):
+    """remove comments, keeping every newline so line numbers don't move"""
+    code = re.sub("/\*.*?\*/", lambda m: "\n" * m.group().count("\n"), code, flags=re.S)
+    return re.sub("(//|#).*", "", code)
+
+def split_clause(text):
+    """("for (i in 1:N)", rest) for text led by a for / if / while clause, else (None, text)"""
+    m = clause_re.match(text)
+    if not m:
+        return None, text
+    depth = 0
+    for i in range(m.end() - 1, len(text)):
+        depth += {"(": 1, ")": -1}.get(text[i], 0)
+        if depth == 0:
+            return text[:i + 1], text[i + 1:]
+    return None, text
+
+def statements(code):
+    """
+    (line, block, loops, statement) for each statement of the program, where loops are the
+    (variable, lower, upper) of the `for` loops around it, outermost first
+    """
+    code = strip_comments(code)
+    found = []
+    # ("block", name) or ("scope", loops it ranges over), innermost last
+    scopes = []
+    text, line = "", 1
+    for char in code:
+        if char not in "{};":
+            text += char
+            if char == "\n":
+                line += 1
+            continue
+        # line the text started on, then strip the clauses leading it
+        text_line = line - text.count("\n")
+        rest = re.sub("^\s*else\\b", "", text.strip())
+        text_line += text.count("\n") - text.lstrip().count("\n")
+        loops = []
+        while True:
+            stripped = rest.lstrip()
+            clause, after = split_clause(stripped)
+            if clause is None:
+                break
+            text_line += rest[:len(rest) - len(stripped)].count("\n") + clause.count("\n")
+            m = for_re.match(" ".join(clause.split()))
+            if m:
+                loops.append(m.groups())
+            rest = after
+        text_line += rest.count("\n") - rest.lstrip().count("\n")
+        rest = " ".join(rest.split())
+        if char == "{":
+            if not scopes and block_re.match(rest):
+                scopes.append(("block", rest))
+            else:
+                # a loop's or if's body, or a function's
+                scopes.append(("scope", loops))
+        elif char == "}":
+            if scopes:
+                scopes.pop()
+        elif rest:
+            block = scopes[0][1] if scopes and scopes[0][0] == "block" else None
+            outer = [loop for kind, value in scopes if kind == "scope" for loop in value]
+            found.append((text_line, block, outer + loops, rest))
+        text = ""
+    return found
+
+def index_count(lhs):
+    """number of indices on the variable a statement assigns: `x[i][j]` and `x[i, j]` both have 2"""
+    count, depth = 0, 0
+    for char in lhs:
+        if char == "[":
+            depth += 1
+            if depth == 1:
+                count += 1
+        elif char == "]":
+            depth -= 1
+        elif char == "," and depth == 1:
+            count += 1
+    return count
+
+def extent(loop, data):
+    """iterations of a (variable, lower, upper) loop, or None if they depend on more than the data"""
+    try:
+        return int(resolve("(%s) - (%s) + 1" % (loop[2], loop[1]), data))
+    except (ValueError, NameError, SyntaxError, TypeError):
+        return None
+
+def classify(statement, functions):
+    """(kind, advice) for a statement run in a loop, or None if it neither assigns nor samples"""
+    m = statement_re.match(statement)
+    if not m:
+        return None
+    lhs, op, rhs = m.groups()
+    if op == "~" or lhs == "target":
+        if re.search("categorical\s*\(\s*softmax\s*\(", rhs):
+            return "sampling", "use `categorical_logit`, which skips building the softmax, and batch the loop's statements into one where the distribution allows"
+        return "sampling", "one `~` over whole vectors (e.g. with `to_vector`) evaluates the density once, sharing terms like log(sigma), instead of once per element"
+    called = [f for f in call_re.findall(rhs) if f in functions]
+    if called:
+        return "call", "write a vectorized `%s` taking vectors or arrays, and call it once instead of once per element" % called[0]
+    rngs = [f for f in call_re.findall(rhs) if f.endswith("_rng")]
+    if rngs:
+        return "rng", "`%s` takes vector arguments and returns an array (Stan 2.18+), drawing every element in one call" % rngs[0]
+    # drop the (possibly nested) indices: a copy is a variable and nothing else
+    unindexed = rhs
+    while "[" in unindexed:
+        stripped = re.sub("\[[^\[\]]*\]", "", unindexed)
+        if stripped == unindexed:
+            break
+        unindexed = stripped
+    if re.match("^\w+$", unindexed.strip()):
+        return "copy", "copy whole arrays with multiple indexing, e.g. `x[i] <- y[idx[i]]`, instead of element by element"
+    return "arithmetic", "compute on whole vectors or matrices in one statement; each element-wise statement is a separate autodiff node"
+
+def advise(model_code, data=None):
+    """
+    Findings for the statements inside loops of the blocks that run per gradient or per draw, and of functions,
+    costliest first. Each is a dict of "line", "block", "kind", "statement", "loops" and "advice", plus
+    "runs": "gradient", "draw" or "call", and "executions" and "elements": how many times the statement runs
+    per run of its block and how many elements it assigns or samples in all, None where the sizes aren't
+    known from `data`. "share" is the fraction of the per gradient elements flagged.
+    """
+    data = data if data is not None else {}
+    functions = set(function_re.findall(strip_comments(model_code))) - set(["if", "while", "for"])
+    nodes = dag.build_nodes(dag.get_blocks(model_code))
+    findings = []
+    for line, block, loops, statement in statements(model_code):
+        if block not in block_runs or not loops:
+            continue
+        found = classify(statement, functions)
+        if found is None:
+            continue
+        kind, advice = found
+        lhs = statement_re.match(statement).group(1)
+        extents = [extent(loop, data) for loop in loops]
+        executions = int(np.prod(extents)) if None not in extents else None
+        elements = executions
+        node = nodes.get(lhs.split("[")[0].strip())
+        if elements is not None and node is not None and node.shape:
+            try:
+                elements *= int(np.prod([resolve(d, data) for d in node.shape[index_count(lhs):]]))
+            except (ValueError, NameError, SyntaxError, TypeError):
+                elements = None
+        findings.append({
+            "line": line,
+            "block": block,
+            "kind": kind,
+            "statement": statement,
+            "loops": ["%s in %s:%s" % loop for loop in loops],
+            "runs": block_runs[block],
+            "executions": executions,
+            "elements": elements,
+            "advice": advice,
+        })
+    total = sum(f["elements"] for f in findings if f["runs"] == "gradient" and f["elements"])
+    for f in findings:
+        f["share"] = float(f["elements"]) / total if f["runs"] == "gradient" and f["elements"] and total else None
+    findings.sort(key=lambda f: (f["runs"] != "gradient", -(f["elements"] or 0), f["line"]))
+    return findings
+
+def report(findings):
+    """lines summarizing findings, for printing"""
+    lines = []
+    for f in findings:
+        cost = "%s x per %s" % (f["executions"] if f["executions"] is not None else "?", f["runs"])
+        if f["elements"] is not None and f["elements"] != f["executions"]:
+            cost += ", %d elements" % f["elements"]
+        if f["share"] is not None:
+            cost += ", %.0f%%" % (100 * f["share"])
+        lines.append("line %d (%s, %s): %s" % (f["line"], f["block"], cost, f["statement"]))
+        lines.append("    %s: %s" % (f["kind"], f["advice"]))
+    return lines
+
+def write_advice(findings, output_dir):
+    with open(os.path.join(output_dir, advice_fn), "w") as f:
+        json.dump(findings, f, indent=2)
+
+def read_advice(output_dir):
+    """findings a run wrote for a model, or [] if it has none"""
+    fn = os.path.join(output_dir, advice_fn)
+    if not os.path.exists(fn):
+        return []
+    with open(fn, "r") as f:
+        return json.load(f)
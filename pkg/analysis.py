@@ -1,43 +1,134 @@
 import os
+import shutil
 import traceback
+import hashlib
 import numpy as np
-import pandas as pd
-import pystan
-import seaborn as sns
-import matplotlib.pyplot as plt
 
-from .dag import parse_stan
+from .cache import CompiledModelCache, DataCache
+from .draws import DrawsStore, ArrayDrawsStore, MmapDrawsStore, write_draws, load_draws, draws_dirname
+from .parallel import plot_jobs, job_label, job_params, run_plot_jobs
+from .outputs import OutputManifest, inputs_hash, _source_digest
+from .diagnostics import write_diagnostics, diagnostics_fn
+from .catalog import publish, entry_name
+from .warmstart import warm_start_inits, declarations
+from .stream import StreamingDrawsStore, LiveMonitor, samples_dirname
+from .profiling import Profile, spanned, draws_nbytes
+from .advisor import advise, report, write_advice
+from .approx import approximate, modes
+from . import diagnostics
 from . import conf
 
+# pystan and the plotting libraries (via pkg.plots) are imported where they're used, so specs can be
+# imported, e.g. to list models or build their data, without loading them
+
+label_prefix = "labels:"
+
 class ModelSpec(object):
     """
     Logic for a Stan model:
      - the Stan code
      - possibly a dictionary of Stan-data, `data`
+     - optionally `labels`: parameter -> labels of the entries along its first dimension (e.g. horse ids),
+       so a warm start can match entries across runs whose data changed
      - method to build the data Stan needs
      - parameters we want to analyze / visualize
+     - optionally `retain_params`: parameters to keep draws of, besides those plotted; the fit drops
+       every other parameter and transformed parameter (None keeps them all). A warm start can only
+       seed the `parameters` block variables listed, so leave out just transformed parameters and
+       generated quantities unless the rest should start cold
     """
-    def __init__(self, category, model_name, single_params=[], param_pairs=[], param_groups={}):
+    def __init__(self, category, model_name, single_params=[], param_pairs=[], param_groups={}, retain_params=None):
         self.category = category
         self.model_name = model_name
         self.single_params = single_params
         self.param_pairs = param_pairs
         self.param_groups = param_groups
+        self.retain_params = retain_params
         # we may have other specific plotting functions we want
         # store them in a list and call them in post processing
-        # each function should take a `fit` and a directory path string as args
+        # each function should take a `DrawsStore` and a directory path string as args,
+        # and return the names of the files it wrote there, so incremental runs can track them
+        # the store's `fit` attribute holds the PyStan fit, if a function needs more than the draws
         self.supplemental_plot_funcs = []
+        self.labels = {}
+        # timing spans of this spec's setup, continued by the StanAnalysis that runs it
+        self.profile = Profile()
 
         code_fn = os.path.join(conf.models_dir, self.category, self.model_name, "model.stan")
         self.model_code = open(code_fn).read()
-        self.build_data()
-        self.set_dimensions()
-        self.set_hyperparameters()
-        self.add_supplemental_plotters()
+        with self.profile.span("load_data", nbytes=lambda: sum(np.asarray(v).nbytes for v in self.data.values())):
+            self.load_data()
+        with self.profile.span("set_dimensions"):
+            self.set_dimensions()
+        with self.profile.span("set_hyperparameters"):
+            self.set_hyperparameters()
+        with self.profile.span("add_supplemental_plotters"):
+            self.add_supplemental_plotters()
 
     def build_data(self):
         raise NotImplementedError("ModelSpec.build_data: must override in subclass of ModelSpec.")
 
+    def data_fingerprint(self):
+        """
+        Override to opt in to caching `data`: return a JSON-serializable description of everything
+        `build_data` reads, e.g. query parameters or `pkg.cache.file_fingerprint(input files)`.
+        The cache key also covers the source of the module defining the subclass.
+        """
+        return None
+
+    def load_data(self):
+        """set `data` from the data cache, if the spec opts in and has an entry, else via `build_data`"""
+        fingerprint = self.data_fingerprint()
+        if fingerprint is None:
+            with self.profile.span("build_data"):
+                self.build_data()
+            return
+        cache = DataCache()
+        key = cache.key(self, fingerprint)
+        data = cache.get(key)
+        if data is not None:
+            print "data cache hit < %s >" % key
+            # labels are stored alongside the data, under prefixed keys
+            self.labels = dict((k[len(label_prefix):], data.pop(k)) for k in list(data) if k.startswith(label_prefix))
+            self.data = data
+        else:
+            print "data cache miss < %s >" % key
+            with self.profile.span("build_data"):
+                self.build_data()
+            payload = dict(self.data)
+            payload.update((label_prefix + k, np.asarray(v).astype(str)) for k, v in self.labels.items())
+            cache.put(key, payload)
+
+    def invalidate_data_cache(self):
+        """drop this spec's cached data, so the next instance rebuilds it"""
+        fingerprint = self.data_fingerprint()
+        if fingerprint is not None:
+            cache = DataCache()
+            cache.invalidate(cache.key(self, fingerprint))
+
+    def sampling_pars(self):
+        """
+        `pars` for `StanModel.sampling`: the retained parameters plus those the plots read, or None for all.
+        Supplemental plotters' parameters must be listed in `retain_params`.
+        """
+        if self.retain_params is None:
+            return None
+        params = set(self.retain_params) | set(self.single_params)
+        for pair in self.param_pairs:
+            params.update(pair)
+        for group in self.param_groups.values():
+            params.update(group)
+        # Stan always keeps lp__
+        params.discard("lp__")
+        return sorted(params)
+
+    def warm_start_prior(self, param, size):
+        """
+        Override to initialize the entries a warm start can't take from the previous fit with `size` draws
+        from `param`'s prior. None falls back to Stan's default initialization.
+        """
+        return None
+
     def set_dimensions(self):
         print "Unimplemented ModelSpec.set_dimensions() called."
 
@@ -51,66 +142,224 @@ class StanAnalysis(object):
     """
     Logic for running an analysis given a ModelSpec and inference parameters.
     """
-    def __init__(self, model_spec, sampling_args={}, clean_output=True):
+    def __init__(self, model_spec, sampling_args={}, clean_output=True, post_process_workers=None, incremental=False,
+                 lazy_plots=False, warm_start=False, stream=False, cprofile=None, output_dir=None, mode="nuts"):
+        """
+        Outputs go to `static/<category>/<model_name>/`, or `output_dir` if given (e.g. one variant of a sweep).
+        `mode` is how `sample` draws from the posterior: "nuts" samples it; "map" finds its mode with `optimizing`,
+        as a single draw; "laplace" takes independent pseudo-draws from a normal approximation around the mode of
+        the unconstrained log density (with the Jacobian of the constraints, unlike "map").
+        The approximations take seconds, for iterating on the model; their outputs are labeled approximate,
+        and post processing skips the standard plots of a MAP estimate. See `pkg.approx`.
+        With `incremental`, the output directory is kept and post processing only redraws the outputs
+        whose inputs changed since they were last drawn; see `pkg.outputs.OutputManifest`.
+        With `lazy_plots`, post processing skips the single parameter, pair and group plots; flan.py
+        renders them from the persisted draws when they are first viewed; see `pkg.render.RenderCache`.
+        With `warm_start`, chains start from draws of the model's last persisted fit, mapped onto the new
+        parameter dimensions, and warmup defaults to `conf.warm_start_warmup`; see `pkg.warmstart`.
+        With `stream`, chains write their draws to `<output_dir>/samples/` as they go, and a monitor thread
+        writes progress and diagnostics of the draws so far to `live.json` for flan.py; see `pkg.stream`.
+        Each stage and plot job is timed, and post processing writes the spans to `profile.json`; stages named
+        in `cprofile` (default `conf.cprofile_stages`), e.g. ["sample", "single mu"], also run under cProfile.
+        See `pkg.profiling`.
+        """
         self.model_spec = model_spec
         self.sampling_args = sampling_args
-        self.output_dir = os.path.join(conf.static_dir, self.model_spec.category, self.model_spec.model_name)
+        self.profile = model_spec.profile
+        if cprofile is not None:
+            self.profile.cprofile = set(cprofile)
+        self.post_process_workers = post_process_workers if post_process_workers else conf.post_process_workers
+        self.incremental = incremental
+        self.lazy_plots = lazy_plots
+        self.stream = stream
+        if mode not in modes:
+            raise ValueError("mode must be one of %s, not < %s >" % (", ".join(modes), mode))
+        self.mode = mode
+        self.approximation = None
+        self.output_dir = output_dir if output_dir else os.path.join(conf.static_dir, self.model_spec.category,
+                                                                     self.model_spec.model_name)
+        self.draws_dir = os.path.join(self.output_dir, draws_dirname)
+        self.samples_dir = os.path.join(self.output_dir, samples_dirname)
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
-        if clean_output:
+        # read before the output directory is cleaned
+        self.warm_start = None
+        if warm_start:
+            self.load_warm_start()
+        if clean_output and not incremental:
             self.clean_output_dir()
 
     def __repr__(self):
         return "<StanAnalysis(category=%s, model_name=%s)>" % (self.model_spec.category, self.model_spec.model_name)
 
-    def compile(self):
+    @spanned("compile")
+    def compile(self, use_cache=True):
+        self.advise()
         print "compiling model ..."
-        self.model = pystan.StanModel(model_code=self.model_spec.model_code)
+        if use_cache:
+            cache = CompiledModelCache()
+            self.model = cache.get(self.model_spec.model_code, model_name=self.model_spec.model_name)
+        else:
+            import pystan
+            self.model = pystan.StanModel(model_code=self.model_spec.model_code)
+
+    def advise(self):
+        """
+        Flag the model's loops Stan could run vectorized, with their cost per gradient from the data's sizes,
+        and write them to `advice.json` for the model page; see `pkg.advisor`.
+        The advisor is a heuristic scanner: if it fails on the model's code, the model compiles without advice.
+        """
+        try:
+            self.advice = advise(self.model_spec.model_code, self.model_spec.data)
+        except Exception:
+            print "performance advice failed, skipping it:"
+            print traceback.format_exc()
+            self.advice = []
+        if self.advice:
+            print "performance advice (%d statements in loops):" % len(self.advice)
+            for line in report(self.advice):
+                print "  " + line
+        write_advice(self.advice, self.output_dir)
 
+    @spanned("sample")
     def sample(self):
         if not hasattr(self, "model"):
             self.compile()
+        if self.mode != "nuts":
+            return self.approximate()
         _iter = self.sampling_args.get("iter", 2000)
         chains = self.sampling_args.get("chains", 4)
         warmup = self.sampling_args.get("warmup", _iter // 2)
+        init = "random"
+        if self.warm_start is not None:
+            init = self.warm_start["inits"]
+            if "warmup" not in self.sampling_args:
+                # chains start near the posterior: shorten warmup, keeping the number of draws
+                _iter -= warmup - min(warmup, conf.warm_start_warmup)
+                warmup = min(warmup, conf.warm_start_warmup)
         thin = self.sampling_args.get("thin", 1)
+        n_jobs = self.sampling_args.get("n_jobs", -1)
+        pars = self.model_spec.sampling_pars()
         print "sampling posterior ..."
         print "  iter   =", _iter
         print "  chains =", chains
         print "  warmup =", warmup
         print "  thin   =", thin
+        print "  n_jobs =", n_jobs
+        print "  init   =", "warm start" if self.warm_start is not None else init
+        print "  pars   =", ", ".join(pars) if pars is not None else "all"
 
-        self.fit = self.model.sampling(data=self.model_spec.data,
-                                      warmup=warmup,
-                                      chains=chains,
-                                      iter=_iter,
-                                      thin=thin)
+        kw = {}
+        if pars is not None:
+            kw["pars"] = pars
+        if self.stream:
+            if os.path.exists(self.samples_dir):
+                shutil.rmtree(self.samples_dir)
+            os.makedirs(self.samples_dir)
+            kw["sample_file"] = os.path.join(self.samples_dir, "chain.csv")
+            monitor = LiveMonitor(self.samples_dir, self.output_dir)
+            monitor.start()
+        try:
+            self.fit = self.model.sampling(data=self.model_spec.data,
+                                          warmup=warmup,
+                                          chains=chains,
+                                          iter=_iter,
+                                          thin=thin,
+                                          n_jobs=n_jobs,
+                                          init=init,
+                                          **kw)
+        finally:
+            if self.stream:
+                monitor.stop("done" if hasattr(self, "fit") else "failed")
+        # large parameters are extracted into memory-mapped files rather than into memory
+        self.draws = DrawsStore(self.fit, spill_dir=conf.spill_dir)
+        if self.stream:
+            # the fit has the full-precision draws
+            shutil.rmtree(self.samples_dir)
 
+    def approximate(self):
+        """draws of the "map" or "laplace" approximation, in place of sampling; see `pkg.approx`"""
+        chains = self.sampling_args.get("chains", 4)
+        _iter = self.sampling_args.get("iter", 2000)
+        n_draws = (_iter - self.sampling_args.get("warmup", _iter // 2)) // self.sampling_args.get("thin", 1)
+        init = self.warm_start["inits"][0] if self.warm_start is not None else "random"
+        print "approximating posterior (%s) ..." % self.mode
+        draws, self.approximation = approximate(self.model, self.model_spec.data, self.mode, chains, n_draws,
+                                                init=init, seed=self.sampling_args.get("seed"),
+                                                pars=self.model_spec.sampling_pars())
+        print "  %s: log density %.4g at the mode, %d unconstrained parameters" % (
+            self.approximation["label"], self.approximation["log_density"], self.approximation["n_unconstrained"])
+        if self.approximation.get("mode_converged") is False:
+            print "  warning: no mode found (the log density may grow without bound), the approximation is unreliable"
+        if self.approximation.get("n_flat_directions"):
+            print "  warning: %d directions with no curvature at the mode, given variance %g" % (
+                self.approximation["n_flat_directions"], conf.laplace_flat_variance)
+        self.draws = ArrayDrawsStore(draws)
+
+    @spanned("post_process")
     def post_process(self, graphviz=True):
         """
         Plot parameters of interest in standard format and write text output.
+        With `post_process_workers` > 1, the plots are drawn in parallel worker processes.
+        A plot that fails is reported and recorded in `plot_failures` without stopping the others.
         """
         print "post processing ..."
-        for param in self.model_spec.single_params:
-            self.single_param_plot(param)
-
-        for pair in self.model_spec.param_pairs:
-            self.param_pair_plot(pair)
-
-        for name, params in self.model_spec.param_groups.items():
-            self.param_group_plot(name, params)
-
-        if graphviz:
+        if not isinstance(self.draws, MmapDrawsStore):
             try:
-                self.graphviz_plot()
-            except:
-                traceback.print_exc()
+                self.write_draws()
+            except Exception:
+                if isinstance(self.draws, DrawsStore):
+                    # don't leave spilled draws behind
+                    self.draws.clear()
+                raise
+            if isinstance(self.draws, DrawsStore) and self.draws.spilled:
+                # plot from the persisted copies, and drop the spilled ones
+                fallback = self.draws
+                self.draws = load_draws(self.output_dir, fallback=fallback)
+                fallback.clear()
+        jobs = plot_jobs(self.model_spec, graphviz=graphviz)
+        if self.lazy_plots or self.mode == "map":
+            # a MAP estimate is a single draw: nothing to plot a density of
+            jobs = [job for job in jobs if job[0] not in ("single", "pair", "group")]
+        if self.incremental:
+            outputs = OutputManifest(self.output_dir)
+            inputs = dict((job_label(job), inputs_hash(job, self.draws, self.model_spec)) for job in jobs)
+            inputs["diagnostics"] = hashlib.sha1(" ".join([self.draws.digest(p) for p in sorted(self.draws.params)]
+                                                          + [_source_digest(diagnostics)])).hexdigest()
+            for fn in outputs.prune(inputs.keys()):
+                print "removing stale < %s >" % os.path.join(self.output_dir, fn)
+            n_jobs = len(jobs)
+            jobs = [job for job in jobs if not outputs.is_current(job_label(job), inputs[job_label(job)])]
+            print "%d of %d plots up to date" % (n_jobs - len(jobs), n_jobs)
 
-        for f in self.model_spec.supplemental_plot_funcs:
-            f(self.fit, self.output_dir)
+        results = run_plot_jobs(jobs, self.draws, self.model_spec, self.output_dir,
+                                n_workers=self.post_process_workers, draws_dir=self.draws_dir,
+                                cprofile=self.profile.cprofile)
+        for job in jobs:
+            label = job_label(job)
+            if label in results:
+                self.profile.add(results[label]["span"], nbytes=draws_nbytes(self.draws, job_params([job])))
+        self.plot_failures = dict((label, result["error"]) for label, result in results.items() if result["error"])
+        if self.plot_failures:
+            print "%d of %d plots failed: %s" % (len(self.plot_failures), len(jobs), ", ".join(sorted(self.plot_failures)))
 
-        self.write_fit_stats()
+        update_diagnostics = True
+        if self.incremental:
+            for label, result in results.items():
+                if not result["error"]:
+                    outputs.record(label, inputs[label], result["files"])
+            update_diagnostics = not outputs.is_current("diagnostics", inputs["diagnostics"])
+            if update_diagnostics:
+                outputs.record("diagnostics", inputs["diagnostics"], [diagnostics_fn])
+            outputs.save()
+        if update_diagnostics:
+            self.write_diagnostics()
         self.copy_notes()
+        self.profile.save(self.output_dir)
+        # under the name of where the outputs went, e.g. a sweep variant's
+        name = entry_name(self.output_dir)
+        if name is not None:
+            publish(*name)
 
     def run(self):
         self.compile()
@@ -121,66 +370,90 @@ class StanAnalysis(object):
         """
         KDE + trace
         """
-        print param
-        trace = pd.Series(self.fit.extract(permuted=True)[param])
-        fig, axs = plt.subplots(2, 1, figsize=(12, 8))
-        sns.distplot(trace, 
-                     kde_kws={"lw": 2.5},
-                     hist_kws={"histtype": "stepfilled", "color": "slategray"},
-                     ax=axs[0])
-        x_min, x_max = axs[0].get_xlim()
-        if x_min < 0. < x_max:
-            axs[0].axvline(0., color="k", lw=1., alpha=0.6)
-        trace.plot(ax=axs[1])
-        fig.suptitle(param)
-        if write_to_disk:
-            fn = os.path.join(self.output_dir, "%s_trace.png" % param)
-            print "writing < %s >" % fn
-            fig.savefig(fn, bbox_inches="tight")
-        else:
-            plt.show()
+        from . import plots
+        plots.single_param_plot(self.draws, param, self.output_dir if write_to_disk else None)
 
     def param_pair_plot(self, pair, write_to_disk=True):
         """
         2d KDE to examine correlation
         """
-        x = self.fit.extract(permuted=True)[pair[0]]
-        y = self.fit.extract(permuted=True)[pair[1]]
-        df = pd.DataFrame({pair[0]: x, pair[1]: y})
-        sns.jointplot(pair[0], pair[1], data=df, kind="kde", size=10, space=0)
-        fig = plt.gcf()
-        if write_to_disk:
-            fn = os.path.join(self.output_dir, "%s-%s.png" % pair)
-            print "writing < %s >" % fn
-            fig.savefig(fn, bbox_inches="tight")
-        else:
-            plt.show()
+        from . import plots
+        plots.param_pair_plot(self.draws, pair, self.output_dir if write_to_disk else None)
 
     def param_group_plot(self, name, params, write_to_disk=True):
         """
         Many parameter correlation plots at once, in less detail
         """
-        df = pd.DataFrame({param: chain for param, chain in self.fit.extract(permuted=True).items() if param in params})
-        fig = sns.pairplot(df, vars=list(df.columns), diag_kind="kde", plot_kws={"alpha": 0.1})
-        if write_to_disk:
-            fn = os.path.join(self.output_dir, "%s_pairplot.png" % name)
-            print "writing < %s >" % fn
-            fig.savefig(fn, bbox_inches="tight")
-        else:
-            plt.show()
+        from . import plots
+        plots.param_group_plot(self.draws, name, params, self.output_dir if write_to_disk else None)
 
     def graphviz_plot(self):
-        dag = parse_stan(self.model_spec.model_code, self.model_spec.model_name)
-        fn = os.path.join(self.output_dir, "graphviz.png")
-        print "writing < %s >" % fn
-        dag.write_png(fn)
+        from . import plots
+        plots.graphviz_plot(self.model_spec.model_code, self.model_spec.model_name, self.output_dir)
 
-    def write_fit_stats(self):
-        fit_stats_fn = os.path.join(self.output_dir, "fit_stats.txt")
-        s = "<br>".join(repr(self.fit).replace(" ", "&nbsp;").split("\n")[1:])
-        print "writing < %s >" % fit_stats_fn
-        with open(fit_stats_fn, "w") as f:
-            f.write(s)
+    @spanned("write_draws", nbytes=lambda self: draws_nbytes(self.draws))
+    def write_draws(self, params=None):
+        """
+        Persist draws as memory-mappable .npy files under `<output_dir>/draws/`, all parameters by default.
+        Reopen them with `load_draws` (or `pkg.draws.load_draws`, which doesn't need PyStan).
+        """
+        params = params if params is not None else self.draws.params
+        if isinstance(self.draws, DrawsStore):
+            # draws are extracted from the fit on first use; time that apart from writing them
+            with self.profile.span("extract", nbytes=lambda: draws_nbytes(self.draws, params)):
+                for param in params:
+                    self.draws.chains(param)
+        print "writing < %s > (%d parameters)" % (self.draws_dir, len(params))
+        # the spec's plot lists, so flan.py can list (and render) the plots of a lazy run
+        spec_plots = {
+            "single_params": list(self.model_spec.single_params),
+            "param_pairs": [list(pair) for pair in self.model_spec.param_pairs],
+            "param_groups": dict((name, list(group)) for name, group in self.model_spec.param_groups.items()),
+        }
+        if self.mode == "map":
+            spec_plots = {"single_params": [], "param_pairs": [], "param_groups": {}}
+        write_draws(self.draws, params, self.draws_dir,
+                    category=self.model_spec.category,
+                    model_name=self.model_spec.model_name,
+                    sampling_args=self.sampling_args,
+                    plots=spec_plots,
+                    declarations=declarations(self.model_spec.model_code),
+                    labels=dict((k, [str(label) for label in v]) for k, v in self.model_spec.labels.items()),
+                    warm_start=self.warm_start["report"] if self.warm_start is not None else None,
+                    mode=self.mode,
+                    approximation=self.approximation)
+
+    @spanned("warm_start")
+    def load_warm_start(self):
+        """inits for each chain from the draws of the model's last run, if it persisted any"""
+        chains = self.sampling_args.get("chains", 4)
+        found = warm_start_inits(self.model_spec, self.output_dir, chains)
+        if found is None:
+            print "warm start: no persisted draws under < %s >, using Stan's inits" % self.output_dir
+            return
+        inits, report = found
+        print "warm start from < %s >:" % self.draws_dir
+        for param, outcome in sorted(report.items()):
+            print "  %s: %s" % (param, outcome)
+        self.warm_start = {"inits": inits, "report": report}
+
+    def load_samples(self):
+        """use the draws a streaming run has written so far, e.g. to post process it from another process"""
+        self.draws = StreamingDrawsStore(self.samples_dir)
+
+    def load_draws(self):
+        """use the draws persisted by a previous run, e.g. to re-plot without sampling again"""
+        self.draws = load_draws(self.output_dir)
+
+    @spanned("diagnostics", nbytes=lambda self: draws_nbytes(self.draws))
+    def write_diagnostics(self):
+        """
+        Mean, quantiles, split R-hat, bulk / tail ESS and MCSE of every parameter element, computed from the
+        draws in batches (see `pkg.diagnostics`) and written to `diagnostics.csv` for flan.py to sort and filter.
+        """
+        fn = os.path.join(self.output_dir, diagnostics_fn)
+        print "writing < %s >" % fn
+        write_diagnostics(self.draws, fn)
 
     def copy_notes(self):
         notes_fn = os.path.join(conf.models_dir, self.model_spec.category, self.model_spec.model_name, "notes.txt")
@@ -193,4 +466,7 @@ class StanAnalysis(object):
     def clean_output_dir(self):
         fns = [os.path.join(self.output_dir, fn) for fn in os.listdir(self.output_dir)]
         for fn in fns:
-            os.remove(fn)
\ No newline at end of file
+            if os.path.isdir(fn):
+                shutil.rmtree(fn)
+            else:
+                os.remove(fn)
\ No newline at end of file
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import hashlib
+import datetime
+import numpy as np
+from flask import Blueprint, Response, request, abort
+
+from .diagnostics import element_names, select
+from .stream import live_fn
+
+# JSON views of a model's persisted draws, registered on the flan.py app.
+# Every response carries an ETag and Last-Modified derived from the draws manifest,
+# so clients can poll with conditional GETs and get a 304 until a new run publishes.
+api = Blueprint("api", __name__)
+catalog = None   # set by `init_api`
+
+quantiles = [2.5, 25., 50., 75., 97.5]
+stream_chunk = 1000   # draws per streamed chunk
+
+def init_api(app, model_catalog):
+    global catalog
+    catalog = model_catalog
+    app.register_blueprint(api)
+
+def _draws(category, model_name):
+    entry = catalog.model(category, model_name)
+    draws = entry.draws_store() if entry else None
+    if draws is None:
+        abort(404)
+    return draws
+
+def diagnostics_query(args):
+    """keyword arguments for `pkg.diagnostics.select` from request arguments, worst R-hat first by default"""
+    return {
+        "sort": args.get("sort", "rhat"),
+        "descending": args.get("desc", "1") == "1",
+        "pattern": args.get("filter", ""),
+        "limit": args.get("limit", 50, type=int),
+    }
+
+def finite(value):
+    """`value` with every NaN or infinite float in it, however nested, replaced by None"""
+    if isinstance(value, float):
+        return value if np.isfinite(value) else None
+    if isinstance(value, dict):
+        return dict((k, finite(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [finite(v) for v in value]
+    return value
+
+def dumps(value):
+    """JSON, with non-finite numbers (R-hat of a constant, sd of a single draw, ...) as null: bare NaN isn't JSON"""
+    return json.dumps(finite(value), allow_nan=False)
+
+def _json_response(body, draws, *etag_parts):
+    """conditional response, with an ETag over the draws' content hashes and the request arguments"""
+    response = Response(body, mimetype="application/json")
+    h = hashlib.sha1(json.dumps(sorted(request.args.items(multi=True))))
+    for part in etag_parts:
+        h.update(part)
+    response.set_etag(h.hexdigest())
+    response.last_modified = datetime.datetime.utcfromtimestamp(int(draws.manifest["created"]))
+    return response.make_conditional(request)
+
+def summarize(chains, chunk_size=1000):
+    """
+    mean, sd and quantiles of each element of a parameter's (n_chains, n_draws) + dims draws,
+    a chunk of elements at a time so large parameters aren't copied whole
+    """
+    flat = chains.reshape(chains.shape[0] * chains.shape[1], -1)
+    stats = {"mean": [], "sd": []}
+    stats.update(("q%g" % q, []) for q in quantiles)
+    for i in range(0, flat.shape[1], chunk_size):
+        chunk = np.asarray(flat[:, i:i + chunk_size])
+        stats["mean"].extend(chunk.mean(axis=0).tolist())
+        stats["sd"].extend(chunk.std(axis=0, ddof=1).tolist())
+        for q, values in zip(quantiles, np.percentile(chunk, quantiles, axis=0)):
+            stats["q%g" % q].extend(np.atleast_1d(values).tolist())
+    return stats
+
+@api.route("/<category>/<model_name>/api/params")
+def params(category, model_name):
+    """persisted parameters with their dims"""
+    draws = _draws(category, model_name)
+    manifest = draws.manifest
+    body = {
+        "n_chains": manifest.get("n_chains"),
+        "n_draws": manifest.get("n_draws"),
+        "params": [{"name": param, "dims": info["shape"][2:], "dtype": info["dtype"]}
+                   for param, info in sorted(manifest["params"].items())],
+    }
+    digests = [draws.digest(p) for p in sorted(manifest["params"])]
+    return _json_response(dumps(body), draws, *digests)
+
+@api.route("/<category>/<model_name>/api/summary")
+def summary(category, model_name):
+    """
+    Summary statistics per parameter element.
+    ?params=a,b limits the parameters summarized.
+    """
+    draws = _draws(category, model_name)
+    names = request.args.get("params")
+    names = names.split(",") if names else sorted(draws.manifest["params"])
+    if any(name not in draws.manifest["params"] for name in names):
+        abort(404)
+    rows = []
+    for param in names:
+        chains = draws.chains(param)
+        stats = summarize(chains)
+        for i, name in enumerate(element_names(param, chains.shape[2:])):
+            row = {"name": name}
+            row.update((k, v[i]) for k, v in stats.items())
+            rows.append(row)
+    return _json_response(dumps({"summary": rows}), draws, *[draws.digest(p) for p in names])
+
+@api.route("/<category>/<model_name>/api/diagnostics")
+def diagnostics(category, model_name):
+    """
+    Rows of the model's convergence diagnostics; see `pkg.diagnostics`.
+    ?sort=<column>&desc=1 orders them (default: worst R-hat first), ?filter=<regex> matches names,
+    ?limit=N keeps the first N (default 50, 0 for all).
+    """
+    draws = _draws(category, model_name)
+    entry = catalog.model(category, model_name)
+    try:
+        rows, n_matching = select(entry.diagnostics(), **diagnostics_query(request.args))
+    except re.error:
+        abort(400)
+    body = dumps({"n_total": len(entry.diagnostics()), "n_matching": n_matching, "diagnostics": rows})
+    etag_parts = [draws.digest(p) for p in sorted(draws.manifest["params"])]
+    if os.path.exists(entry.diagnostics_fn):
+        etag_parts.append(repr(os.path.getmtime(entry.diagnostics_fn)))
+    return _json_response(body, draws, *etag_parts)
+
+@api.route("/<category>/<model_name>/api/draws/<param>")
+def param_draws(category, model_name, param):
+    """
+    Draws of one parameter, streamed chunk by chunk from the memory-mapped file:
+      {"param": ..., "dims": [...], "chains": [...], "draws": [[chain 1 draws], [chain 2 draws], ...]}
+    Query arguments select the slice:
+      chains=0,2       which chains (default: all)
+      start, stop      draw range within each chain (default: all)
+      step             keep every step-th draw
+      max_draws        alternatively, downsample evenly to at most this many draws per chain
+    """
+    draws = _draws(category, model_name)
+    if param not in draws.manifest["params"]:
+        abort(404)
+    chains = draws.chains(param)
+    try:
+        chain_idx = [int(c) for c in request.args["chains"].split(",")] if "chains" in request.args else range(chains.shape[0])
+        start = request.args.get("start", 0, type=int)
+        stop = request.args.get("stop", chains.shape[1], type=int)
+        step = request.args.get("step", 1, type=int)
+        max_draws = request.args.get("max_draws", None, type=int)
+        n = len(range(*slice(start, stop, step).indices(chains.shape[1])))
+        if max_draws and n > max_draws:
+            step *= -(-n // max_draws)
+        selected = [chains[c, start:stop:step] for c in chain_idx]
+    except (ValueError, IndexError):
+        abort(400)
+
+    def generate():
+        yield '{"param": %s, "dims": %s, "chains": %s, "draws": [' % (
+            json.dumps(param), json.dumps(list(chains.shape[2:])), json.dumps(chain_idx))
+        for i, chain in enumerate(selected):
+            yield "[" if i == 0 else ", ["
+            for j in range(0, len(chain), stream_chunk):
+                chunk = np.asarray(chain[j:j + stream_chunk])
+                values = (json.dumps(chunk.tolist()) if np.isfinite(chunk).all() else dumps(chunk.tolist()))[1:-1]
+                yield values if j == 0 else ", " + values
+            yield "]"
+        yield "]}"
+
+    return _json_response(generate(), draws, draws.digest(param))
+
+@api.route("/<category>/<model_name>/api/live")
+def live(category, model_name):
+    """
+    Progress of a streaming run, as its monitor last wrote it: per-chain (warmup, draws, expected) rows,
+    and diagnostics of the draws so far with an early convergence check; see `pkg.stream.LiveMonitor`.
+    """
+    entry = catalog.model(category, model_name)
+    fn = os.path.join(entry.model_dir, live_fn) if entry else None
+    if fn is None or not os.path.exists(fn):
+        abort(404)
+    with open(fn, "r") as f:
+        body = f.read()
+    response = Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
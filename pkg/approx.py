@@ -0,0 +1,135 @@
+import time
+import numpy as np
+from collections import OrderedDict
+
+from . import conf
+
+# Approximate inference, for iterating on a model in seconds rather than sampling it:
+#  - "map": the posterior mode from the compiled model's `optimizing` (L-BFGS), as a single draw
+#  - "laplace": a normal approximation on the unconstrained scale, where the draws are taken, so of the log
+#    density there with the Jacobian of the constraints: around its mode (refined with L-BFGS from the
+#    optimum of `optimizing`, which leaves the Jacobian out), with covariance the inverse of the negative
+#    Hessian there. Independent pseudo-draws from it are mapped back through the constraints (transformed
+#    parameters and generated quantities included).
+#    The Hessian is from central differences of Stan's gradient, 2 gradient evaluations per unconstrained
+#    parameter: its diagonal only, beyond `conf.laplace_max_dense_dims` parameters, saves memory but not
+#    time, and models with more than `conf.laplace_max_dims` are refused.
+# Both give draws shaped like a sampler's, (chains, draws) + dims, so post processing runs unchanged.
+
+modes = ["nuts", "map", "laplace"]
+# curvature, relative to the largest, below which a direction of the approximation counts as flat
+flat_tolerance = 1e-8
+# largest gradient component at which the Laplace mode counts as found (L-BFGS also stops when the log density
+# barely changes, as along a direction it grows in without bound)
+mode_gradient_tolerance = 1e-3
+labels = {
+    "map": "MAP point estimate (optimizing)",
+    "laplace": "Laplace approximation around the mode",
+}
+
+def layout(fit):
+    """(param, dims, offset) of each parameter in the flat vectors `constrain_pars` returns"""
+    found, offset = [], 0
+    for name, dims in zip(fit._get_param_names(), fit._get_param_dims()):
+        if name == "lp__":
+            continue
+        dims = tuple(int(d) for d in dims)
+        found.append((name, dims, offset))
+        offset += int(np.prod(dims))
+    return found
+
+def unflatten(flat, params):
+    """(n, k) constrained vectors -> param -> (n,) + dims, from Stan's column-major element order"""
+    values = OrderedDict()
+    for name, dims, offset in params:
+        block = flat[:, offset:offset + int(np.prod(dims))]
+        values[name] = np.ascontiguousarray(block.reshape((len(flat),) + dims[::-1]).transpose(
+            (0,) + tuple(range(len(dims), 0, -1))))
+    return values
+
+def hessian(fit, u, diagonal=False, step=None):
+    """
+    Hessian of the log density, with the Jacobian of the constraints, at unconstrained `u`:
+    one column per pair of gradient evaluations, or just the diagonal of each (at the same cost)
+    """
+    step = step if step else conf.laplace_step
+    d = len(u)
+    H = np.empty(d) if diagonal else np.empty((d, d))
+    for i in range(d):
+        h = step * max(1., abs(u[i]))
+        up, down = u.copy(), u.copy()
+        up[i] += h
+        down[i] -= h
+        column = (fit.grad_log_prob(up, adjust_transform=True) - fit.grad_log_prob(down, adjust_transform=True)) / (2 * h)
+        if diagonal:
+            H[i] = column[i]
+        else:
+            H[:, i] = column
+    return H if diagonal else (H + H.T) / 2.
+
+def laplace_mode(fit, u0):
+    """
+    (mode, log density there, whether it's a stationary point) of the log density on the unconstrained scale
+    with the Jacobian of the constraints, found with L-BFGS starting from `u0`
+    """
+    from scipy.optimize import minimize
+
+    def objective(u):
+        try:
+            return -fit.log_prob(u, adjust_transform=True), -fit.grad_log_prob(u, adjust_transform=True)
+        except (RuntimeError, ValueError):
+            # outside the support, or rejected by the model: steer the line search back
+            return np.inf, np.zeros_like(u)
+
+    result = minimize(objective, u0, jac=True, method="L-BFGS-B")
+    return result.x, -float(result.fun), bool(np.all(np.abs(result.jac) <= mode_gradient_tolerance))
+
+def normal_draws(u0, H, n, rng):
+    """
+    `n` draws from the normal with mean `u0` and precision -H (dense, or diagonal as a vector), and how many
+    directions had (next to) no downward curvature: those get the variance `conf.laplace_flat_variance` instead
+    """
+    z = rng.standard_normal((n, len(u0)))
+    w, V = (-H, None) if H.ndim == 1 else np.linalg.eigh(-H)
+    flat = w <= flat_tolerance * max(w.max(), 0.)
+    w = np.where(flat, 1. / conf.laplace_flat_variance, w)
+    scaled = z / np.sqrt(w)
+    return u0 + (scaled if V is None else np.dot(scaled, V.T)), int(flat.sum())
+
+def approximate(model, data, mode, n_chains, n_draws, init="random", seed=None, pars=None):
+    """
+    (param -> (n_chains, n_draws) + dims draws, including lp__, info) for mode "map" (a single draw,
+    whatever the counts) or "laplace". `pars`, if given, limits the draws to those parameters and lp__.
+    """
+    if mode not in labels:
+        raise ValueError("unknown approximation < %s >, expected one of %s" % (mode, ", ".join(sorted(labels))))
+    seed = seed if seed is not None else np.random.randint(2 ** 31 - 1)
+    fit = model.fit_class(data, seed)
+    n_unconstrained = len(fit.unconstrained_param_names())
+    if mode == "laplace" and n_unconstrained > conf.laplace_max_dims:
+        raise ValueError("the Laplace approximation of %d unconstrained parameters takes %d gradient evaluations for "
+                         "its Hessian (conf.laplace_max_dims is %d); use mode=\"map\", or sample"
+                         % (n_unconstrained, 2 * n_unconstrained, conf.laplace_max_dims))
+    optimum = model.optimizing(data=data, init=init, seed=seed, as_vector=False)
+    params = [p for p in layout(fit) if pars is None or p[0] in pars]
+    u0 = np.asarray(fit.unconstrain_pars(dict((k, np.asarray(v)) for k, v in optimum["par"].items())), dtype=float)
+    info = {"mode": mode, "label": labels[mode], "log_density": float(optimum["value"]), "n_unconstrained": n_unconstrained}
+    if mode == "map":
+        u = u0[None, :]
+        n_chains, n_draws = 1, 1
+    else:
+        u0, log_density, converged = laplace_mode(fit, u0)
+        diagonal = n_unconstrained > conf.laplace_max_dense_dims
+        start = time.time()
+        fit.grad_log_prob(u0, adjust_transform=True)
+        print "  Hessian: %d gradient evaluations, ~%.1fs" % (2 * n_unconstrained, 2 * n_unconstrained * (time.time() - start))
+        H = hessian(fit, u0, diagonal=diagonal)
+        u, n_flat = normal_draws(u0, H, n_chains * n_draws, np.random.RandomState(seed))
+        info.update({"log_density": log_density, "mode_converged": converged, "hessian": "diagonal" if diagonal else "dense",
+                     "n_flat_directions": n_flat})
+    flat = np.array([fit.constrain_pars(np.ascontiguousarray(x)) for x in u])
+    values = unflatten(flat, params)
+    # as the sampler reports it: the log density with the Jacobian, up to a constant
+    values["lp__"] = np.array([fit.log_prob(x, adjust_transform=True) for x in u])
+    draws = OrderedDict((k, v.reshape((n_chains, n_draws) + v.shape[1:])) for k, v in values.items())
+    return draws, info
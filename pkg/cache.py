@@ -0,0 +1,257 @@
+import os
+import time
+import json
+import fcntl
+import hashlib
+import platform
+import inspect
+import subprocess
+import cPickle as pickle
+import numpy as np
+from contextlib import contextmanager
+from distutils import sysconfig
+
+from . import conf
+
+# ----- helpers ----- #
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Exclusive advisory lock on `path`, held for the duration of the `with` block.
+    With `blocking=False`, yields False instead of waiting if another process holds the lock.
+    A holder may unlink `path` (see `evict`): whoever was waiting on the unlinked file then finds it
+    replaced or gone once it gets the lock, and locks the file now at `path` instead.
+    """
+    while True:
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            yield False
+            return
+        try:
+            current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+        except OSError:
+            current = False
+        if current:
+            break
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+    try:
+        yield True
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+def atomic_write(fn, write_func, mode="wb"):
+    """call `write_func(f)` on a temp file, then rename it into place"""
+    tmp_fn = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp_fn, mode) as f:
+        write_func(f)
+    os.rename(tmp_fn, fn)
+
+def evict(cache_dir, suffix, max_bytes=None, max_age=None, keep=()):
+    """
+    Remove cache entries (files ending in `suffix`, plus any siblings sharing their key) that are
+    older than `max_age` seconds, then the least recently used ones until at most `max_bytes` remain.
+    Entries whose lock is held by another process are left alone. Returns the removed keys.
+    """
+    entries = []
+    for fn in os.listdir(cache_dir):
+        if fn.endswith(suffix):
+            try:
+                st = os.stat(os.path.join(cache_dir, fn))
+            except OSError:
+                # evicted by another process meanwhile
+                continue
+            entries.append((st.st_mtime, st.st_size, fn[:-len(suffix)]))
+    entries.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for mtime, size, key in entries:
+        too_old = max_age is not None and now - mtime > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if key in keep or not (too_old or too_big):
+            continue
+        lock_fn = os.path.join(cache_dir, key + ".lock")
+        with file_lock(lock_fn, blocking=False) as locked:
+            if not locked:
+                continue
+            for fn in os.listdir(cache_dir):
+                if fn.startswith(key + ".") and fn != key + ".lock":
+                    os.remove(os.path.join(cache_dir, fn))
+            # while still holding it: anyone waiting on it retries on a new lock file (see `file_lock`)
+            os.remove(lock_fn)
+        total -= size
+        removed.append(key)
+    return removed
+
+_compiler_version = None
+
+def compiler_version():
+    """identifying string for the C++ toolchain PyStan will build extension modules with"""
+    global _compiler_version
+    if _compiler_version is None:
+        cc = sysconfig.get_config_var("CC") or "cc"
+        try:
+            out = subprocess.Popen(cc.split()[:1] + ["--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+            _compiler_version = out.split("\n")[0].strip()
+        except OSError:
+            _compiler_version = "unknown"
+        _compiler_version = "%s | %s | %s" % (cc, _compiler_version, platform.python_compiler())
+    return _compiler_version
+
+# ----- compiled models ----- #
+class CompiledModelCache(object):
+    """
+    On-disk cache of compiled `pystan.StanModel`s, keyed by the Stan source and the PyStan / compiler version.
+    Layout of `cache_dir`, for each key:
+      <key>.pkl   pickled StanModel
+      <key>.json  metadata: compile time, creation time, model name
+      <key>.lock  held while the entry is compiled or read, so concurrent runners compile once
+    Hit / miss counts and the compile time saved by hits accumulate in `stats.json`.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None, max_age=None):
+        self.cache_dir = cache_dir if cache_dir else conf.compile_cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else conf.compile_cache_max_bytes
+        self.max_age = max_age if max_age is not None else conf.compile_cache_max_age
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.stats_fn = os.path.join(self.cache_dir, "stats.json")
+
+    def key(self, model_code):
+        import pystan
+        h = hashlib.sha1()
+        for s in [model_code, pystan.__version__, compiler_version()]:
+            h.update(s)
+        return h.hexdigest()
+
+    def get(self, model_code, model_name=None):
+        """return the cached StanModel for `model_code`, compiling and storing it on a miss"""
+        key = self.key(model_code)
+        model_fn = os.path.join(self.cache_dir, key + ".pkl")
+        meta_fn = os.path.join(self.cache_dir, key + ".json")
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            model = self._load(model_fn)
+            seconds = self._compile_seconds(meta_fn) if model is not None else None
+            if seconds is not None:
+                os.utime(model_fn, None)
+                self._record(hit=True, seconds=seconds)
+                print "compile cache hit < %s > (saved ~%.1fs)" % (key[:12], seconds)
+            else:
+                import pystan
+                print "compile cache miss < %s >" % key[:12]
+                start = time.time()
+                model = pystan.StanModel(model_code=model_code)
+                seconds = time.time() - start
+                atomic_write(model_fn, lambda f: pickle.dump(model, f, pickle.HIGHEST_PROTOCOL))
+                meta = {"compile_seconds": seconds, "created": time.time(), "model_name": model_name}
+                atomic_write(meta_fn, lambda f: json.dump(meta, f), mode="w")
+                self._record(hit=False, seconds=seconds)
+        evict(self.cache_dir, ".pkl", max_bytes=self.max_bytes, max_age=self.max_age, keep=(key,))
+        self.print_report()
+        return model
+
+    def _load(self, model_fn):
+        if not os.path.exists(model_fn):
+            return None
+        try:
+            with open(model_fn, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # corrupt or incompatible entry; recompile over it
+            print "compile cache: discarding unreadable < %s >" % model_fn
+            return None
+
+    def _compile_seconds(self, meta_fn):
+        """compile time recorded in an entry's metadata, or None if that's missing or unreadable (a miss)"""
+        try:
+            with open(meta_fn, "r") as f:
+                return float(json.load(f)["compile_seconds"])
+        except (IOError, ValueError, KeyError, TypeError):
+            print "compile cache: discarding entry with unreadable metadata < %s >" % meta_fn
+            return None
+
+    def _record(self, hit, seconds):
+        with file_lock(self.stats_fn + ".lock"):
+            stats = self.report()
+            if hit:
+                stats["hits"] += 1
+                stats["saved_seconds"] += seconds
+            else:
+                stats["misses"] += 1
+                stats["compile_seconds"] += seconds
+            atomic_write(self.stats_fn, lambda f: json.dump(stats, f), mode="w")
+
+    def report(self):
+        """cumulative hit / miss stats for this cache directory"""
+        stats = {"hits": 0, "misses": 0, "compile_seconds": 0., "saved_seconds": 0.}
+        if os.path.exists(self.stats_fn):
+            with open(self.stats_fn, "r") as f:
+                stats.update(json.load(f))
+        return stats
+
+    def print_report(self):
+        stats = self.report()
+        print "compile cache: %d hits, %d misses, %.1fs spent compiling, ~%.1fs saved" % (
+            stats["hits"], stats["misses"], stats["compile_seconds"], stats["saved_seconds"])
+
+# ----- ModelSpec data ----- #
+def file_fingerprint(*paths):
+    """(path, mtime, size) of input files, for use in a `ModelSpec.data_fingerprint`"""
+    return [(path, os.path.getmtime(path), os.path.getsize(path)) for path in paths]
+
+class DataCache(object):
+    """
+    On-disk cache of ModelSpec data payloads: one `<key>.npz` per entry, holding one array per data key.
+    Reading an entry marks it used; once the directory holds more than `max_bytes`, the least recently
+    used entries are evicted.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir if cache_dir else conf.data_cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else conf.data_cache_max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, model_spec, fingerprint):
+        """hash of the spec's fingerprint and the source of the module defining its class"""
+        h = hashlib.sha1(json.dumps(fingerprint, sort_keys=True))
+        h.update(inspect.getsource(inspect.getmodule(type(model_spec))))
+        return "%s_%s_%s" % (model_spec.category, model_spec.model_name, h.hexdigest())
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """the cached data dict, or None on a miss"""
+        fn = self.path(key)
+        if not os.path.exists(fn):
+            return None
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            if not os.path.exists(fn):
+                # evicted meanwhile
+                return None
+            with np.load(fn) as f:
+                data = dict((k, f[k].item() if f[k].ndim == 0 else f[k]) for k in f.files)
+            os.utime(fn, None)
+        return data
+
+    def put(self, key, data):
+        """store a data dict; returns False if some value can't be stored as a plain array"""
+        arrays = dict((k, np.asarray(v)) for k, v in data.items())
+        objects = sorted(k for k, arr in arrays.items() if arr.dtype == object)
+        if objects:
+            print "data cache: not caching, values aren't plain arrays: %s" % ", ".join(objects)
+            return False
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            atomic_write(self.path(key), lambda f: np.savez(f, **arrays))
+        evict(self.cache_dir, ".npz", max_bytes=self.max_bytes, keep=(key,))
+        return True
+
+    def invalidate(self, key):
+        fn = self.path(key)
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            if os.path.exists(fn):
+                os.remove(fn)
@@ -0,0 +1,315 @@
+import os
+import csv
+import json
+import time
+import threading
+
+from .cache import file_lock
+from .draws import draws_dirname, manifest_fn, load_draws
+from .diagnostics import diagnostics_fn, read_diagnostics
+from .profiling import read_profile
+from .advisor import read_advice
+from .images import content_hash
+from . import conf
+
+# Sweeps (see `pkg.sweep`) write `static/<category>/<model_name>_sweep/`: a `sweep.json` listing the variants,
+# their summary, and one output directory per variant. The catalog lists a sweep among its category's models,
+# with a page of its variants, and knows each variant as a model of its own named "<sweep>:<variant>".
+sweep_fn = "sweep.json"
+variant_sep = ":"
+
+# ----- publishing ----- #
+def entry_name(output_dir, static_dir=None):
+    """
+    (category, model name) the catalog knows an output directory under `static_dir` by: a model's,
+    or a sweep variant's "<sweep>:<variant>"; None for a directory elsewhere
+    """
+    static_dir = static_dir if static_dir else conf.static_dir
+    parts = os.path.relpath(os.path.abspath(output_dir), os.path.abspath(static_dir)).split(os.sep)
+    if parts[0] == os.pardir or len(parts) not in (2, 3):
+        return None
+    return parts[0], variant_sep.join(parts[1:])
+
+def publish(category, model_name):
+    """
+    Note that a model's outputs changed, by appending "<time> <category>/<model_name>" to the publish log.
+    Catalogs in running flan.py processes pick this up on their next refresh.
+    """
+    with file_lock(conf.publish_log_fn + ".lock"):
+        with open(conf.publish_log_fn, "a") as f:
+            f.write("%f %s/%s\n" % (time.time(), category, model_name))
+
+# ----- index ----- #
+class ModelEntry(object):
+    """
+    What the model page shows for one model, read from its output directory once.
+    """
+    def __init__(self, category, model_name, model_dir, static_path=None):
+        self.category = category
+        self.model_name = model_name
+        self.model_dir = model_dir
+        # where the outputs are under /static/: "<category>/<model_name>", or deeper for a sweep variant
+        self.static_path = static_path if static_path else "%s/%s" % (category, model_name)
+        self.loaded = time.time()
+
+        # notes and fit print
+        self.notes = self._read("notes.txt", "No model notes.")
+        self.fit_stats = self._read("fit_stats.txt", "No model fit stats.")
+        self.diagnostics_fn = os.path.join(model_dir, diagnostics_fn)
+        self._diagnostics = None
+        # timing spans of the run that wrote the outputs
+        self.profile = read_profile(model_dir)
+        # loops in the model code that could be vectorized
+        self.advice = read_advice(model_dir)
+
+        # persisted draws, and the spec's plot lists they were written with
+        self.draws = []
+        self._draws_store = None
+        self.approximation = None
+        spec_plots = {}
+        draws_manifest_fn = os.path.join(model_dir, draws_dirname, manifest_fn)
+        if os.path.exists(draws_manifest_fn):
+            with open(draws_manifest_fn, "r") as f:
+                manifest = json.load(f)
+            self.draws = [(param, "x".join(str(d) for d in info["shape"]), "%s/%s" % (draws_dirname, info["file"]),
+                           self.plot_url("single", param) if len(info["shape"]) == 2 else None)
+                          for param, info in sorted(manifest["params"].items())]
+            spec_plots = manifest.get("plots", {})
+            # set when the draws are from a MAP or Laplace approximation rather than sampling
+            self.approximation = manifest.get("approximation")
+
+        # filter for filenames of each plot type to make list of static urls
+        fns = os.listdir(model_dir)
+        self.graphviz = self.image("graphviz", "graphviz.png") if "graphviz.png" in fns else None
+        single_param_fns = [fn for fn in fns if "trace" in fn]
+        param_pair_fns = [fn for fn in fns if "-" in fn]
+        param_group_fns = [fn for fn in fns if "pairplot" in fn]
+        supplemental_png_fns = set([fn for fn in fns if ".png" in fn])
+        supplemental_png_fns -= set(single_param_fns)
+        supplemental_png_fns -= set(param_pair_fns)
+        supplemental_png_fns -= set(param_group_fns)
+        supplemental_png_fns -= set(["graphviz.png"])
+        supplemental_png_fns = list(supplemental_png_fns)
+        # format filenames into (title, url, thumbnail url)
+        self.single_params = [self.image(fn.replace("_trace.png", ""), fn) for fn in single_param_fns]
+        self.param_pairs = [self.image("%s vs %s" % tuple(fn.replace(".png", "").split("-")[::-1]), fn) for fn in param_pair_fns]
+        self.param_groups = [self.image(fn.replace("_pairplot.png", ""), fn) for fn in param_group_fns]
+        self.supplemental = [self.image(fn.replace(".png", ""), fn) for fn in supplemental_png_fns]
+
+        # plots the spec asked for that weren't drawn in post processing are rendered on demand, when clicked
+        fns = set(fns)
+        self.single_params += [(param, self.plot_url("single", param), None) for param in spec_plots.get("single_params", [])
+                               if "%s_trace.png" % param not in fns]
+        self.param_pairs += [("%s vs %s" % (y, x), self.plot_url("pair", x, y), None) for x, y in spec_plots.get("param_pairs", [])
+                             if "%s-%s.png" % (x, y) not in fns]
+        if spec_plots.get("param_groups"):
+            from .plots import group_plot_files
+        for name, params in sorted(spec_plots.get("param_groups", {}).items()):
+            group_fns = group_plot_files(name, params)
+            for page, fn in enumerate(group_fns, 1):
+                if fn not in fns:
+                    title = name if len(group_fns) == 1 else "%s_p%d" % (name, page)
+                    self.param_groups.append((title, self.plot_url("group", name) + ("?page=%d" % page if page > 1 else ""), None))
+
+    def __repr__(self):
+        return "<ModelEntry(category=%s, model_name=%s)>" % (self.category, self.model_name)
+
+    def _read(self, fn, default):
+        fn = os.path.join(self.model_dir, fn)
+        if os.path.exists(fn):
+            with open(fn, "r") as f:
+                return f.read()
+        return default
+
+    def static_url(self, fn):
+        return "/static/%s/%s" % (self.static_path, fn)
+
+    def image(self, title, fn):
+        """
+        (title, url, thumbnail url) of a png output; both urls carry its content hash, so browsers
+        can cache them until the file changes (see `static_file` in flan.py)
+        """
+        version = "?v=%s" % content_hash(os.path.join(self.model_dir, fn))
+        return (title, self.static_url(fn) + version,
+                "/thumb/%s/%s%s" % (self.static_path, fn, version))
+
+    def plot_url(self, kind, *args):
+        """url flan.py renders a plot at on demand; see `model_plot` there"""
+        return "/%s/%s/plot/%s/%s.png" % (self.category, self.model_name, kind, "/".join(args))
+
+    def draws_store(self):
+        """the model's persisted draws, memory-mapped, or None if it has none"""
+        if self._draws_store is None and self.draws:
+            self._draws_store = load_draws(self.model_dir)
+        return self._draws_store
+
+    def diagnostics(self):
+        """rows of the model's diagnostics.csv, read on first use; empty if it has none"""
+        if self._diagnostics is None:
+            self._diagnostics = read_diagnostics(self.diagnostics_fn) if os.path.exists(self.diagnostics_fn) else []
+        return self._diagnostics
+
+    def page_kw(self):
+        """keyword arguments for templates/model.html"""
+        return {
+            "static_path": self.static_path,
+            "notes": self.notes,
+            "fit_stats": self.fit_stats,
+            "draws": self.draws,
+            "graphviz": self.graphviz,
+            "single_params": self.single_params,
+            "param_pairs": self.param_pairs,
+            "param_groups": self.param_groups,
+            "supplemental": self.supplemental,
+            "profile": self.profile,
+            "profile_total": sum(span["wall"] for span in self.profile if span["depth"] == 0),
+            "advice": self.advice,
+            "approximation": self.approximation,
+        }
+
+class SweepEntry(object):
+    """
+    What the sweep page shows for one sweep: its variants, with their settings, status and page,
+    and the posterior means of the first `conf.sweep_print_rows` elements of its summary, side by side
+    """
+    def __init__(self, category, sweep_name, sweep_dir):
+        from .sweep import summary_fn
+        self.category = category
+        self.sweep_name = sweep_name
+        self.sweep_dir = sweep_dir
+        with open(os.path.join(sweep_dir, sweep_fn), "r") as f:
+            self.variants = json.load(f)
+        for variant in self.variants:
+            variant["page"] = "/%s/%s%s%s/" % (category, sweep_name, variant_sep, variant["name"])
+            variant["total_seconds"] = sum(s for s in variant.get("seconds", {}).values() if s)
+        self.summary_url = None
+        self.summary_header, self.summary_rows = [], []
+        summary_fn = os.path.join(sweep_dir, summary_fn)
+        if os.path.exists(summary_fn):
+            self.summary_url = "/static/%s/%s/%s" % (category, sweep_name, os.path.basename(summary_fn))
+            with open(summary_fn, "rb") as f:
+                rows = list(csv.reader(f))
+            means = [i for i, column in enumerate(rows[0]) if column.startswith("mean ")]
+            self.summary_header = [rows[0][i][len("mean "):] for i in means]
+            self.summary_rows = [(row[0], [row[i] for i in means]) for row in rows[1:conf.sweep_print_rows + 1]]
+
+    def __repr__(self):
+        return "<SweepEntry(category=%s, sweep_name=%s, variants=%d)>" % (self.category, self.sweep_name, len(self.variants))
+
+    def page_kw(self):
+        """keyword arguments for templates/sweep.html"""
+        return {
+            "variants": self.variants,
+            "summary_url": self.summary_url,
+            "summary_header": self.summary_header,
+            "summary_rows": self.summary_rows,
+        }
+
+class Catalog(object):
+    """
+    In-process index of the model outputs under `static/<category>/<model_name>/`, and of sweeps' variants.
+    The directory tree is listed once; model entries are read on first use and then kept.
+    `refresh()`, at most every `refresh_seconds`, stats the static dir, the category dirs and the publish log:
+     - new lines in the publish log invalidate just the models they name
+     - a changed directory mtime (models added or removed by hand) or a truncated log relists the tree
+    so page renders don't scan the filesystem.
+    """
+    def __init__(self, static_dir=None, publish_log_fn=None, refresh_seconds=None):
+        self.static_dir = static_dir if static_dir else conf.static_dir
+        self.publish_log_fn = publish_log_fn if publish_log_fn else conf.publish_log_fn
+        self.refresh_seconds = refresh_seconds if refresh_seconds is not None else conf.catalog_refresh_seconds
+        self.lock = threading.RLock()
+        self.rebuild()
+
+    def __repr__(self):
+        return "<Catalog(categories=%d, models=%d)>" % (len(self.index), sum(len(m) for m in self.index.values()))
+
+    def rebuild(self):
+        with self.lock:
+            self.index = {}
+            # (category, sweep name) -> names of its variants' output directories
+            self.sweeps = {}
+            self.dir_mtimes = {self.static_dir: os.path.getmtime(self.static_dir)}
+            for cat in os.listdir(self.static_dir):
+                category_dir = os.path.join(self.static_dir, cat)
+                if not os.path.isdir(category_dir) or cat in ["css", "js"]:
+                    continue
+                self.dir_mtimes[category_dir] = os.path.getmtime(category_dir)
+                models = [m for m in os.listdir(category_dir) if os.path.isdir(os.path.join(category_dir, m))]
+                self.index[cat] = sorted(models)
+                for m in models:
+                    model_dir = os.path.join(category_dir, m)
+                    if os.path.exists(os.path.join(model_dir, sweep_fn)):
+                        # variants appear as the sweep runs
+                        self.dir_mtimes[model_dir] = os.path.getmtime(model_dir)
+                        self.sweeps[(cat, m)] = set(v for v in os.listdir(model_dir)
+                                                    if os.path.isdir(os.path.join(model_dir, v)))
+            self.entries = {}
+            self.log_offset = self._log_size()
+            self.checked = time.time()
+
+    def _log_size(self):
+        return os.path.getsize(self.publish_log_fn) if os.path.exists(self.publish_log_fn) else 0
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and time.time() - self.checked < self.refresh_seconds:
+                return
+            self.checked = time.time()
+            for d, mtime in self.dir_mtimes.items():
+                if not os.path.exists(d) or os.path.getmtime(d) != mtime:
+                    return self.rebuild()
+            log_size = self._log_size()
+            if log_size < self.log_offset:
+                return self.rebuild()
+            if log_size > self.log_offset:
+                with open(self.publish_log_fn, "r") as f:
+                    f.seek(self.log_offset)
+                    lines = f.read(log_size - self.log_offset).splitlines()
+                self.log_offset = log_size
+                for line in lines:
+                    key = tuple(line.split(" ", 1)[-1].split("/", 1))
+                    self.entries.pop(key, None)
+                    if len(key) == 2 and not self._known(*key):
+                        # first run of a new model; pick up the new directories
+                        return self.rebuild()
+
+    def _known(self, category, model_name):
+        if variant_sep in model_name:
+            sweep_name, variant = model_name.split(variant_sep, 1)
+            return variant in self.sweeps.get((category, sweep_name), ())
+        return model_name in self.index.get(category, [])
+
+    def categories(self):
+        self.refresh()
+        return sorted(self.index)
+
+    def models(self, category):
+        self.refresh()
+        return self.index.get(category, [])
+
+    def model(self, category, model_name):
+        """the ModelEntry for a model or a sweep variant ("<sweep>:<variant>"), or None if it has no outputs"""
+        self.refresh()
+        key = (category, model_name)
+        with self.lock:
+            if key in self.sweeps:
+                return None
+            if key not in self.entries:
+                if not self._known(category, model_name):
+                    return None
+                static_path = "/".join([category] + model_name.split(variant_sep, 1))
+                self.entries[key] = ModelEntry(category, model_name, os.path.join(self.static_dir, *static_path.split("/")),
+                                               static_path=static_path)
+            return self.entries[key]
+
+    def sweep(self, category, sweep_name):
+        """the SweepEntry for a sweep, or None if there's no such sweep"""
+        self.refresh()
+        key = (category, sweep_name)
+        with self.lock:
+            if key not in self.sweeps:
+                return None
+            if key not in self.entries:
+                self.entries[key] = SweepEntry(category, sweep_name, os.path.join(self.static_dir, category, sweep_name))
+            return self.entries[key]
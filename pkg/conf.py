@@ -5,3 +5,92 @@ flan_dir = os.path.abspath(os.path.join(pkg_dir, os.pardir))
 
 models_dir = os.path.join(pkg_dir, "models")
 static_dir = os.path.join(flan_dir, "static")
+cache_dir = os.path.join(flan_dir, "cache")
+
+# compiled StanModels, keyed by Stan source + PyStan / compiler version
+compile_cache_dir = os.path.join(cache_dir, "models")
+compile_cache_max_bytes = 2 * 1024 ** 3
+compile_cache_max_age = 60 * 24 * 3600
+
+# post processing: plot worker processes, and where they share draws (shared memory if available)
+post_process_workers = 1
+scratch_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# runner.py: per-job status and timing of the last run
+runner_report_fn = os.path.join(flan_dir, "runner_report.json")
+
+# ModelSpec data payloads, for specs that define `data_fingerprint`
+data_cache_dir = os.path.join(cache_dir, "data")
+data_cache_max_bytes = 1024 ** 3
+
+# flan.py's catalog of model outputs: StanAnalysis appends to the publish log after each run,
+# and the catalog checks for changes at most this often
+publish_log_fn = os.path.join(static_dir, "published.log")
+catalog_refresh_seconds = 2.
+
+# plots flan.py renders on demand from persisted draws
+render_cache_dir = os.path.join(cache_dir, "renders")
+render_cache_max_bytes = 512 * 1024 ** 2
+
+# model pages show thumbnails of the plots, at most `thumbnail_max_px` on their longer side, and load the
+# full images on click; browsers that accept `image_format` ("webp" or "jpeg", written with PIL; None for
+# the original pngs) get that instead. Both are kept in `image_cache_dir`.
+thumbnail_max_px = 480
+image_format = "webp"
+image_quality = 85
+image_cache_dir = os.path.join(cache_dir, "images")
+image_cache_max_bytes = 512 * 1024 ** 2
+
+# files under static/ are served with their content hash as ETag; urls carrying it (`?v=<hash>`)
+# are cached by browsers for this long without asking again
+static_max_age = 365 * 24 * 3600
+
+# convergence diagnostics: parameter elements summarized per batch
+diagnostics_chunk_size = 256
+
+# trace plots: points drawn per chain, picked to keep the trace's shape
+trace_max_points = 1000
+
+# parameter group plots: "binned" draws 2D histograms of every pair at once, with a subsample of draws
+# scattered over them, and splits groups wider than `group_plot_page_size` into tiled pages;
+# "pairplot" is a seaborn scatter pairplot of every draw
+group_plot_mode = "binned"
+group_plot_bins = 40
+group_plot_scatter_draws = 300
+group_plot_page_size = 16
+
+# extraction: parameters whose draws take at least `spill_min_bytes` are copied out of the fit
+# `spill_chunk_bytes` at a time into memory-mapped files under `spill_dir`, rather than into memory
+spill_dir = os.path.join(cache_dir, "spill")
+spill_min_bytes = 256 * 1024 ** 2
+spill_chunk_bytes = 64 * 1024 ** 2
+
+# parameter sweeps: elements whose means are printed side by side (all are in sweep_summary.csv)
+sweep_print_rows = 40
+
+# approximate inference (StanAnalysis `mode="laplace"`): central difference step of the Hessian, relative to
+# each coordinate, the most unconstrained parameters it's stored densely for (only its diagonal beyond, which
+# saves memory but not time: either takes 2 gradient evaluations per parameter), the most it's attempted for,
+# and the variance given to directions the log density doesn't curve down in (unit, as Stan's inits)
+laplace_step = 1e-5
+laplace_max_dense_dims = 2000
+laplace_max_dims = 20000
+laplace_flat_variance = 1.
+
+# warm starts: warmup iterations for chains started from a previous fit's draws
+warm_start_warmup = 200
+
+# streaming runs: chains write their draws to sample files that a monitor thread tails every
+# `stream_poll_seconds`, writing progress and, once every chain has `stream_min_draws` draws, diagnostics
+# to live.json; the run looks converged once max R-hat < `stream_max_rhat` and min bulk ESS > `stream_min_ess`
+stream_poll_seconds = 5.
+stream_read_bytes = 4 * 1024 ** 2
+stream_min_draws = 20
+stream_max_rhat = 1.01
+stream_min_ess = 400
+stream_worst_rows = 10
+
+# profiling: stages (or plot job labels, e.g. "single mu") to also run under cProfile, comma separated in
+# $FLAN_CPROFILE, and how many functions the text summary of each lists
+cprofile_stages = [name for name in os.environ.get("FLAN_CPROFILE", "").split(",") if name]
+cprofile_top_functions = 40
@@ -1,5 +1,6 @@
 import re
-import pydot
+import hashlib
+from collections import OrderedDict
 
 # ----- globals ----- #
 datatypes = [
@@ -17,6 +18,12 @@ regexs = [
     ("model", re.compile("model\s*{")),
     ("generated quantities", re.compile("generated quantities\s*{")),
 ]
+brace_re = re.compile("[{}]")
+identifier_re = re.compile("[A-Za-z_]\w*")
+target_token_re = re.compile("[A-Za-z_]\w*|[\[(]|[\])]")
+# (nodes, edges) parsed by parse_stan, by hash of the code, oldest first
+parse_cache = OrderedDict()
+parse_cache_size = 32
 fillcolors = {
     "data": "slategray",
     "transformed data": "slategray", 
@@ -43,14 +50,17 @@ class Node(object):
     `datatype`: int, real, vector, etc
     `dims`: tuple of the dimensions that index the variable, or None for scalar params
       matrix[N,M] real[2,2] -> ("N", "M", "2", "2")
+    `shape`: the same dimensions in the order Stan indexes the variable (and PyStan shapes its draws),
+      array dimensions first: vector[N] x[M] -> ("M", "N")
     `block`: block where defined
     `deterministic`: True if defined "<-"; False if defined by "~"
     """
-    def __init__(self, name, datatype, constraint, dims, block):
+    def __init__(self, name, datatype, constraint, dims, block, shape=None):
         self.name = name
         self.datatype = datatype
         self.constraint = constraint
         self.dims = dims
+        self.shape = shape
         self.block = block
         self.deterministic = False    # change while parsing edges if deterministic
         self.include = False          # change while parsing edges if node is involved in "~" or "<-"
@@ -72,12 +82,14 @@ class DAG(object):
     deterministic -> double bordered
     """
     def __init__(self, nodes, edges, graph_name=None):
+        # only drawing needs pydot; parsing doesn't
+        import pydot
         self.nodes = nodes
         self.edges = edges
         self.graph_name = graph_name if graph_name else "Stan Graph"
         self.dims = list(set([node.dims for node in self.nodes if node.dims]))
-        # flat list of dim names so we can exclude them from the graph
-        self.flat_dims = [dim for dim_tuple in self.dims for dim in dim_tuple]
+        # flat set of dim names so we can exclude them from the graph
+        self.flat_dims = set([dim for dim_tuple in self.dims for dim in dim_tuple])
         self.clusters = {repr(dim): pydot.Cluster(str(i), 
                                                   label='%s' % repr(dim).replace("'", ""), 
                                                   fontsize=18,
@@ -85,6 +97,7 @@ class DAG(object):
                                                   labelloc="b") for i, dim in enumerate(self.dims)}
         self.graph = pydot.Dot(graph_type="digraph", label='"%s"' % graph_name)
         self.edge_pairs = []
+        seen_pairs = set()
 
         for node in self.nodes:
             # we don't need to plot nodes corresponding only to vector / array dims
@@ -106,9 +119,10 @@ class DAG(object):
             if edge.from_name in self.flat_dims or edge.to_name in self.flat_dims:
                 continue
             edge_pair = (edge.from_name, edge.to_name)
-            if edge_pair not in self.edge_pairs:
+            if edge_pair not in seen_pairs:
                 self.graph.add_edge(pydot.Edge(*edge_pair))
                 self.edge_pairs.append(edge_pair)
+                seen_pairs.add(edge_pair)
 
     def write_png(self, filepath):
         self.graph.write_png(filepath)
@@ -126,25 +140,16 @@ def preprocess_code(code):
     return code
 
 def get_block(code, regex):
-    # return list of lines for a block
-    i, depth = None, None
+    # return list of lines for a block: jump from brace to brace to its closing brace, then slice
     m = regex.search(code)
-    if m:
-        s = ""
-        i = m.end()
-        depth = 1
-        while depth > 0:
-            if code[i] == "}":
-                depth -= 1
-            elif code[i] == "{":
-                depth += 1
-            if depth > 0:
-                s += code[i]
-            i += 1
-        s = s.strip()
-        return s.split("\n")
-    else:
+    if not m:
         return None
+    depth = 1
+    for brace in brace_re.finditer(code, m.end()):
+        depth += 1 if brace.group() == "{" else -1
+        if depth == 0:
+            return code[m.end():brace.start()].strip().split("\n")
+    raise ValueError("unbalanced braces after < %s >" % m.group())
 
 def get_blocks(code):
     # blocks: name -> list of lines
@@ -176,25 +181,50 @@ def build_nodes(blocks):
             for line in lines:
                 try:
                     datatype, constraint, dim, name, array_dim = declaration_re.match(line).groups()
-                    nodes_dict[name] = Node(name, datatype, constraint, process_dims(dim, array_dim), block_name)
+                    nodes_dict[name] = Node(name, datatype, constraint, process_dims(dim, array_dim), block_name,
+                                            shape=process_dims(array_dim, dim))
                 except:
                     pass
     return nodes_dict
 
 # -- edges -- #
 def collapse_multiline(lines):
-    for i, line in enumerate(lines):
-        if ("~" in line or "<-" in line) and line[-1] != ";":
-            return collapse_multiline(lines[:i] + ["".join(lines[i:i+2])] + lines[i+2:])
-    return lines
+    # join "~" and "<-" statements that continue over several lines onto one line, in one pass
+    collapsed = []
+    i = 0
+    while i < len(lines):
+        parts = [lines[i]]
+        i += 1
+        while ("~" in parts[0] or "<-" in parts[0]) and parts[-1][-1:] != ";" and i < len(lines):
+            parts.append(lines[i])
+            i += 1
+        collapsed.append("".join(parts))
+    return collapsed
+
+def target_node(to_str, nodes_dict):
+    """
+    The variable a statement assigns or samples: the last node name outside any brackets, so
+    `for (n in 1:N) y[n]` gives y; else the first node name, so `tail(ambient, N - 1)` gives ambient.
+    """
+    outside, inside = [], []
+    depth = 0
+    for m in target_token_re.finditer(to_str):
+        token = m.group()
+        if token in "[(":
+            depth += 1
+        elif token in "])":
+            depth -= 1
+        elif token in nodes_dict:
+            (outside if depth == 0 else inside).append((m.start(), token))
+    if outside:
+        return outside[-1][1]
+    return min(inside)[1] if inside else None
 
 def build_edges(blocks, nodes_dict):
     """
     Parse the blocks where we do assignment and distribution declarations for edges.
     For assignments, set the `deterministic` attribute of the assigned node to be True.
     """
-    node_names = nodes_dict.keys()
-    nodes_re = re.compile("|".join(node_names))
     block_names = ["transformed data", "transformed parameters", "model", "generated quantities"]
     edges = []
     for block_name in block_names:
@@ -203,13 +233,14 @@ def build_edges(blocks, nodes_dict):
             lines = collapse_multiline(lines)
             lines = filter(lambda line: "~" in line or "<-" in line, lines)
             for line in lines:
-                line = re.sub("\s+", "", line)
                 deterministic = "<-" in line
-                to_str, from_str = line.split("<-" if deterministic else "~")
-                to_node = re.findall(nodes_re, to_str)[0]
-                from_nodes = re.findall(nodes_re, from_str)
-                # filter out instances where a variable name is *contained* in another variable name
-                from_nodes = [n for n in from_nodes if re.search("\W%s\W" % n, ";" + from_str)]
+                to_str, from_str = line.split("<-" if deterministic else "~", 1)
+                to_node = target_node(to_str, nodes_dict)
+                if to_node is None:
+                    # e.g. a local variable of the model block
+                    continue
+                # whole identifiers only, so a name *contained* in another variable name doesn't match
+                from_nodes = [n for n in identifier_re.findall(from_str) if n in nodes_dict]
 
                 # save state on the nodes
                 nodes_dict[to_node].include = True
@@ -222,8 +253,17 @@ def build_edges(blocks, nodes_dict):
     return edges
 
 def parse_stan(code, graph_name=None):
-    blocks = get_blocks(code)
-    nodes_dict = build_nodes(blocks)
-    edges = build_edges(blocks, nodes_dict)
-    nodes = nodes_dict.values()
-    return DAG(nodes, edges, graph_name)
+    """
+    a new DAG of a Stan program; the parse is memoized on the code, so re-plotting an unchanged model
+    doesn't re-parse it
+    """
+    key = hashlib.sha1(code).hexdigest()
+    if key not in parse_cache:
+        blocks = get_blocks(code)
+        nodes_dict = build_nodes(blocks)
+        edges = build_edges(blocks, nodes_dict)
+        if len(parse_cache) >= parse_cache_size:
+            parse_cache.popitem(last=False)
+        parse_cache[key] = (tuple(nodes_dict.values()), tuple(edges))
+    nodes, edges = parse_cache[key]
+    return DAG(list(nodes), list(edges), graph_name)
@@ -0,0 +1,107 @@
+import numpy as np
+
+# Numerical helpers for plotting large posteriors in time linear in the number of draws:
+# densities are estimated on a fixed grid of bins instead of at every draw, and traces keep only
+# the points that carry their shape.
+
+def scott_bandwidth(x):
+    """Scott's rule, the default bandwidth of seaborn's (scipy's) Gaussian KDE"""
+    return np.std(x, ddof=1) * len(x) ** -0.2
+
+def freedman_diaconis_bins(x, max_bins=50):
+    """the number of histogram bins seaborn's distplot uses"""
+    iqr = np.subtract(*np.percentile(x, [75, 25]))
+    if len(x) < 2 or iqr == 0:
+        return int(np.sqrt(len(x)))
+    h = 2 * iqr / len(x) ** (1. / 3)
+    return int(min(np.ceil((np.max(x) - np.min(x)) / h), max_bins))
+
+def linear_binning(x, lo, delta, gridsize):
+    """weights of draws spread over their two neighbouring grid points, in proportion to proximity"""
+    pos = (x - lo) / delta
+    left = np.clip(np.floor(pos).astype(int), 0, gridsize - 1)
+    frac = pos - left
+    return (np.bincount(left, weights=1. - frac, minlength=gridsize)
+            + np.bincount(np.minimum(left + 1, gridsize - 1), weights=frac, minlength=gridsize))
+
+def binned_kde(x, gridsize=512, cut=3., bw=None):
+    """
+    Gaussian KDE of the draws `x` on `gridsize` points spanning their range plus `cut` bandwidths,
+    as (grid, density), or None if the draws are constant.
+    The draws are linearly binned onto the grid and the bin counts convolved with the kernel by FFT,
+    so the cost is O(n_draws + gridsize log gridsize) rather than O(n_draws * gridsize).
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    bw = bw if bw is not None else scott_bandwidth(x)
+    if not np.isfinite(bw) or bw <= 0:
+        return None
+    lo, hi = x.min() - cut * bw, x.max() + cut * bw
+    grid = np.linspace(lo, hi, gridsize)
+    delta = grid[1] - grid[0]
+    counts = linear_binning(x, lo, delta, gridsize)
+    # kernel out to 4 bandwidths, within the grid
+    half_width = int(min(gridsize - 1, np.ceil(4 * bw / delta)))
+    offsets = np.arange(-half_width, half_width + 1) * delta
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2) / (bw * np.sqrt(2 * np.pi))
+    size = 2 ** int(np.ceil(np.log2(gridsize + 2 * half_width + 1)))
+    density = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    density = density[half_width:half_width + gridsize] / len(x)
+    return grid, np.maximum(density, 0.)
+
+def lttb(y, n_out):
+    """
+    Indices of `n_out` points of the series `y` (against its index) chosen by largest-triangle-three-buckets:
+    the first and last points, plus from each of `n_out` - 2 equal buckets the point forming the largest
+    triangle with the previously chosen point and the mean of the next bucket. Keeps spikes and the
+    envelope of a trace that plain thinning would lose.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    cumsum = np.concatenate([[0.], np.cumsum(y)])
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_lo, next_hi = edges[i + 1], edges[i + 2]
+            avg_x = (next_lo + next_hi - 1) / 2.
+            avg_y = (cumsum[next_hi] - cumsum[next_lo]) / (next_hi - next_lo)
+        else:
+            avg_x, avg_y = n - 1., y[n - 1]
+        xs = np.arange(lo, hi)
+        area = np.abs((a - avg_x) * (y[lo:hi] - y[a]) - (a - xs) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def bin_indices(x, lo, hi, bins):
+    """bin number in [0, bins) of each entry of (n, k) draws, over per-column ranges [lo, hi]"""
+    scaled = (x - lo) / (hi - lo) * bins
+    return np.clip(scaled.astype(int), 0, bins - 1)
+
+def pair_histograms(x, pairs, bins, lo, hi, max_codes=2 ** 22):
+    """
+    2D histograms of many column pairs of the (n, k) draws `x` at once: counts shaped (len(pairs), bins, bins),
+    where counts[p, a, b] counts draws with column pairs[p][0] in bin a and column pairs[p][1] in bin b.
+    Each pair's cells get their own range of codes, so one `bincount` per chunk of draws fills every histogram;
+    chunks hold at most `max_codes` codes to bound memory.
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    offsets = np.arange(len(pairs)) * bins * bins
+    counts = np.zeros(len(pairs) * bins * bins)
+    chunk_size = max(1, max_codes // max(len(pairs), 1))
+    for start in range(0, len(x), chunk_size):
+        idx = bin_indices(x[start:start + chunk_size], lo, hi, bins)
+        codes = offsets + idx[:, pairs[:, 0]] * bins + idx[:, pairs[:, 1]]
+        counts += np.bincount(codes.ravel(), minlength=len(counts))
+    return counts.reshape(len(pairs), bins, bins)
+
+def strided_sample(n, size):
+    """`size` evenly spaced indices into `n` draws: a deterministic subsample spanning every chain"""
+    if size >= n:
+        return np.arange(n)
+    return np.linspace(0, n - 1, size).astype(int)
@@ -0,0 +1,182 @@
+import os
+import re
+import csv
+import numpy as np
+
+from . import conf
+
+# Convergence diagnostics for every scalar in a posterior, computed from the draws rather than the fit:
+# means, quantiles, rank-normalized split R-hat, bulk / tail ESS and MCSE, as in Vehtari, Gelman, Simpson,
+# Carpenter & Buerkner (2021), "Rank-normalization, folding, and localization: an improved R-hat".
+# Elements are processed a chunk of columns at a time, each chunk a (chains, draws, columns) array,
+# so every statistic is one batched NumPy operation over the chunk.
+
+diagnostics_fn = "diagnostics.csv"
+columns = ["name", "mean", "mcse_mean", "sd", "q5", "q50", "q95", "ess_bulk", "ess_tail", "rhat"]
+
+def element_names(param, shape):
+    """Stan-style 1-based names of a parameter's elements, in row-major order of the flattened dims"""
+    if not shape:
+        return [param]
+    return ["%s[%s]" % (param, ",".join(str(i + 1) for i in idx)) for idx in np.ndindex(*shape)]
+
+# ----- statistics of (chains, draws, columns) arrays ----- #
+def split_chains(x):
+    """the first and second half of each chain as separate chains, dropping the middle draw of odd lengths"""
+    half = x.shape[1] // 2
+    return np.concatenate([x[:, :half], x[:, x.shape[1] - half:]], axis=0)
+
+def rank_normalize(x):
+    """normal scores of each column's ranks over all chains, tied values sharing their average rank"""
+    from scipy.special import ndtri
+    m, n, k = x.shape
+    size = m * n
+    # one row per column, so sorting and indexing run over contiguous memory
+    rows = np.ascontiguousarray(x.reshape(size, k).T)
+    order = np.argsort(rows, axis=1, kind="mergesort")
+    positions = (order + (np.arange(k) * size)[:, None]).ravel()
+    sorted_rows = np.take(rows, positions).reshape(k, size)
+    ranks = np.arange(1., size + 1.)[None, :].repeat(k, axis=0)
+    starts = np.ones((k, size), dtype=bool)
+    starts[:, 1:] = sorted_rows[:, 1:] != sorted_rows[:, :-1]
+    if not starts.all():
+        # first and last sorted position of the run of ties each position belongs to
+        idx = ranks - 1.
+        ends = np.ones((k, size), dtype=bool)
+        ends[:, :-1] = starts[:, 1:]
+        first = np.maximum.accumulate(np.where(starts, idx, 0), axis=1)
+        last = np.minimum.accumulate(np.where(ends, idx, size)[:, ::-1], axis=1)[:, ::-1]
+        ranks = (first + last) / 2. + 1.
+    scores = np.empty(k * size)
+    scores[positions] = ndtri((ranks.ravel() - 0.375) / (size + 0.25))
+    return scores.reshape(k, size).T.reshape(m, n, k)
+
+def rhat(x):
+    """potential scale reduction of each column, treating axis 0 as chains"""
+    n = x.shape[1]
+    between = n * x.mean(axis=1).var(axis=0, ddof=1)
+    within = x.var(axis=1, ddof=1).mean(axis=0)
+    return np.sqrt(((n - 1.) / n * within + between / n) / within)
+
+def ess(x):
+    """
+    Effective sample size of each column. Autocovariances come from one FFT per chunk; the combined
+    autocorrelations are summed in pairs up to the first negative pair, made monotone (Geyer's initial
+    monotone sequence), as Stan does.
+    """
+    m, n, k = x.shape
+    centered = x - x.mean(axis=1)[:, None, :]
+    nfft = 2 ** int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(centered, n=nfft, axis=1)
+    # only the autocovariance averaged over chains is needed, and the inverse transform is linear:
+    # average the power spectra first, and invert once instead of once per chain
+    power = (f.real ** 2 + f.imag ** 2).mean(axis=0)
+    del f
+    mean_acov = np.fft.irfft(power, n=nfft, axis=0)[:n] / n
+    mean_var = mean_acov[0] * n / (n - 1.)
+    var_plus = mean_var * (n - 1.) / n
+    if m > 1:
+        var_plus += x.mean(axis=1).var(axis=0, ddof=1)
+    rho = 1. - (mean_var - mean_acov) / var_plus
+    rho[0] = 1.
+    n_pairs = n // 2
+    pairs = rho[0:2 * n_pairs:2] + rho[1:2 * n_pairs:2]
+    positive = np.logical_and.accumulate(pairs > 0., axis=0)
+    pairs = np.where(positive, np.minimum.accumulate(np.where(positive, pairs, np.inf), axis=0), 0.)
+    tau = np.maximum(-1. + 2. * pairs.sum(axis=0), 1. / np.log10(m * n))
+    # undefined for constant columns
+    return np.where(var_plus > 0., m * n / tau, np.nan)
+
+def chunk_stats(x):
+    """dict of column -> array of statistics for a (chains, draws, columns) array"""
+    x = np.asarray(x, dtype=float)
+    flat = x.reshape(-1, x.shape[2])
+    q5, q50, q95 = np.percentile(flat, [5., 50., 95.], axis=0)
+    if x.shape[1] < 4:
+        # too few draws to split chains, e.g. a MAP estimate: only the location
+        nan = np.full(x.shape[2], np.nan)
+        return {"mean": flat.mean(axis=0), "mcse_mean": nan, "sd": nan, "q5": q5, "q50": q50, "q95": q95,
+                "ess_bulk": nan, "ess_tail": nan, "rhat": nan}
+    split = split_chains(x)
+    sd = flat.std(axis=0, ddof=1)
+    z = rank_normalize(split)
+    folded = rank_normalize(np.abs(split - q50))
+    tail = np.minimum(ess((split <= q5).astype(float)), ess((split <= q95).astype(float)))
+    return {
+        "mean": flat.mean(axis=0),
+        "mcse_mean": sd / np.sqrt(ess(split)),
+        "sd": sd,
+        "q5": q5,
+        "q50": q50,
+        "q95": q95,
+        "ess_bulk": ess(z),
+        "ess_tail": tail,
+        "rhat": np.maximum(rhat(z), rhat(folded)),
+    }
+
+# ----- all parameters ----- #
+def column_chunks(draws, params, chunk_size):
+    """
+    (names, (chains, draws, columns) array) for consecutive chunks of at most `chunk_size` elements,
+    packing the elements of small parameters together so scalars don't each cost a batch
+    """
+    names, blocks, size = [], [], 0
+    for param in params:
+        chains = draws.chains(param)
+        flat = chains.reshape(chains.shape[:2] + (-1,))
+        param_names = element_names(param, chains.shape[2:])
+        i = 0
+        while i < flat.shape[2]:
+            take = min(chunk_size - size, flat.shape[2] - i)
+            names.extend(param_names[i:i + take])
+            blocks.append(flat[:, :, i:i + take])
+            size += take
+            i += take
+            if size == chunk_size:
+                yield names, np.concatenate(blocks, axis=2)
+                names, blocks, size = [], [], 0
+    if names:
+        yield names, np.concatenate(blocks, axis=2)
+
+def summarize(draws, params=None, chunk_size=None):
+    """diagnostics of every element of `params` (default: all), as a dict of column -> list"""
+    params = params if params is not None else sorted(draws.params)
+    chunk_size = chunk_size if chunk_size else conf.diagnostics_chunk_size
+    table = dict((column, []) for column in columns)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for names, block in column_chunks(draws, params, chunk_size):
+            table["name"].extend(names)
+            for column, values in chunk_stats(block).items():
+                table[column].extend(values.tolist())
+    return table
+
+def write_diagnostics(draws, fn, params=None):
+    table = summarize(draws, params)
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in zip(*[table[column] for column in columns]):
+            writer.writerow([row[0]] + ["%.6g" % value for value in row[1:]])
+    os.rename(tmp_fn, fn)
+
+def read_diagnostics(fn):
+    """rows of a diagnostics csv, as dicts with float statistics"""
+    with open(fn, "rb") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return [dict([(header[0], row[0])] + zip(header[1:], map(float, row[1:]))) for row in reader]
+
+def select(rows, sort=None, descending=False, pattern=None, limit=None):
+    """
+    Filter rows to names matching the regular expression `pattern`, sort them by a column, NaNs last,
+    and keep the first `limit`. Returns (rows, number of rows matching).
+    """
+    if pattern:
+        name_re = re.compile(pattern)
+        rows = [row for row in rows if name_re.search(row["name"])]
+    if sort in columns:
+        nans = [row for row in rows if row[sort] != row[sort]]
+        rows = sorted((row for row in rows if row[sort] == row[sort]), key=lambda row: row[sort], reverse=descending) + nans
+    n_matching = len(rows)
+    return (rows[:limit] if limit else rows), n_matching
@@ -0,0 +1,280 @@
+import os
+import re
+import errno
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from .cache import atomic_write
+from . import conf
+
+# persisted draws live in `<output_dir>/draws/`: one `<param>.npy` per parameter, shaped
+# (n_chains, n_draws) + param_dims, plus a manifest describing them
+draws_dirname = "draws"
+manifest_fn = "manifest.json"
+
+def clear_stale_spills(spill_root):
+    """
+    Remove spill directories (`draws_<pid>_*`) left behind by processes that are no longer running,
+    e.g. runs killed before post processing cleared them
+    """
+    for dn in os.listdir(spill_root):
+        m = re.match(r"^draws_(\d+)_", dn)
+        if m is None or int(m.group(1)) == os.getpid():
+            continue
+        try:
+            os.kill(int(m.group(1)), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                print "removing stale spilled draws < %s >" % os.path.join(spill_root, dn)
+                shutil.rmtree(os.path.join(spill_root, dn), ignore_errors=True)
+
+def flatten_chains(chains):
+    """(n_chains, n_draws) + dims -> (n_chains * n_draws,) + dims, without copying contiguous input"""
+    return chains.reshape((-1,) + chains.shape[2:])
+
+def array_digest(arr):
+    """content hash of an array, including its shape and dtype"""
+    h = hashlib.sha1("%s %s" % (arr.shape, arr.dtype))
+    h.update(np.ascontiguousarray(arr))
+    return h.hexdigest()
+
+class DrawsStore(object):
+    """
+    Lazy, memoized access to the posterior draws of a PyStan fit.
+    `store.chains(param)` extracts only that parameter, the first time it is asked for, and keeps it
+    as a contiguous array of shape (n_chains, n_draws) + param_dims, warmup excluded.
+    `store[param]` is a view of the same draws with the chains concatenated: (n_chains * n_draws,) + param_dims.
+    Draw i of one parameter comes from the same iteration as draw i of every other parameter.
+
+    With a `spill_dir`, parameters whose draws take at least `spill_min_bytes` are copied from the fit
+    `spill_chunk_bytes` at a time into a memory-mapped .npy file there, instead of into memory, and
+    `chains(param)` is that file opened read-only; `clear()` removes the files. Spill directories of
+    processes that died without clearing theirs are removed when the next store starts spilling.
+    """
+    def __init__(self, fit, spill_dir=None, spill_min_bytes=None, spill_chunk_bytes=None):
+        self.fit = fit
+        self._draws = {}
+        self._digests = {}
+        self.spill_root = spill_dir
+        self.spill_dir = None
+        self.spill_min_bytes = spill_min_bytes if spill_min_bytes is not None else conf.spill_min_bytes
+        self.spill_chunk_bytes = spill_chunk_bytes if spill_chunk_bytes else conf.spill_chunk_bytes
+
+    def __repr__(self):
+        return "<DrawsStore(params=%d, extracted=%d)>" % (len(self.params), len(self._draws))
+
+    def __getitem__(self, param):
+        return flatten_chains(self.chains(param))
+
+    def __contains__(self, param):
+        return param in self.params
+
+    def chains(self, param):
+        if param not in self._draws:
+            if param not in self.params:
+                raise KeyError(param)
+            if self.spill_root is not None and 8 * np.prod(self.shape(param)) >= self.spill_min_bytes:
+                self._draws[param] = self._spill(param)
+            else:
+                draws = self.fit.extract(pars=[param], permuted=False)[param]
+                # (n_draws, n_chains, ...) -> (n_chains, n_draws, ...)
+                self._draws[param] = np.ascontiguousarray(np.swapaxes(draws, 0, 1))
+        return self._draws[param]
+
+    def shape(self, param):
+        """(n_chains, n_draws) + dims of a parameter's draws, warmup excluded, without extracting them"""
+        sim = self.fit.sim
+        dims = dict(zip(sim["pars_oi"], sim["dims_oi"]))[param]
+        n_draws = min(n - w for n, w in zip(sim["n_save"], sim["warmup2"]))
+        return (len(sim["samples"]), n_draws) + tuple(dims)
+
+    def _spill(self, param):
+        """
+        Copy a parameter's draws into `<spill_dir>/<param>.npy`, a block of draws at a time, and open it
+        memory-mapped. The fit keeps one array per element and chain, in column-major element order, so each
+        block is gathered from those arrays into C order and written out before the next is read.
+        """
+        if self.spill_dir is None:
+            if not os.path.exists(self.spill_root):
+                os.makedirs(self.spill_root)
+            clear_stale_spills(self.spill_root)
+            self.spill_dir = tempfile.mkdtemp(prefix="draws_%d_" % os.getpid(), dir=self.spill_root)
+        sim = self.fit.sim
+        shape = self.shape(param)
+        dims = shape[2:]
+        size = int(np.prod(dims))
+        # the parameter's elements are contiguous in fnames_oi, after those of the parameters before it
+        i = sim["pars_oi"].index(param)
+        offset = sum(int(np.prod(d)) for d in sim["dims_oi"][:i])
+        fnames = sim["fnames_oi"][offset:offset + size]
+        positions = np.ravel_multi_index(np.unravel_index(np.arange(size), dims, order="F"), dims) if dims else [0]
+        fn = os.path.join(self.spill_dir, "%s.npy" % param)
+        out = np.lib.format.open_memmap(fn, mode="w+", dtype=np.float64, shape=shape)
+        flat = out.reshape(shape[:2] + (size,))
+        block_draws = max(1, self.spill_chunk_bytes // (8 * size))
+        for c, holder in enumerate(sim["samples"]):
+            elements = [holder.chains[fname] for fname in fnames]
+            first = len(elements[0]) - shape[1]
+            for start in range(0, shape[1], block_draws):
+                stop = min(start + block_draws, shape[1])
+                block = np.empty((stop - start, size))
+                for position, element in zip(positions, elements):
+                    block[:, position] = element[first + start:first + stop]
+                flat[c, start:stop] = block
+        out.flush()
+        del flat, out
+        return np.load(fn, mmap_mode="r")
+
+    def digest(self, param):
+        """content hash of a parameter's draws"""
+        if param not in self._digests:
+            self._digests[param] = array_digest(self.chains(param))
+        return self._digests[param]
+
+    @property
+    def params(self):
+        """names of all parameters in the fit, including lp__"""
+        return list(self.fit.sim["pars_oi"])
+
+    @property
+    def nbytes(self):
+        """memory held by the draws extracted so far, not counting spilled ones"""
+        return sum(draws.nbytes for draws in self._draws.values() if not isinstance(draws, np.memmap))
+
+    @property
+    def spilled(self):
+        """parameters whose draws are memory-mapped from the spill directory"""
+        return sorted(param for param, draws in self._draws.items() if isinstance(draws, np.memmap))
+
+    def get(self, param, default=None):
+        return self[param] if param in self else default
+
+    def clear(self):
+        self._draws = {}
+        self._digests = {}
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+class ArrayDrawsStore(object):
+    """
+    The DrawsStore interface over draws already in memory, as a dict of param -> (n_chains, n_draws) + dims,
+    e.g. the pseudo-draws of an approximation (see `pkg.approx`)
+    """
+    def __init__(self, draws, fit=None):
+        self._draws = dict((param, np.ascontiguousarray(chains)) for param, chains in draws.items())
+        self._digests = {}
+        self.fit = fit
+
+    def __repr__(self):
+        return "<ArrayDrawsStore(params=%d)>" % len(self._draws)
+
+    def __getitem__(self, param):
+        return flatten_chains(self.chains(param))
+
+    def __contains__(self, param):
+        return param in self._draws
+
+    def chains(self, param):
+        return self._draws[param]
+
+    def digest(self, param):
+        if param not in self._digests:
+            self._digests[param] = array_digest(self.chains(param))
+        return self._digests[param]
+
+    @property
+    def params(self):
+        return list(self._draws)
+
+    def get(self, param, default=None):
+        return self[param] if param in self else default
+
+class MmapDrawsStore(object):
+    """
+    Read-only draws written by `write_draws`, opened memory-mapped: nothing is read until it is touched,
+    and separate processes share the pages instead of each holding a copy.
+    Needs only numpy, so persisted posteriors can be re-plotted or summarized without PyStan.
+    Parameters that weren't written are looked up in `fallback`, if given.
+    """
+    def __init__(self, draws_dir, fallback=None):
+        self.draws_dir = draws_dir
+        self.fallback = fallback
+        with open(os.path.join(draws_dir, manifest_fn), "r") as f:
+            self.manifest = json.load(f)
+        self._draws = {}
+
+    def __repr__(self):
+        return "<MmapDrawsStore(draws_dir=%s)>" % self.draws_dir
+
+    def __getitem__(self, param):
+        if param not in self.manifest["params"] and self.fallback is not None:
+            return self.fallback[param]
+        return flatten_chains(self.chains(param))
+
+    def __contains__(self, param):
+        return param in self.params
+
+    def chains(self, param):
+        if param not in self._draws:
+            if param not in self.manifest["params"]:
+                if self.fallback is not None:
+                    return self.fallback.chains(param)
+                raise KeyError(param)
+            fn = os.path.join(self.draws_dir, self.manifest["params"][param]["file"])
+            self._draws[param] = np.load(fn, mmap_mode="r")
+        return self._draws[param]
+
+    def digest(self, param):
+        """content hash of a parameter's draws, as recorded when they were written"""
+        if param not in self.manifest["params"] and self.fallback is not None:
+            return self.fallback.digest(param)
+        info = self.manifest["params"][param]
+        if "digest" not in info:
+            info["digest"] = array_digest(self.chains(param))
+        return info["digest"]
+
+    @property
+    def params(self):
+        params = list(self.manifest["params"])
+        if self.fallback is not None:
+            params += [param for param in self.fallback.params if param not in self.manifest["params"]]
+        return params
+
+    @property
+    def fit(self):
+        return self.fallback.fit if self.fallback is not None else None
+
+    def get(self, param, default=None):
+        return self[param] if param in self else default
+
+def write_draws(draws, params, draws_dir, **meta):
+    """
+    Save `draws.chains(param)` to `draws_dir/<param>.npy` for each of `params`, then the manifest.
+    Extra keyword arguments are recorded in the manifest.
+    Each file is renamed into place, so readers with the previous one memory-mapped keep their own copy.
+    """
+    if not os.path.exists(draws_dir):
+        os.makedirs(draws_dir)
+    manifest = {"created": time.time(), "params": {}}
+    manifest.update(meta)
+    for param in params:
+        chains = draws.chains(param)
+        fn = "%s.npy" % param
+        atomic_write(os.path.join(draws_dir, fn), lambda f: np.save(f, chains))
+        manifest["params"][param] = {"file": fn, "shape": list(chains.shape), "dtype": str(chains.dtype),
+                                     "digest": draws.digest(param)}
+        manifest["n_chains"], manifest["n_draws"] = chains.shape[:2]
+    # written last, so a reader never sees a manifest naming files that aren't there yet
+    tmp_fn = os.path.join(draws_dir, manifest_fn + ".tmp")
+    with open(tmp_fn, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmp_fn, os.path.join(draws_dir, manifest_fn))
+
+def load_draws(output_dir, fallback=None):
+    """open the draws persisted under an analysis output directory, e.g. `static/<category>/<model_name>`"""
+    return MmapDrawsStore(os.path.join(output_dir, draws_dirname), fallback=fallback)
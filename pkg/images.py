@@ -0,0 +1,105 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+from .cache import file_lock, evict
+from . import conf
+
+# Images flan.py serves in place of the pngs post processing wrote: size-bounded thumbnails for model pages,
+# which load the full images only when clicked, and optionally the images recompressed to a smaller format
+# ("webp" or "jpeg", written with PIL if it's installed) for browsers that accept it.
+# Both are derived on first request and kept in `conf.image_cache_dir` under the content hash of the
+# original, so a run that rewrites a plot simply misses, and the outputs under static/ are never touched.
+
+mimetypes = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+# content hashes of files, with the (size, mtime) they were computed at
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+def content_hash(fn):
+    """sha1 of a file's content, recomputed only when its size or mtime changes"""
+    st = os.stat(fn)
+    stamp = (st.st_size, st.st_mtime)
+    with _hashes_lock:
+        cached = _hashes.get(fn)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(1024 ** 2), b""):
+            h.update(block)
+    with _hashes_lock:
+        _hashes[fn] = (stamp, h.hexdigest())
+    return h.hexdigest()
+
+def compressed_format():
+    """`conf.image_format` if it's set and PIL is installed to write it, else None"""
+    if conf.image_format not in ("webp", "jpeg"):
+        return None
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return conf.image_format
+
+def downsample(img, max_px):
+    """image array shrunk by an integer factor to at most `max_px` on its longer side, averaging blocks of pixels"""
+    k = int(np.ceil(max(img.shape[:2]) / float(max_px)))
+    if k <= 1:
+        return img
+    h, w = img.shape[0] // k * k, img.shape[1] // k * k
+    return img[:h, :w].reshape((h // k, k, w // k, k) + img.shape[2:]).mean(axis=(1, 3))
+
+def save(img, fn, fmt):
+    """write an image array of floats in [0, 1] as png (with matplotlib) or webp / jpeg (with PIL)"""
+    if fmt == "png":
+        import matplotlib.image
+        matplotlib.image.imsave(fn, img, format="png")
+        return
+    from PIL import Image
+    pixels = np.round(np.clip(img, 0., 1.) * 255).astype(np.uint8)
+    image = Image.fromarray(pixels)
+    if fmt == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(fn, format=fmt.upper(), quality=conf.image_quality)
+
+class ImageCache(object):
+    """
+    Thumbnails and recompressed copies of png outputs, each stored once in `cache_dir` as
+    `<content hash>-<variant>.<format>`. Once the directory holds more than `max_bytes`, the least recently
+    served are evicted. Concurrent requests for the same image make it once, as in `pkg.render.RenderCache`.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir if cache_dir else conf.image_cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else conf.image_cache_max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def __repr__(self):
+        return "<ImageCache(cache_dir=%s)>" % self.cache_dir
+
+    def thumbnail(self, fn, fmt="png", max_px=None):
+        """path of a thumbnail of the png `fn`, at most `max_px` (default `conf.thumbnail_max_px`) on its longer side"""
+        max_px = max_px if max_px else conf.thumbnail_max_px
+        return self._get(fn, "t%d" % max_px, fmt, lambda img: downsample(img, max_px))
+
+    def compressed(self, fn, fmt):
+        """path of the png `fn` at full size in format `fmt`"""
+        return self._get(fn, "full", fmt, lambda img: img)
+
+    def _get(self, fn, variant, fmt, transform):
+        key = "%s-%s" % (content_hash(fn), variant)
+        path = os.path.join(self.cache_dir, "%s.%s" % (key, fmt))
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            if os.path.exists(path):
+                os.utime(path, None)
+            else:
+                import matplotlib.image
+                tmp_fn = path + ".tmp"
+                save(transform(matplotlib.image.imread(fn)), tmp_fn, fmt)
+                os.rename(tmp_fn, path)
+        for suffix in set([".png", "." + fmt]):
+            evict(self.cache_dir, suffix, max_bytes=self.max_bytes, keep=(key,))
+        return path
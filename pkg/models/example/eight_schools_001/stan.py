@@ -28,9 +28,11 @@ class NewSpec(ModelSpec):
         self.data = data
 
 
-def main():
+def build_analysis():
     model_spec = NewSpec(category, model_name)
     # adjust inference settings as needed
     sampling_args = {}
-    analysis = StanAnalysis(model_spec, sampling_args=sampling_args)
-    analysis.run()
\ No newline at end of file
+    return StanAnalysis(model_spec, sampling_args=sampling_args)
+
+def main():
+    build_analysis().run()
\ No newline at end of file
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+# Stan data construction for hkjc/v001, kept free of DB access so it can run on any results frame.
+# `df` is indexed by (field size, race id, ...) and has columns horse_id, horse_race_num and rank,
+# with each race's rows in finishing-post order.
+
+def race_matrices(r, field_size):
+    """
+    Reshape one field size's results into fixed-width per-race arrays, races in sorted race id order:
+    (horse_index, nth_race, winner), the first two shaped (N_races, field_size).
+    Equivalent to filling the rows one `groupby` group at a time, without the Python loop.
+    """
+    codes, races = pd.factorize(r.index.get_level_values(0), sort=True)
+    n_races = len(races)
+    counts = np.bincount(codes, minlength=n_races)
+    if not (counts == field_size).all():
+        raise ValueError("races with %d runners expected, found sizes %s" % (field_size, sorted(set(counts))))
+    # stable, so each race keeps its rows in their original order, as groupby does
+    order = np.argsort(codes, kind="mergesort")
+
+    def matrix(col):
+        return r[col].values[order].reshape(n_races, field_size)
+
+    horse_index = matrix("horse_stan_idx").astype(int)
+    nth_race = matrix("horse_race_num").astype(int)
+    winner = np.argmin(matrix("rank"), axis=1) + 1
+    return horse_index, nth_race, winner
+
+def build_stan_data(df):
+    """
+    - Map the horse ids to 1-based integer keys
+    - Build the per-race matrices for 12- and 14-horse races
+    """
+    data = {}
+    codes, horses = pd.factorize(df["horse_id"], sort=True)
+    df = df.assign(horse_stan_idx=codes + 1)
+    N_horses = len(horses)
+
+    for field_size in [12, 14]:
+        horse_index, nth_race, winner = race_matrices(df.loc[field_size], field_size)
+        assert np.min(horse_index) > 0
+        assert np.min(nth_race) > 0
+        data["N_%d_races" % field_size] = horse_index.shape[0]
+        data["horse_index_%d" % field_size] = horse_index
+        data["nth_race_%d" % field_size] = nth_race
+        data["winner_%d" % field_size] = winner
+
+    data["N_horses"] = N_horses
+    return data
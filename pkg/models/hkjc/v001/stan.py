@@ -1,10 +1,10 @@
 import os
+import inspect
+import hashlib
+import datetime
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from hkjc.sqa import *
 from pkg.analysis import ModelSpec, StanAnalysis
+from .data import build_stan_data
 
 # get category and model_name from the file's path
 category, model_name = os.path.dirname(os.path.realpath(__file__)).split("/")[-2:]
@@ -17,66 +17,48 @@ class NewSpec(ModelSpec):
     def __init__(self, category, model_name, 
                  single_params=[],
                  param_pairs=[], 
-                 param_groups={}):
+                 param_groups={},
+                 # every `parameters` block variable, so warm starts seed them all; the transformed parameters are dropped
+                 retain_params=["skills", "beta_age_curve", "perf_12", "perf_14", "perf_sigma"],
+                 start_date="20130101",
+                 data_version=None):
+        # races after `start_date`, as of `data_version`
+        self.start_date = start_date
+        self.data_version = data_version if data_version else datetime.date.today().strftime("%Y%m%d")
         super(NewSpec, self).__init__(category, model_name,
                                       single_params=single_params,
                                       param_pairs=param_pairs,
-                                      param_groups=param_groups)
+                                      param_groups=param_groups,
+                                      retain_params=retain_params)
 
     def build_data(self):
         """
         - Select a subset of races
-        - Map the horse ids to 1-based integer keys
-        - 
+        - Build the Stan data with `data.build_stan_data`
+        The results DB is only opened here, so a data cache hit doesn't need it.
         """
-        data = {}
-        sd = "20130101"
-        df = results_df(Result.id > sd)
-        horses = sorted(list(df["horse_id"].unique()))
-        horses_idx = dict(zip(horses, range(1, len(horses) + 1)))
-        N_horses = len(horses_idx)
-        df["horse_stan_idx"] = df["horse_id"].map(lambda v: horses_idx[v])
-        r_12 = df.loc[12]
-        r_14 = df.loc[14]
+        from hkjc.sqa import Result, results_df
+        df = results_df(Result.id > self.start_date)
+        self.data = build_stan_data(df)
+        # `skills` is indexed by horse id, sorted, as `build_stan_data` numbers the horses
+        self.labels = {"skills": np.sort(df["horse_id"].unique())}
 
-        # number of races
-        N_12_races = len(r_12.index.get_level_values(0).unique())
-        N_14_races = len(r_14.index.get_level_values(0).unique())
-
-        # horse indexes
-        horse_index_12 = np.zeros((N_12_races, 12), dtype=int)
-        horse_index_14 = np.zeros((N_14_races, 14), dtype=int)
-        for i, (name, group) in enumerate(r_12.groupby(r_12.index.get_level_values(0))):
-            horse_index_12[i, :] = group["horse_stan_idx"].values
-        for i, (name, group) in enumerate(r_14.groupby(r_14.index.get_level_values(0))):
-            horse_index_14[i, :] = group["horse_stan_idx"].values
-        assert np.min(np.min(horse_index_12)) > 0
-        assert np.min(np.min(horse_index_14)) > 0
-
-        # horse race numbers for age adj factor
-        nth_race_12 = np.zeros((N_12_races, 12), dtype=int)
-        nth_race_14 = np.zeros((N_14_races, 14), dtype=int)
-        for i, (name, group) in enumerate(r_12.groupby(r_12.index.get_level_values(0))):
-            nth_race_12[i, :] = group["horse_race_num"].values
-        for i, (name, group) in enumerate(r_14.groupby(r_14.index.get_level_values(0))):
-            nth_race_14[i, :] = group["horse_race_num"].values
-        assert np.min(np.min(nth_race_12)) > 0
-        assert np.min(np.min(nth_race_14)) > 0
-
-        # race winners
-        winner_12 = r_12.groupby(r_12.index.get_level_values(0)).apply(lambda g: np.argmin(g["rank"].values) + 1).values
-        winner_14 = r_14.groupby(r_14.index.get_level_values(0)).apply(lambda g: np.argmin(g["rank"].values) + 1).values
+    def data_fingerprint(self):
+        """
+        The results DB only grows with new race days, so the cutoff plus a data version (by default,
+        today's date) identifies the query result. Changes to `data.py` also start a new entry.
+        """
+        return {
+            "start_date": self.start_date,
+            "data_version": self.data_version,
+            "data.py": hashlib.sha1(inspect.getsource(inspect.getmodule(build_stan_data))).hexdigest(),
+        }
 
-        data["N_horses"] = N_horses
-        data["N_12_races"] = N_12_races
-        data["N_14_races"] = N_14_races
-        data["horse_index_12"] = horse_index_12
-        data["horse_index_14"] = horse_index_14
-        data["nth_race_12"] = nth_race_12
-        data["nth_race_14"] = nth_race_14
-        data["winner_12"] = winner_12
-        data["winner_14"] = winner_14
-        self.data = data
+    def warm_start_prior(self, param, size):
+        """horses new since the last fit start from the skills prior"""
+        if param == "skills":
+            return np.random.normal(25, 8.3, size)
+        return None
 
     def set_dimensions(self):
         # reporting
@@ -89,24 +71,30 @@ class NewSpec(ModelSpec):
 
     def add_supplemental_plotters(self):
         """
-        Create list of functions with arg signature: (fit, output_dir) for custom plots
+        Create list of functions with arg signature: (draws, output_dir) for custom plots,
+        each returning the files it wrote
         """
-        def plot_age_curve_params(fit, output_dir):
-            df = pd.DateFrame(fit.extract(permuted=True)["beta_age_curve"], 
+        def plot_age_curve_params(draws, output_dir):
+            import pandas as pd
+            import seaborn as sns
+            df = pd.DataFrame(draws["beta_age_curve"], 
                               columns=["Race_Num_Adj_%d" % i for i in range(3)])
             fig = sns.pairplot(df, vars=list(df.columns), 
                                diag_kind="kde", plot_kws={"alpha": 0.1})
             fn = os.path.join(output_dir, "age_curve_args.png")
             print "writing < %s >" % fn
             fig.savefig(fn, bbox_inches="tight")
+            return [fn]
 
         self.supplemental_plot_funcs.append(plot_age_curve_params)
 
 
-def main():
+def build_analysis():
     model_spec = NewSpec(category, model_name)
     # adjust inference settings as needed
     sampling_args = {}
-    analysis = StanAnalysis(model_spec, sampling_args=sampling_args)
-    analysis.run()
+    return StanAnalysis(model_spec, sampling_args=sampling_args)
+
+def main():
+    build_analysis().run()
 
@@ -0,0 +1,93 @@
+import os
+import json
+import inspect
+import hashlib
+
+from . import dag
+
+outputs_fn = "outputs.json"
+
+def _source_digest(obj):
+    """hash of a module's or function's source, so changes to plotting code invalidate its outputs"""
+    try:
+        source = inspect.getsource(obj)
+    except (IOError, TypeError):
+        code = getattr(obj, "__code__", None)
+        source = repr((code.co_code, code.co_consts)) if code else repr(obj)
+    return hashlib.sha1(source).hexdigest()
+
+def inputs_hash(job, draws, model_spec):
+    """
+    Hash of everything a plot job's output depends on:
+     - the job's kind and arguments, i.e. its entry in the spec's plotting lists
+     - the draws of the parameters it plots (all parameters, for supplemental plotters)
+     - the code that draws it, and the plot settings in `conf`
+    """
+    from . import plots
+    kind = job[0]
+    h = hashlib.sha1(repr(job))
+    if kind == "single":
+        params = [job[1]]
+    elif kind == "pair":
+        params = list(job[1])
+    elif kind == "group":
+        params = list(job[2])
+    elif kind == "graphviz":
+        params = []
+        h.update(model_spec.model_code)
+        h.update(_source_digest(dag))
+    else:
+        params = sorted(draws.params)
+        h.update(_source_digest(model_spec.supplemental_plot_funcs[job[1]]))
+    if kind in ("single", "pair", "group"):
+        h.update(_source_digest(plots))
+        h.update(repr(plots.settings()))
+    for param in params:
+        h.update(draws.digest(param) if param in draws else "missing %s" % param)
+    return h.hexdigest()
+
+class OutputManifest(object):
+    """
+    Record of the files post processing wrote to an output directory, stored in `outputs.json`.
+    Each entry is keyed by a job label and holds the hash of that job's inputs and the files it wrote,
+    so an incremental run redraws only the plots whose inputs changed, and removes the files of plots
+    that are no longer asked for.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.fn = os.path.join(output_dir, outputs_fn)
+        self.entries = {}
+        if os.path.exists(self.fn):
+            with open(self.fn, "r") as f:
+                self.entries = json.load(f)
+
+    def __repr__(self):
+        return "<OutputManifest(output_dir=%s, entries=%d)>" % (self.output_dir, len(self.entries))
+
+    def is_current(self, label, inputs):
+        """True if `label` was last drawn from the same inputs and its files are still there"""
+        entry = self.entries.get(label)
+        if entry is None or entry["inputs"] != inputs:
+            return False
+        return all(os.path.exists(os.path.join(self.output_dir, fn)) for fn in entry["files"])
+
+    def record(self, label, inputs, files):
+        self.entries[label] = {"inputs": inputs, "files": list(files)}
+
+    def prune(self, labels):
+        """drop entries not in `labels`, deleting their files; returns the deleted filenames"""
+        keep = set(fn for label in labels if label in self.entries for fn in self.entries[label]["files"])
+        removed = []
+        for label in [label for label in self.entries if label not in labels]:
+            for fn in self.entries.pop(label)["files"]:
+                path = os.path.join(self.output_dir, fn)
+                if fn not in keep and os.path.exists(path):
+                    os.remove(path)
+                    removed.append(fn)
+        return removed
+
+    def save(self):
+        tmp_fn = self.fn + ".tmp"
+        with open(tmp_fn, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.rename(tmp_fn, self.fn)
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import cProfile
+import traceback
+import multiprocessing
+
+from .draws import MmapDrawsStore, write_draws
+from .profiling import measure, dump_stats
+from . import conf
+
+# Plot jobs are small tuples: (kind, args...). Everything else a worker needs is put in `_state`
+# before the pool forks, so workers inherit it instead of receiving a pickled fit.
+_state = {}
+
+def plot_jobs(model_spec, graphviz=True):
+    """list the plot jobs for a ModelSpec, in the order post processing has always drawn them"""
+    jobs = [("single", param) for param in model_spec.single_params]
+    jobs += [("pair", tuple(pair)) for pair in model_spec.param_pairs]
+    jobs += [("group", name, params) for name, params in model_spec.param_groups.items()]
+    if graphviz:
+        jobs.append(("graphviz",))
+    jobs += [("supplemental", i, getattr(f, "__name__", str(i))) for i, f in enumerate(model_spec.supplemental_plot_funcs)]
+    return jobs
+
+def job_params(jobs):
+    """parameters whose draws the standard plot jobs read"""
+    params = []
+    for job in jobs:
+        if job[0] == "single":
+            params.append(job[1])
+        elif job[0] == "pair":
+            params.extend(job[1])
+        elif job[0] == "group":
+            params.extend(job[2])
+    return sorted(set(params))
+
+def job_label(job):
+    kind = job[0]
+    if kind == "pair":
+        return "pair %s-%s" % job[1]
+    elif kind == "supplemental":
+        return "supplemental %s" % job[2]
+    return " ".join([kind] + [str(arg) for arg in job[1:2]])
+
+def job_files(job):
+    """files a standard plot job writes; None for supplemental plotters, which return the names of their own"""
+    from . import plots
+    kind = job[0]
+    if kind == "single":
+        return ["%s_trace.png" % job[1]]
+    elif kind == "pair":
+        return ["%s-%s.png" % job[1]]
+    elif kind == "group":
+        fns = plots.group_plot_files(job[1], job[2])
+        # ("group", name, params, page) is one page of a group tiled over several
+        return fns if len(job) == 3 else [fns[job[3] - 1]]
+    elif kind == "graphviz":
+        return ["graphviz.png"]
+    return None
+
+def run_job(job):
+    """
+    Draw one plot. Returns (job, error, span, files), where error is a formatted traceback or None,
+    span is its timing (see `pkg.profiling.measure`) and files are the names of the files it wrote to
+    the output directory. Jobs whose label is in `_state["cprofile"]` run under cProfile.
+    """
+    model_spec, draws, output_dir = _state["model_spec"], _state["draws"], _state["output_dir"]
+    label = job_label(job)
+    profiler = cProfile.Profile() if label in _state.get("cprofile", ()) else None
+    with measure(label, profiler) as span:
+        error, files = _draw(job, model_spec, draws, output_dir)
+    if profiler:
+        span["cprofile"] = dump_stats(profiler, output_dir, label)
+    if files is None:
+        files = job_files(job)
+    return job, error, span, files
+
+def _draw(job, model_spec, draws, output_dir):
+    """
+    draw a plot job, returning (the traceback if it fails, else None, and the files a supplemental plotter
+    says it wrote, relative to `output_dir`)
+    """
+    from . import plots
+    kind = job[0]
+    files = None
+    try:
+        if kind == "single":
+            plots.single_param_plot(draws, job[1], output_dir)
+        elif kind == "pair":
+            plots.param_pair_plot(draws, job[1], output_dir)
+        elif kind == "group":
+            plots.param_group_plot(draws, job[1], job[2], output_dir)
+        elif kind == "graphviz":
+            plots.graphviz_plot(model_spec.model_code, model_spec.model_name, output_dir)
+        elif kind == "supplemental":
+            written = model_spec.supplemental_plot_funcs[job[1]](draws, output_dir)
+            if written is None:
+                print "warning: < %s > returned no file names, so incremental runs won't track its files" % job_label(job)
+            files = sorted(os.path.relpath(os.path.join(output_dir, fn), output_dir) for fn in written or [])
+        else:
+            raise ValueError("unknown plot job kind: %s" % kind)
+    except Exception:
+        return traceback.format_exc(), []
+    return None, files
+
+def _init_worker():
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
+    _state["draws"] = MmapDrawsStore(_state["draws_dir"], fallback=_state["fallback"])
+
+def run_plot_jobs(jobs, draws, model_spec, output_dir, n_workers=1, draws_dir=None, cprofile=()):
+    """
+    Run plot jobs, serially or across a pool of `n_workers` processes.
+    Workers open memory-mapped draws from `draws_dir`, as written by `write_draws`. Without one, the draws
+    the standard plots read are first written to a scratch directory (in shared memory where available).
+    Supplemental plotters that read other parameters fall back to the draws store inherited from this process.
+    A failing plot doesn't stop the batch. Returns a dict of job label -> {"error", "seconds", "files", "span"},
+    where "error" is the traceback of a failed plot, else None, and "span" its timing and memory.
+    Jobs whose labels are in `cprofile` run under cProfile, with stats written to the output directory.
+    """
+    # loaded here rather than by each job, so forked workers inherit the plotting libraries
+    from . import plots
+    _state.update({"model_spec": model_spec, "output_dir": output_dir, "cprofile": set(cprofile)})
+    if n_workers <= 1:
+        _state["draws"] = draws
+        return _collect(run_job(job) for job in jobs)
+
+    scratch_dir = None
+    if draws_dir is None:
+        draws_dir = scratch_dir = tempfile.mkdtemp(prefix="flan-draws-", dir=conf.scratch_dir)
+    try:
+        if scratch_dir:
+            write_draws(draws, [param for param in job_params(jobs) if param in draws], scratch_dir)
+        _state.update({"draws_dir": draws_dir, "fallback": draws})
+        pool = multiprocessing.Pool(n_workers, initializer=_init_worker)
+        try:
+            results = _collect(pool.imap_unordered(run_job, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return results
+
+def _collect(results):
+    collected = {}
+    for job, error, span, files in results:
+        label = job_label(job)
+        if error:
+            print "FAILED < %s > after %.1fs" % (label, span["wall"])
+            print error
+        collected[label] = {"error": error, "seconds": span["wall"], "files": files, "span": span}
+    return collected
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+import seaborn as sns
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from .dag import parse_stan
+from .density import binned_kde, freedman_diaconis_bins, lttb, pair_histograms, strided_sample
+from . import conf
+
+# Standard parameter plots. Each takes a mapping of parameter name -> draws (e.g. a `DrawsStore`)
+# and writes a png to `output_dir`, or shows the figure if `output_dir` is None.
+
+def single_param_plot(draws, param, output_dir=None):
+    """
+    KDE + trace
+    The density is a binned FFT KDE and each chain's trace is drawn separately, downsampled to at most
+    `conf.trace_max_points` points by largest-triangle-three-buckets, so the cost hardly grows with the draws.
+    """
+    print param
+    chains = _chains(draws, param)
+    x = chains.ravel()
+    fig, axs = plt.subplots(2, 1, figsize=(12, 8))
+    # same look as sns.distplot: normalized stepfilled histogram with Freedman-Diaconis bins, plus the KDE
+    heights, edges = np.histogram(x, bins=max(freedman_diaconis_bins(x), 1), density=True)
+    axs[0].hist(edges[:-1], bins=edges, weights=heights, histtype="stepfilled", color="slategray", alpha=0.4)
+    kde = binned_kde(x)
+    if kde is not None:
+        axs[0].plot(kde[0], kde[1], lw=2.5)
+    x_min, x_max = axs[0].get_xlim()
+    if x_min < 0. < x_max:
+        axs[0].axvline(0., color="k", lw=1., alpha=0.6)
+    for i, chain in enumerate(chains):
+        idx = lttb(chain, conf.trace_max_points)
+        axs[1].plot(idx, chain[idx], lw=1., alpha=0.8, label="chain %d" % (i + 1))
+    if len(chains) > 1:
+        axs[1].legend(loc="upper right", fontsize="small", ncol=len(chains))
+    axs[1].set_xlim(0, chains.shape[1] - 1)
+    fig.suptitle(param)
+    save_or_show(fig, output_dir, "%s_trace.png" % param)
+
+def _chains(draws, param):
+    """a scalar parameter's draws as (n_chains, n_draws); one chain if the mapping doesn't keep them"""
+    chains = np.asarray(draws.chains(param) if hasattr(draws, "chains") else [draws[param]], dtype=float)
+    if chains.ndim != 2:
+        raise ValueError("%s isn't a scalar parameter" % param)
+    return chains
+
+def param_pair_plot(draws, pair, output_dir=None):
+    """
+    2d KDE to examine correlation
+    """
+    x = draws[pair[0]]
+    y = draws[pair[1]]
+    df = pd.DataFrame({pair[0]: x, pair[1]: y})
+    sns.jointplot(pair[0], pair[1], data=df, kind="kde", size=10, space=0)
+    fig = plt.gcf()
+    save_or_show(fig, output_dir, "%s-%s.png" % tuple(pair))
+
+def param_group_plot(draws, name, params, output_dir=None, page=None):
+    """
+    Many parameter correlation plots at once, in less detail
+    In the default "binned" mode (`conf.group_plot_mode`), the 2D histograms of every pair on a page come
+    from one vectorized pass over the draws, overlaid with a fixed, evenly spaced subsample of draws, so the
+    cost is linear in the draws and wide groups stay legible. Groups wider than `conf.group_plot_page_size`
+    are tiled over several pages, `<name>_p<N>_pairplot.png`; `page` draws only page N.
+    """
+    if conf.group_plot_mode == "pairplot":
+        df = pd.DataFrame({param: draws[param] for param in params}, columns=params)
+        fig = sns.pairplot(df, vars=list(df.columns), diag_kind="kde", plot_kws={"alpha": 0.1})
+        save_or_show(fig, output_dir, "%s_pairplot.png" % name)
+        return
+    pages = group_pages(params)
+    fns = group_plot_files(name, params)
+    for i, (rows, cols) in enumerate(pages):
+        if page is None or page == i + 1:
+            fig = _group_page(draws, rows, cols)
+            fig.suptitle(name if len(pages) == 1 else "%s (%d of %d)" % (name, i + 1, len(pages)))
+            save_or_show(fig, output_dir, fns[i])
+
+def settings():
+    """the `conf` values the standard plots depend on, for hashing along with this module's source"""
+    return (conf.trace_max_points, conf.group_plot_mode, conf.group_plot_bins,
+            conf.group_plot_scatter_draws, conf.group_plot_page_size)
+
+def group_pages(params):
+    """
+    (row params, column params) of each page of a group plot: the lower triangle of the group's grid
+    of pairs, cut into blocks of at most `conf.group_plot_page_size` parameters a side
+    """
+    size = conf.group_plot_page_size
+    blocks = [list(params[i:i + size]) for i in range(0, len(params), size)]
+    return [(blocks[i], blocks[j]) for i in range(len(blocks)) for j in range(i + 1)]
+
+def group_plot_files(name, params):
+    if conf.group_plot_mode == "pairplot" or len(group_pages(params)) == 1:
+        return ["%s_pairplot.png" % name]
+    return ["%s_p%d_pairplot.png" % (name, i + 1) for i in range(len(group_pages(params)))]
+
+def _group_page(draws, rows, cols):
+    """
+    One page of a binned group plot, drawn as a single mosaic image on one set of axes (rather than one set
+    of axes per pair) so its cost doesn't grow with the number of panels: each panel is a 2D histogram scaled
+    to its own maximum, with the subsampled draws scattered over it in one call. A diagonal page (rows == cols)
+    is a corner plot, with each parameter's KDE on the diagonal. Labels give each parameter's range.
+    """
+    diagonal = rows == cols
+    params = rows + [param for param in cols if param not in rows]
+    col_of = dict((param, i) for i, param in enumerate(params))
+    x = np.column_stack([np.asarray(draws[param], dtype=float) for param in params])
+    lo, hi = x.min(axis=0), x.max(axis=0)
+    hi = np.where(hi > lo, hi, lo + 1.)
+    bins = conf.group_plot_bins
+    step = bins + max(bins // 8, 1)   # panel plus gap, in pixels
+    panels = [(r, c) for r in range(len(rows)) for c in range(len(cols)) if not diagonal or c < r]
+    pairs = [(col_of[rows[r]], col_of[cols[c]]) for r, c in panels]
+
+    def to_px(values, j, offset):
+        # position within a panel, in image pixels
+        return offset + (values - lo[j]) / (hi[j] - lo[j]) * bins - 0.5
+
+    image = np.zeros((len(rows) * step, len(cols) * step))
+    sample = x[strided_sample(len(x), conf.group_plot_scatter_draws)]
+    points = []
+    if panels:
+        counts = pair_histograms(x, pairs, bins, lo, hi)
+        scale = counts.reshape(len(panels), -1).max(axis=1)
+        for p, (r, c) in enumerate(panels):
+            # row 0 of the image is the top, so flip each panel's y axis
+            image[r * step:r * step + bins, c * step:c * step + bins] = np.sqrt(counts[p] / scale[p])[::-1]
+            i, j = pairs[p]
+            points.append(np.column_stack([to_px(sample[:, j], j, c * step),
+                                           r * step + bins - 1 - to_px(sample[:, i], i, 0)]))
+    curves = []
+    if diagonal:
+        for r, param in enumerate(rows):
+            kde = binned_kde(x[:, r])
+            if kde is not None:
+                curves.append(np.column_stack([to_px(kde[0], r, r * step),
+                                               r * step + bins - 0.5 - 0.9 * bins * kde[1] / kde[1].max()]))
+
+    fig, ax = plt.subplots(figsize=(1.2 * len(cols) + 2, 1.2 * len(rows) + 1.5))
+    ax.imshow(np.ma.masked_equal(image, 0), cmap="Blues", interpolation="nearest", aspect="equal", vmin=0., vmax=1.)
+    if points:
+        points = np.concatenate(points)
+        ax.scatter(points[:, 0], points[:, 1], s=1.5, color="k", alpha=0.3, linewidths=0)
+    if curves:
+        ax.add_collection(LineCollection(curves, linewidths=1.5))
+    frames = [(r, c) for r in range(len(rows)) for c in range(len(cols)) if not diagonal or c <= r]
+    ax.add_collection(LineCollection([[(c * step - 0.5, r * step - 0.5), (c * step + bins - 0.5, r * step - 0.5),
+                                       (c * step + bins - 0.5, r * step + bins - 0.5), (c * step - 0.5, r * step + bins - 0.5),
+                                       (c * step - 0.5, r * step - 0.5)] for r, c in frames],
+                                     colors="lightgray", linewidths=0.5))
+    ax.set_xlim(-0.5, len(cols) * step - 0.5)
+    ax.set_ylim(len(rows) * step - 0.5, -0.5)
+
+    def label(param):
+        j = col_of[param]
+        return "%s\n[%.3g, %.3g]" % (param, lo[j], hi[j])
+
+    ax.set_xticks([c * step + bins / 2. for c in range(len(cols))])
+    ax.set_xticklabels([label(param) for param in cols], rotation=90, fontsize=8)
+    ax.set_yticks([r * step + bins / 2. for r in range(len(rows))])
+    ax.set_yticklabels([label(param) for param in rows], fontsize=8)
+    ax.tick_params(length=0)
+    for side in ax.spines.values():
+        side.set_visible(False)
+    return fig
+
+def graphviz_plot(model_code, model_name, output_dir):
+    dag = parse_stan(model_code, model_name)
+    fn = os.path.join(output_dir, "graphviz.png")
+    print "writing < %s >" % fn
+    dag.write_png(fn)
+
+def save_or_show(fig, output_dir, fn):
+    if output_dir:
+        fn = os.path.join(output_dir, fn)
+        print "writing < %s >" % fn
+        fig.savefig(fn, bbox_inches="tight")
+        # figures are not garbage collected while pyplot tracks them
+        plt.close(getattr(fig, "fig", fig))
+    else:
+        plt.show()
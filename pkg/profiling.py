@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import resource
+import functools
+from contextlib import contextmanager
+
+from . import conf
+
+# Timing spans over the stages of a run: ModelSpec's data loading, compiling, sampling, extracting and
+# writing the draws, each plot job and the diagnostics. Each span records wall and CPU time (including
+# finished child processes, e.g. sampling chains), peak RSS and the bytes of draws it touched.
+# They are written to `profile.json` next to the outputs, for flan.py's model page.
+# Peak RSS is per span: on Linux the process's high-water mark is restarted (/proc/self/clear_refs) whenever a
+# span starts or ends, and each reading is credited to every span open at the time. Elsewhere it falls back
+# to the process's peak so far. A finished child's peak (e.g. a sampling chain's) counts for a span only if
+# it's a new high for the children, as the kernel keeps no other record of it.
+
+profile_fn = "profile.json"
+
+# spans being measured in this process, innermost last
+_open_spans = []
+
+def peak_rss_kb():
+    """high-water mark of this process's resident set since it was last restarted, or over its lifetime"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def children_peak_rss_kb():
+    """largest resident set of any finished child process, so far"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def _checkpoint():
+    """credit the peak since the last checkpoint to the open spans, and restart the high-water mark"""
+    peak = peak_rss_kb()
+    for record in _open_spans:
+        record["_peak_kb"] = max(record["_peak_kb"], peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+def cpu_seconds():
+    """user + system time of this process and its finished children"""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def cprofile_fn(name):
+    """file a span's cProfile stats are dumped to; the `.txt` sibling has the top functions"""
+    return "cprofile_%s.prof" % re.sub("[^\w\-]+", "_", name).strip("_")
+
+@contextmanager
+def measure(name, profiler=None):
+    """
+    Time the `with` block, yielding the span it fills in: "name", "start", "wall", "cpu", "peak_rss_mb".
+    With a `cProfile.Profile`, the block also runs under it.
+    """
+    record = {"name": name, "start": time.time()}
+    cpu = cpu_seconds()
+    children_peak = children_peak_rss_kb()
+    _checkpoint()
+    record["_peak_kb"] = peak_rss_kb()
+    _open_spans.append(record)
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+        record["wall"] = time.time() - record["start"]
+        record["cpu"] = cpu_seconds() - cpu
+        _checkpoint()
+        _open_spans.remove(record)
+        peak = record.pop("_peak_kb")
+        if children_peak_rss_kb() > children_peak:
+            peak = max(peak, children_peak_rss_kb())
+        record["peak_rss_mb"] = peak / 1024.
+
+def dump_stats(profiler, output_dir, name):
+    fn = cprofile_fn(name)
+    profiler.dump_stats(os.path.join(output_dir, fn))
+    with open(os.path.join(output_dir, fn.replace(".prof", ".txt")), "w") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(conf.cprofile_top_functions)
+    return fn
+
+def draws_nbytes(draws, params=None):
+    """bytes of the draws of `params` (default: all), from their shapes, without reading memory-mapped ones"""
+    params = params if params is not None else draws.params
+    return sum(draws.chains(param).nbytes for param in params if param in draws)
+
+def spanned(name, nbytes=None):
+    """
+    Decorate a method of an object with a `profile` to time each call as a span.
+    `nbytes`, if given, is called with the object after the call for the bytes of draws it touched.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            with self.profile.span(name, nbytes=(lambda: nbytes(self)) if nbytes else None):
+                return method(self, *args, **kw)
+        return wrapper
+    return decorate
+
+class Profile(object):
+    """
+    The spans of one run, in the order they started. `span(name)` times a `with` block; spans started
+    inside it are its children. Spans named in `cprofile` also run under cProfile; their stats are
+    written next to the profile by `save` (see `cprofile_fn`).
+    """
+    def __init__(self, cprofile=None):
+        self.created = time.time()
+        self.spans = []
+        self.depth = 0
+        self.cprofile = set(cprofile if cprofile is not None else conf.cprofile_stages)
+        self.profilers = {}
+
+    def __repr__(self):
+        return "<Profile(spans=%d)>" % len(self.spans)
+
+    @contextmanager
+    def span(self, name, nbytes=None):
+        """
+        Time a stage. `nbytes` is the size of the draws it touched, or a function returning it,
+        called once the stage is done (e.g. for draws it extracts).
+        """
+        profiler = None
+        if name in self.cprofile:
+            profiler = self.profilers[name] = cProfile.Profile()
+        with measure(name, profiler) as record:
+            record["depth"] = self.depth
+            self.spans.append(record)
+            self.depth += 1
+            try:
+                yield record
+            finally:
+                self.depth -= 1
+                record["nbytes"] = nbytes() if callable(nbytes) else nbytes
+
+    def add(self, record, nbytes=None):
+        """a span measured elsewhere, e.g. a plot job in a worker process, as a child of the current span"""
+        record = dict(record, depth=self.depth, nbytes=nbytes)
+        self.spans.append(record)
+
+    def save(self, output_dir):
+        """write the spans to `output_dir`; spans still open, like the one saving, get their wall time so far"""
+        now = time.time()
+        spans = []
+        for span in self.spans:
+            if span["name"] in self.profilers and "wall" in span:
+                span["cprofile"] = dump_stats(self.profilers.pop(span["name"]), output_dir, span["name"])
+            if "wall" not in span:
+                # its peak so far: since its last checkpoint, and before
+                peak = max(span.get("_peak_kb", 0), peak_rss_kb())
+                span = dict(span, wall=now - span["start"], cpu=None, peak_rss_mb=peak / 1024., nbytes=None)
+                span.pop("_peak_kb", None)
+            spans.append(dict(span, start=span["start"] - self.created))
+        profile = {"created": self.created, "saved": time.time(), "spans": spans}
+        tmp_fn = os.path.join(output_dir, profile_fn + ".tmp")
+        with open(tmp_fn, "w") as f:
+            json.dump(profile, f, indent=2)
+        os.rename(tmp_fn, os.path.join(output_dir, profile_fn))
+
+def read_profile(output_dir):
+    """spans of a model's profile.json, or [] if it has none"""
+    fn = os.path.join(output_dir, profile_fn)
+    if not os.path.exists(fn):
+        return []
+    with open(fn, "r") as f:
+        return json.load(f)["spans"]
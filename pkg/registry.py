@@ -0,0 +1,63 @@
+import os
+import fnmatch
+import importlib
+
+from . import conf
+
+# Models are found by listing `pkg/models/<category>/<model_name>/` for directories with a `model.stan` and
+# a `stan.py`, without importing anything: a model's module (and with it PyStan, its data layer, ...)
+# is only imported in the process that builds its analysis, so listing models is instant, and a model
+# whose dependencies are missing only fails itself.
+
+class ModelInfo(object):
+    """a model found on disk; `module` is its `stan.py` as an importable name"""
+    def __init__(self, category, model_name, model_dir):
+        self.category = category
+        self.model_name = model_name
+        self.model_dir = model_dir
+        self.name = "%s/%s" % (category, model_name)
+        self.module = "pkg.models.%s.%s.stan" % (category, model_name)
+
+    def __repr__(self):
+        return "<ModelInfo(name=%s)>" % self.name
+
+    def notes(self):
+        """first line of the model's notes.txt, or an empty string"""
+        fn = os.path.join(self.model_dir, "notes.txt")
+        if not os.path.exists(fn):
+            return ""
+        with open(fn, "r") as f:
+            return f.readline().strip()
+
+    def load(self):
+        """import the model's module"""
+        return importlib.import_module(self.module)
+
+    def build_analysis(self):
+        """the StanAnalysis from the module's `build_analysis()`; a Job factory for `pkg.scheduler`"""
+        return self.load().build_analysis()
+
+def discover(models_dir=None):
+    """every model under `models_dir` (default `conf.models_dir`), sorted by category and name"""
+    models_dir = models_dir if models_dir else conf.models_dir
+    models = []
+    for category in sorted(os.listdir(models_dir)):
+        category_dir = os.path.join(models_dir, category)
+        if not os.path.isdir(category_dir) or not os.path.exists(os.path.join(category_dir, "__init__.py")):
+            continue
+        for model_name in sorted(os.listdir(category_dir)):
+            model_dir = os.path.join(category_dir, model_name)
+            if all(os.path.exists(os.path.join(model_dir, fn)) for fn in ["__init__.py", "model.stan", "stan.py"]):
+                models.append(ModelInfo(category, model_name, model_dir))
+    return models
+
+def select(models, patterns=None, categories=None):
+    """
+    Models whose "<category>/<model_name>" matches any of the shell-style `patterns` (e.g. "hkjc/*")
+    and whose category is one of `categories`; either filter is skipped if not given
+    """
+    if categories:
+        models = [m for m in models if m.category in categories]
+    if patterns:
+        models = [m for m in models if any(fnmatch.fnmatch(m.name, p.strip("/")) for p in patterns)]
+    return models
@@ -0,0 +1,129 @@
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+from .cache import file_lock, evict
+from .outputs import inputs_hash
+from .parallel import job_files
+from . import plots
+from . import conf
+
+element_re = re.compile(r"^(\w+)\[(\d+(?:,\d+)*)\]$")
+
+class ElementDraws(object):
+    """
+    A draws store that also answers for single elements of array parameters, by Stan-style 1-based
+    names like "theta[3]" or "beta[2,1]", so any scalar in the posterior can be plotted.
+    """
+    def __init__(self, draws):
+        self.draws = draws
+
+    def __repr__(self):
+        return "<ElementDraws(%r)>" % self.draws
+
+    def _split(self, param):
+        m = element_re.match(param)
+        if m is None or m.group(1) not in self.draws:
+            return None
+        idx = tuple(int(i) - 1 for i in m.group(2).split(","))
+        shape = self.draws.chains(m.group(1)).shape[2:]
+        if len(idx) != len(shape) or not all(0 <= i < n for i, n in zip(idx, shape)):
+            return None
+        return m.group(1), idx
+
+    def __contains__(self, param):
+        return param in self.draws or self._split(param) is not None
+
+    def chains(self, param):
+        if param in self.draws:
+            return self.draws.chains(param)
+        split = self._split(param)
+        if split is None:
+            raise KeyError(param)
+        name, idx = split
+        return self.draws.chains(name)[(Ellipsis,) + idx]
+
+    def __getitem__(self, param):
+        chains = self.chains(param)
+        return np.asarray(chains).reshape((-1,) + chains.shape[2:])
+
+    def digest(self, param):
+        if param in self.draws:
+            return self.draws.digest(param)
+        name, idx = self._split(param)
+        return hashlib.sha1("%s %s" % (self.draws.digest(name), idx)).hexdigest()
+
+class RenderCache(object):
+    """
+    Standard plots rendered on demand from persisted draws, with the same code post processing uses.
+    Each png is stored once in `cache_dir` as `<key>.png`, keyed like an incremental post processing output:
+    by the plot's arguments, the content hashes of the draws it reads and the plotting code, so a run that
+    publishes new draws simply misses. Once the directory holds more than `max_bytes`, the least recently
+    served images are evicted.
+    Concurrent requests for the same image render it once: the first takes the entry's file lock (which
+    also excludes other threads of this process) and the rest wait for it, then find the png.
+    pyplot isn't thread-safe, so renders themselves are serialized.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        import matplotlib.pyplot as plt
+        plt.switch_backend("Agg")
+        self.cache_dir = cache_dir if cache_dir else conf.render_cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else conf.render_cache_max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.plot_lock = threading.Lock()
+
+    def __repr__(self):
+        return "<RenderCache(cache_dir=%s)>" % self.cache_dir
+
+    def render(self, draws, job):
+        """
+        Path of the png for a standard plot job (`("single", param)`, `("pair", (x, y))` or
+        `("group", name, params, page)`; see `pkg.parallel.plot_jobs`), rendering it on a miss.
+        Raises KeyError if the job reads a parameter the draws don't have, ValueError if one isn't a scalar.
+        """
+        if job[0] not in ("single", "pair", "group"):
+            raise ValueError("only standard plots render on demand: %s" % (job,))
+        if job[0] == "group":
+            job = tuple(job[:3]) + (job[3] if len(job) > 3 else 1,)
+            if not 1 <= job[3] <= len(plots.group_pages(job[2])):
+                raise KeyError("page %d" % job[3])
+        draws = ElementDraws(draws)
+        if job[0] == "single":
+            params = [job[1]]
+        elif job[0] == "pair":
+            params = list(job[1])
+        else:
+            params = list(job[2])
+        for param in params:
+            if param not in draws:
+                raise KeyError(param)
+            if draws.chains(param).ndim != 2:
+                raise ValueError("%s isn't a scalar; plot one of its elements, e.g. %s[1]" % (param, param))
+        key = inputs_hash(job, draws, None)
+        fn = os.path.join(self.cache_dir, key + ".png")
+        with file_lock(os.path.join(self.cache_dir, key + ".lock")):
+            if os.path.exists(fn):
+                os.utime(fn, None)
+            else:
+                tmp_dir = tempfile.mkdtemp(prefix=key + "-", dir=self.cache_dir)
+                try:
+                    with self.plot_lock:
+                        self._plot(draws, job, tmp_dir)
+                    os.rename(os.path.join(tmp_dir, job_files(job)[0]), fn)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        evict(self.cache_dir, ".png", max_bytes=self.max_bytes, keep=(key,))
+        return fn
+
+    def _plot(self, draws, job, output_dir):
+        if job[0] == "single":
+            plots.single_param_plot(draws, job[1], output_dir)
+        elif job[0] == "pair":
+            plots.param_pair_plot(draws, job[1], output_dir)
+        else:
+            plots.param_group_plot(draws, job[1], job[2], output_dir, page=job[3])
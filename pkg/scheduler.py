@@ -0,0 +1,168 @@
+import time
+import json
+import select
+import traceback
+import multiprocessing
+
+from . import conf
+
+# Each job runs in its own process and works through these stages in order. Before a stage it asks the
+# scheduler for cores and blocks until they are granted, so stages of different jobs overlap:
+# one model can compile while another samples and a third post-processes, within the CPU budget.
+stages = ["build", "compile", "sample", "post_process"]
+
+def stage_cores(stage, analysis):
+    """cores a stage wants; sampling runs one process per chain"""
+    if stage == "sample":
+        return analysis.sampling_args.get("chains", 4)
+    elif stage == "post_process":
+        return analysis.post_process_workers
+    return 1
+
+def run_stage(stage, analysis, cores):
+    if stage == "compile":
+        # a sweep's variants are forked with the model already compiled
+        if not hasattr(analysis, "model"):
+            analysis.compile()
+    elif stage == "sample":
+        analysis.sampling_args = dict(analysis.sampling_args, n_jobs=cores)
+        analysis.sample()
+    elif stage == "post_process":
+        analysis.post_process_workers = cores
+        analysis.post_process()
+
+def job_main(factory, conn):
+    """entry point of a job process; `factory` builds the StanAnalysis during the "build" stage"""
+    analysis = None
+    for stage in stages:
+        conn.send(("request", stage, 1 if analysis is None else stage_cores(stage, analysis)))
+        cores = conn.recv()
+        try:
+            if stage == "build":
+                analysis = factory()
+            else:
+                run_stage(stage, analysis, cores)
+        except Exception:
+            conn.send(("failed", stage, traceback.format_exc()))
+            return
+        conn.send(("done", stage, None))
+    conn.close()
+
+class Job(object):
+    """
+    A named analysis to schedule. `factory` takes no arguments and returns a StanAnalysis;
+    it is called in the job's own process.
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.status = "pending"
+        self.stages = []
+        self.error = None
+        self.process = None
+        self.conn = None
+
+    def __repr__(self):
+        return "<Job(name=%s, status=%s)>" % (self.name, self.status)
+
+    def to_dict(self):
+        return {"name": self.name, "status": self.status, "stages": self.stages, "error": self.error,
+                "seconds": sum(s["seconds"] for s in self.stages if s.get("seconds") is not None)}
+
+class Scheduler(object):
+    """
+    Run several Jobs at once without using more than `cpus` cores in total.
+    Stage requests are granted first come, first served; a request that doesn't fit yet lets later,
+    smaller ones go ahead. A request for more than the whole budget is capped to the budget.
+    A per-job status and timing report is rewritten to `report_fn` as jobs progress.
+    """
+    def __init__(self, jobs, cpus=None, report_fn=None):
+        self.jobs = jobs
+        self.cpus = cpus if cpus else multiprocessing.cpu_count()
+        self.report_fn = report_fn if report_fn else conf.runner_report_fn
+        self.free = self.cpus
+        self.requests = []
+
+    def run(self):
+        self.started = time.time()
+        for job in self.jobs:
+            job.conn, child_conn = multiprocessing.Pipe()
+            job.process = multiprocessing.Process(target=job_main, args=(job.factory, child_conn), name=job.name)
+            job.process.start()
+            child_conn.close()
+            job.status = "running"
+        running = list(self.jobs)
+        while running:
+            readable, _, _ = select.select([job.conn for job in running], [], [], 1.)
+            for job in [j for j in running if j.conn in readable]:
+                if not self.handle(job):
+                    running.remove(job)
+            self.grant()
+            self.write_report()
+        for job in self.jobs:
+            job.process.join()
+        self.print_report()
+        return self.jobs
+
+    def handle(self, job):
+        """process one message from a job; returns False once the job has finished"""
+        try:
+            kind, stage, arg = job.conn.recv()
+        except EOFError:
+            if job.status == "running":
+                self.finish_stage(job, "failed")
+                job.status = "failed"
+                job.error = job.error or "job process exited with code %s" % job.process.exitcode
+            return False
+        if kind == "request":
+            cores = min(arg, self.cpus)
+            job.stages.append({"stage": stage, "cores": cores, "status": "queued", "queued": time.time()})
+            self.requests.append(job)
+        elif kind == "done":
+            self.finish_stage(job, "done")
+            if stage == stages[-1]:
+                job.status = "done"
+        elif kind == "failed":
+            self.finish_stage(job, "failed")
+            job.status = "failed"
+            job.error = arg
+            print "job < %s > failed in stage < %s >:" % (job.name, stage)
+            print arg
+        return True
+
+    def grant(self):
+        for job in list(self.requests):
+            stage = job.stages[-1]
+            if stage["cores"] <= self.free:
+                self.free -= stage["cores"]
+                stage["status"] = "running"
+                stage["started"] = time.time()
+                stage["wait_seconds"] = stage["started"] - stage["queued"]
+                self.requests.remove(job)
+                print "job < %s > starting < %s > on %d core(s), %d free" % (job.name, stage["stage"], stage["cores"], self.free)
+                job.conn.send(stage["cores"])
+
+    def finish_stage(self, job, status):
+        if job.stages and job.stages[-1]["status"] == "running":
+            stage = job.stages[-1]
+            stage["status"] = status
+            stage["finished"] = time.time()
+            stage["seconds"] = stage["finished"] - stage["started"]
+            self.free += stage["cores"]
+
+    def report(self):
+        return {"cpus": self.cpus, "started": self.started, "seconds": time.time() - self.started,
+                "jobs": [job.to_dict() for job in self.jobs]}
+
+    def write_report(self):
+        with open(self.report_fn, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_report(self):
+        print "writing < %s >" % self.report_fn
+        self.write_report()
+        print "%-30s %-8s %s" % ("job", "status", "  ".join("%12s" % stage for stage in stages))
+        for job in self.jobs:
+            seconds = dict((s["stage"], s.get("seconds")) for s in job.stages)
+            cells = ["%11.1fs" % seconds[stage] if seconds.get(stage) is not None else "%12s" % "-" for stage in stages]
+            print "%-30s %-8s %s" % (job.name, job.status, "  ".join(cells))
@@ -0,0 +1,257 @@
+import os
+import re
+import glob
+import json
+import time
+import threading
+import numpy as np
+
+from .draws import flatten_chains, array_digest
+from .diagnostics import summarize
+from . import conf
+
+# Draws of a run in progress, read from the CSV files Stan writes each chain's iterations to
+# (`sample_file`), so diagnostics and flan.py's live view can start before sampling finishes.
+# Files are tailed: each refresh reads only the bytes appended since the last, and parses all the
+# complete rows among them in one `np.fromstring` call rather than line by line.
+
+samples_dirname = "samples"
+live_fn = "live.json"
+comment_re = re.compile(r"^#.*(\n|$)", re.M)
+setting_re = re.compile(r"^#\s*(\w+)\s*=\s*(\S+)\s*$", re.M)
+
+class CsvTail(object):
+    """
+    Rows of one chain's sample file, as a growing (n_rows, n_columns) float array.
+    `read()` parses whatever has been appended since the last call, up to the last complete line.
+    """
+    def __init__(self, fn, read_bytes=None):
+        self.fn = fn
+        self.read_bytes = read_bytes if read_bytes else conf.stream_read_bytes
+        self.offset = 0
+        self.columns = None
+        self.settings = {}
+        self.buffer = np.empty((0, 0))
+        self.n_rows = 0
+
+    def __repr__(self):
+        return "<CsvTail(fn=%s, rows=%d)>" % (self.fn, self.n_rows)
+
+    @property
+    def rows(self):
+        return self.buffer[:self.n_rows]
+
+    def read(self):
+        """parse newly written rows; returns how many there were"""
+        if not os.path.exists(self.fn):
+            return 0
+        n_before = self.n_rows
+        with open(self.fn, "r") as f:
+            f.seek(self.offset)
+            while True:
+                chunk = f.read(self.read_bytes)
+                end = chunk.rfind("\n") + 1
+                if end == 0:
+                    if len(chunk) < self.read_bytes:
+                        # the last line isn't complete yet
+                        break
+                    # a line longer than `read_bytes`: read it whole
+                    self.read_bytes *= 2
+                    f.seek(self.offset)
+                    continue
+                self.offset += end
+                self._parse(chunk[:end])
+                f.seek(self.offset)
+                if len(chunk) < self.read_bytes:
+                    break
+        return self.n_rows - n_before
+
+    def _parse(self, text):
+        if self.columns is None:
+            # the preamble: run settings as "# key=value" comments, then the header row
+            self.settings.update(setting_re.findall(text))
+            text = comment_re.sub("", text)
+            header, _, text = text.partition("\n")
+            if not header:
+                return
+            self.columns = header.strip().split(",")
+        values = np.fromstring(comment_re.sub("", text).strip().replace("\n", ","), sep=",")
+        self._append(values.reshape(-1, len(self.columns)))
+
+    def _append(self, rows):
+        if not len(rows):
+            return
+        if self.n_rows + len(rows) > len(self.buffer):
+            # grow geometrically, so tailing costs amortized O(1) per row
+            buffer = np.empty((max(2 * len(self.buffer), self.n_rows + len(rows), 64), len(self.columns)))
+            if self.n_rows:
+                buffer[:self.n_rows] = self.rows
+            self.buffer = buffer
+        self.buffer[self.n_rows:self.n_rows + len(rows)] = rows
+        self.n_rows += len(rows)
+
+    @property
+    def n_warmup(self):
+        """rows of warmup iterations at the start of the file"""
+        if self.settings.get("save_warmup", "0") == "0":
+            return 0
+        warmup, thin = int(self.settings.get("warmup", 0)), int(self.settings.get("thin", 1))
+        return -(-warmup // thin)
+
+def param_columns(columns):
+    """parameter -> (column indices, dims), from sample file headers like "eta.1,eta.2", sampler columns excepting lp__ dropped"""
+    found = {}
+    for i, column in enumerate(columns):
+        name = column.split(".")[0]
+        if name.endswith("__") and name != "lp__":
+            continue
+        index = tuple(int(d) for d in column.split(".")[1:])
+        found.setdefault(name, []).append((i, index))
+    params = {}
+    for name, entries in found.items():
+        dims = tuple(np.max([index for _, index in entries], axis=0)) if entries[0][1] else ()
+        params[name] = ([i for i, _ in entries], dims)
+    return params
+
+class StreamingDrawsStore(object):
+    """
+    DrawsStore interface over the sample files of a run in progress, for diagnostics and plots.
+    `refresh()` reads what the chains have written since; until the next refresh, `chains(param)` is
+    the post-warmup draws so far, shaped (n_chains, n_draws) + dims, cut to the shortest chain's draws.
+    """
+    def __init__(self, samples_dir):
+        self.samples_dir = samples_dir
+        self.tails = {}
+        self._draws = {}
+        self._digests = {}
+        self._param_columns = {}
+        self.refresh()
+
+    def __repr__(self):
+        return "<StreamingDrawsStore(samples_dir=%s, chains=%d, draws=%d)>" % (self.samples_dir, len(self.tails), self.n_draws)
+
+    def refresh(self):
+        """read newly written draws; returns True if there were any"""
+        for fn in sorted(glob.glob(os.path.join(self.samples_dir, "*.csv"))):
+            if fn not in self.tails:
+                self.tails[fn] = CsvTail(fn)
+        changed = sum(tail.read() for tail in self.tails.values()) > 0
+        if changed:
+            self._draws = {}
+            self._digests = {}
+            if not self._param_columns and self._ready:
+                self._param_columns = param_columns(self._ready[0].columns)
+        return changed
+
+    @property
+    def _ready(self):
+        return [tail for _, tail in sorted(self.tails.items()) if tail.columns is not None]
+
+    @property
+    def n_draws(self):
+        """post-warmup draws every chain has written"""
+        tails = self._ready
+        return min(max(tail.n_rows - tail.n_warmup, 0) for tail in tails) if tails else 0
+
+    def progress(self):
+        """(warmup rows, post-warmup rows, expected rows) written by each chain"""
+        progress = []
+        for tail in self._ready:
+            n_warmup = min(tail.n_rows, tail.n_warmup)
+            expected = -(-int(tail.settings.get("iter", 0)) // int(tail.settings.get("thin", 1)))
+            if tail.settings.get("save_warmup", "0") == "0":
+                expected -= -(-int(tail.settings.get("warmup", 0)) // int(tail.settings.get("thin", 1)))
+            progress.append((n_warmup, tail.n_rows - n_warmup, expected))
+        return progress
+
+    def __getitem__(self, param):
+        return flatten_chains(self.chains(param))
+
+    def __contains__(self, param):
+        return param in self.params
+
+    def chains(self, param):
+        if param not in self._draws:
+            tails = self._ready
+            if param not in self._param_columns:
+                raise KeyError(param)
+            idx, dims = self._param_columns[param]
+            n = self.n_draws
+            draws = np.array([tail.rows[tail.n_warmup:tail.n_warmup + n][:, idx] for tail in tails])
+            # Stan writes array elements in column-major order
+            self._draws[param] = np.ascontiguousarray(draws.reshape(draws.shape[:2] + dims[::-1]).transpose(
+                (0, 1) + tuple(range(len(dims) + 1, 1, -1))))
+        return self._draws[param]
+
+    def digest(self, param):
+        if param not in self._digests:
+            self._digests[param] = array_digest(self.chains(param))
+        return self._digests[param]
+
+    @property
+    def params(self):
+        return sorted(self._param_columns)
+
+    @property
+    def fit(self):
+        return None
+
+    def get(self, param, default=None):
+        return self[param] if param in self else default
+
+def read_live(output_dir):
+    """the status a LiveMonitor last wrote for a model, or None"""
+    fn = os.path.join(output_dir, live_fn)
+    if not os.path.exists(fn):
+        return None
+    with open(fn, "r") as f:
+        return json.load(f)
+
+class LiveMonitor(threading.Thread):
+    """
+    Background thread that, every `poll_seconds` while a run samples, refreshes a StreamingDrawsStore
+    and writes `live.json` to the output directory: each chain's progress and, once every chain has
+    `stream_min_draws` post-warmup draws, diagnostics of the draws so far (see `pkg.diagnostics`) with an
+    early convergence check: max R-hat under `stream_max_rhat` and min bulk ESS over `stream_min_ess`.
+    """
+    def __init__(self, samples_dir, output_dir, poll_seconds=None):
+        super(LiveMonitor, self).__init__()
+        self.daemon = True
+        self.samples_dir = samples_dir
+        self.output_dir = output_dir
+        self.poll_seconds = poll_seconds if poll_seconds is not None else conf.stream_poll_seconds
+        self.stopped = threading.Event()
+        self.store = None
+        self.status = {}
+
+    def run(self):
+        while not self.stopped.wait(self.poll_seconds):
+            self.update("sampling")
+
+    def stop(self, status="done"):
+        self.stopped.set()
+        self.join()
+        self.update(status)
+
+    def update(self, status):
+        if self.store is None:
+            self.store = StreamingDrawsStore(self.samples_dir)
+        changed = self.store.refresh()
+        self.status.update({"status": status, "updated": time.time(), "chains": self.store.progress()})
+        if changed and self.store.n_draws >= conf.stream_min_draws:
+            table = summarize(self.store)
+            order = np.argsort([-r if r == r else -np.inf for r in table["rhat"]])
+            rows = [dict((k, None if v[i] != v[i] else v[i]) for k, v in table.items()) for i in order[:conf.stream_worst_rows]]
+            rhats = [r for r in table["rhat"] if r == r]
+            ess = [e for e in table["ess_bulk"] if e == e]
+            self.status["diagnostics"] = {
+                "n_draws": self.store.n_draws,
+                "max_rhat": max(rhats) if rhats else None,
+                "min_ess_bulk": min(ess) if ess else None,
+                "worst": rows,
+            }
+            self.status["converged"] = bool(rhats and ess and max(rhats) < conf.stream_max_rhat and min(ess) > conf.stream_min_ess)
+        tmp_fn = os.path.join(self.output_dir, live_fn + ".tmp")
+        with open(tmp_fn, "w") as f:
+            json.dump(self.status, f)
+        os.rename(tmp_fn, os.path.join(self.output_dir, live_fn))
@@ -0,0 +1,146 @@
+import os
+import csv
+import json
+import shutil
+import itertools
+
+from .cache import CompiledModelCache
+from .analysis import StanAnalysis
+from .scheduler import Job, Scheduler
+from .diagnostics import diagnostics_fn, read_diagnostics
+from .catalog import publish, sweep_fn, variant_sep
+from . import conf
+
+# Parameter sweeps: one ModelSpec run over a grid of constructor arguments (data cutoffs, prior settings)
+# and sampling arguments. The model is compiled once, before the variants' processes fork, so each
+# inherits it; the variants are scheduled like runner.py's jobs, within a CPU budget (see `pkg.scheduler`).
+# Outputs go to `static/<category>/<model_name>_sweep/<variant>/`, and `sweep_summary.csv` there puts the
+# diagnostics of every variant side by side. `sweep.json` lists the variants with their settings and status;
+# flan.py shows the sweep as a page linking to each variant's own, see `pkg.catalog.SweepEntry`.
+
+summary_fn = "sweep_summary.csv"
+report_fn = "sweep_report.json"
+summary_columns = ["mean", "sd", "q5", "q50", "q95", "ess_bulk", "rhat"]
+
+def variant_name(settings):
+    """directory name of a variant, from its settings: "iter=1000,start_date=20140101" """
+    return ",".join("%s=%s" % (k, settings[k]) for k in sorted(settings)) or "default"
+
+def grid(spec_grid=None, sampling_grid=None):
+    """
+    (spec kwargs, sampling args) of every combination of the values in `spec_grid` and `sampling_grid`,
+    dicts of argument -> list of values
+    """
+    spec_grid = spec_grid if spec_grid else {}
+    sampling_grid = sampling_grid if sampling_grid else {}
+    keys = sorted(spec_grid) + sorted(sampling_grid)
+    values = [spec_grid[k] for k in sorted(spec_grid)] + [sampling_grid[k] for k in sorted(sampling_grid)]
+    variants = []
+    for combination in itertools.product(*values):
+        settings = dict(zip(keys, combination))
+        variants.append((dict((k, settings[k]) for k in spec_grid), dict((k, settings[k]) for k in sampling_grid)))
+    return variants
+
+class Sweep(object):
+    """
+    Run `spec_class(category, model_name, **spec_kw)` with `sampling_args` updated by each variant's,
+    for every combination in the grids. `analysis_kw` are passed to each variant's StanAnalysis, e.g.
+    `{"lazy_plots": True}`. `summary_params` limits the summary to those parameters' elements.
+    """
+    def __init__(self, spec_class, category, model_name, spec_grid=None, sampling_grid=None, sampling_args={},
+                 analysis_kw={}, cpus=None, summary_params=None):
+        self.spec_class = spec_class
+        self.category = category
+        self.model_name = model_name
+        self.variants = grid(spec_grid, sampling_grid)
+        self.sampling_args = sampling_args
+        self.analysis_kw = analysis_kw
+        self.cpus = cpus
+        self.summary_params = summary_params
+        self.sweep_name = "%s_sweep" % model_name
+        self.sweep_dir = os.path.join(conf.static_dir, category, self.sweep_name)
+
+    def __repr__(self):
+        return "<Sweep(category=%s, model_name=%s, variants=%d)>" % (self.category, self.model_name, len(self.variants))
+
+    def output_dir(self, spec_kw, sampling_kw):
+        return os.path.join(self.sweep_dir, variant_name(dict(spec_kw, **sampling_kw)))
+
+    def factory(self, spec_kw, sampling_kw):
+        """builds one variant's StanAnalysis, holding the model compiled by `run`, in its job's process"""
+        def build_analysis():
+            model_spec = self.spec_class(self.category, self.model_name, **spec_kw)
+            analysis = StanAnalysis(model_spec, sampling_args=dict(self.sampling_args, **sampling_kw),
+                                    output_dir=self.output_dir(spec_kw, sampling_kw), **self.analysis_kw)
+            analysis.model = self.model
+            return analysis
+        return build_analysis
+
+    def run(self):
+        """compile, run every variant, and write the summary; returns the scheduler's jobs"""
+        code_fn = os.path.join(conf.models_dir, self.category, self.model_name, "model.stan")
+        print "compiling model once for %d variants ..." % len(self.variants)
+        self.model = CompiledModelCache().get(open(code_fn).read(), model_name=self.model_name)
+        if os.path.exists(self.sweep_dir):
+            shutil.rmtree(self.sweep_dir)
+        os.makedirs(self.sweep_dir)
+        jobs = [Job(variant_name(dict(spec_kw, **sampling_kw)), self.factory(spec_kw, sampling_kw))
+                for spec_kw, sampling_kw in self.variants]
+        for name in [job.name for job in jobs]:
+            if variant_sep in name or "/" in name:
+                raise ValueError("variant < %s > can't be named after settings containing %r or '/'" % (name, variant_sep))
+        # listed in flan.py while it runs, each variant's page appearing as it publishes
+        self.write_variants(jobs)
+        Scheduler(jobs, cpus=self.cpus, report_fn=os.path.join(self.sweep_dir, report_fn)).run()
+        self.write_summary(jobs)
+        return jobs
+
+    def write_variants(self, jobs):
+        """`sweep.json`: each variant's name, settings, status and stage timings"""
+        variants = []
+        for (spec_kw, sampling_kw), job in zip(self.variants, jobs):
+            variants.append({"name": job.name, "status": job.status, "spec_kw": spec_kw, "sampling_args": sampling_kw,
+                             "seconds": dict((s["stage"], s.get("seconds")) for s in job.stages)})
+        with open(os.path.join(self.sweep_dir, sweep_fn), "w") as f:
+            json.dump(variants, f, indent=2)
+        publish(self.category, self.sweep_name)
+
+    def write_summary(self, jobs):
+        """
+        `sweep_summary.csv`: one row per parameter element, with each variant's statistics in columns
+        "<statistic> <variant>", next to each other per statistic; and `sweep.json` with the final statuses
+        """
+        rows = {}
+        names = []
+        for (spec_kw, sampling_kw), job in zip(self.variants, jobs):
+            fn = os.path.join(self.output_dir(spec_kw, sampling_kw), diagnostics_fn)
+            if job.status != "done" or not os.path.exists(fn):
+                continue
+            for row in read_diagnostics(fn):
+                if self.summary_params is not None and row["name"].split("[")[0] not in self.summary_params:
+                    continue
+                if row["name"] not in rows:
+                    rows[row["name"]] = {}
+                    names.append(row["name"])
+                rows[row["name"]][job.name] = row
+        fn = os.path.join(self.sweep_dir, summary_fn)
+        print "writing < %s >" % fn
+        header = ["name"] + ["%s %s" % (column, job.name) for column in summary_columns for job in jobs]
+        with open(fn, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for name in names:
+                cells = [name]
+                for column in summary_columns:
+                    cells += ["%.6g" % rows[name][job.name][column] if job.name in rows[name] else "" for job in jobs]
+                writer.writerow(cells)
+        self.write_variants(jobs)
+        self.print_summary(jobs, rows, names)
+
+    def print_summary(self, jobs, rows, names):
+        """posterior means of each variant, side by side, for the first `conf.sweep_print_rows` elements"""
+        width = max([len(job.name) for job in jobs] + [10])
+        print "%-20s %s" % ("mean", " ".join("%*s" % (width, job.name) for job in jobs))
+        for name in names[:conf.sweep_print_rows]:
+            print "%-20s %s" % (name, " ".join("%*.4g" % (width, rows[name][job.name]["mean"]) if job.name in rows[name]
+                                                else "%*s" % (width, "-") for job in jobs))
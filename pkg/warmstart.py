@@ -0,0 +1,160 @@
+import os
+import re
+import ast
+import operator
+import numpy as np
+
+from .draws import draws_dirname, manifest_fn, load_draws
+from . import dag
+
+# Warm starts: initial values for a new run of a model, taken from the draws its last run persisted.
+# Which parameters carry over is decided from the `parameters` block declarations (parsed by `pkg.dag`)
+# of the new model code, resolved against the new data, and those recorded in the previous draws manifest:
+#  - same type and shape: a previous draw is used as is
+#  - same type and rank, different sizes (e.g. N_horses grew): the entries both runs have are copied,
+#    matched by the spec's labels where it has them (see `ModelSpec.labels`), the rest drawn from
+#    `ModelSpec.warm_start_prior`
+#  - anything else: left out, so Stan initializes it as usual
+
+# types whose entries are unconstrained apart from bounds, so a resized value is still valid
+resizable_types = set(["real", "vector", "row_vector", "matrix"])
+bound_re = re.compile("(lower|upper)\s*=\s*([^,>]+)")
+
+binary_ops = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul}
+unary_ops = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+def resolve(expr, data):
+    """
+    value of a dimension or bound expression from a Stan declaration: a literal, a data name, or + - * /
+    on those (integer division truncating, as in Stan). Anything else, e.g. a function call, raises ValueError.
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError("can't resolve < %s >" % expr)
+    return _evaluate(tree.body, expr, data)
+
+def _evaluate(node, expr, data):
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Name) and node.id in data and np.ndim(data[node.id]) == 0:
+        return np.asarray(data[node.id]).item()
+    if isinstance(node, ast.UnaryOp) and type(node.op) in unary_ops:
+        return unary_ops[type(node.op)](_evaluate(node.operand, expr, data))
+    if isinstance(node, ast.BinOp) and type(node.op) in binary_ops:
+        return binary_ops[type(node.op)](_evaluate(node.left, expr, data), _evaluate(node.right, expr, data))
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+        left, right = _evaluate(node.left, expr, data), _evaluate(node.right, expr, data)
+        if right == 0:
+            raise ValueError("division by zero in < %s >" % expr)
+        if isinstance(left, (int, long)) and isinstance(right, (int, long)):
+            return int(float(left) / right)
+        return float(left) / right
+    raise ValueError("can't resolve < %s >" % expr)
+
+def declarations(model_code):
+    """parameter name -> {"datatype", "constraint", "shape"} of each `parameters` block declaration, dims unresolved"""
+    nodes = dag.build_nodes(dag.get_blocks(model_code))
+    return dict((node.name, {"datatype": node.datatype, "constraint": node.constraint, "shape": list(node.shape or [])})
+                for node in nodes.values() if node.block == "parameters")
+
+def bounds(constraint, data):
+    """(lower, upper) of a declaration's constraint, None where unbounded"""
+    found = dict((k, float(resolve(v, data))) for k, v in bound_re.findall(constraint or ""))
+    return found.get("lower"), found.get("upper")
+
+def default_prior(declaration, data, size):
+    """
+    Stan's own initialization: uniform(-2, 2) on the unconstrained scale, mapped through the bounds
+    """
+    u = np.random.uniform(-2., 2., size)
+    lower, upper = bounds(declaration["constraint"], data)
+    if lower is not None and upper is not None:
+        return lower + (upper - lower) / (1. + np.exp(-u))
+    if lower is not None:
+        return lower + np.exp(u)
+    if upper is not None:
+        return upper - np.exp(u)
+    return u
+
+def previous_fit(output_dir, params, n_inits):
+    """
+    (manifest, param -> draws) from the draws persisted under `output_dir`, or None if there are none:
+    `n_inits` draws of each of `params` it has, from the end of each previous chain in turn.
+    The draws are read into memory, so the output directory can be cleaned afterwards.
+    """
+    if not os.path.exists(os.path.join(output_dir, draws_dirname, manifest_fn)):
+        return None
+    draws = load_draws(output_dir)
+    n_chains, n_draws = draws.manifest["n_chains"], draws.manifest["n_draws"]
+    chain_idx = [i % n_chains for i in range(n_inits)]
+    draw_idx = [max(n_draws - 1 - i // n_chains, 0) for i in range(n_inits)]
+    values = dict((param, np.array(draws.chains(param)[chain_idx, draw_idx]))
+                  for param in params if param in draws.manifest["params"])
+    return draws.manifest, values
+
+def label_index(old_labels, new_labels, old_size, new_size):
+    """(new positions, old positions) of the entries along the first dimension that both runs have"""
+    if old_labels is not None and new_labels is not None and len(old_labels) == old_size and len(new_labels) == new_size:
+        old_position = dict((label, i) for i, label in enumerate(old_labels))
+        pairs = [(i, old_position[label]) for i, label in enumerate(new_labels) if label in old_position]
+        return np.array([p[0] for p in pairs], dtype=int), np.array([p[1] for p in pairs], dtype=int)
+    n = min(old_size, new_size)
+    return np.arange(n), np.arange(n)
+
+def warm_start_inits(model_spec, output_dir, n_inits):
+    """
+    (list of `n_inits` init dicts for `StanModel.sampling`, report of param -> what was done with it),
+    or None if the model has no persisted draws
+    """
+    new_declarations = declarations(model_spec.model_code)
+    previous = previous_fit(output_dir, new_declarations, n_inits)
+    if previous is None:
+        return None
+    manifest, values = previous
+    old_declarations = manifest.get("declarations", {})
+    old_labels = manifest.get("labels", {})
+    new_labels = dict((k, [str(label) for label in v]) for k, v in model_spec.labels.items())
+    inits = [{} for _ in range(n_inits)]
+    report = {}
+    for param, declaration in sorted(new_declarations.items()):
+        if param not in values:
+            if param in old_declarations:
+                # declared last run, but outside its `retain_params`
+                report[param] = "cold: the previous run didn't keep its draws"
+            else:
+                report[param] = "new parameter"
+            continue
+        old = values[param]
+        old_shape = old.shape[1:]
+        # manifests written before declarations were recorded: assume unchanged
+        old_declaration = old_declarations.get(param, declaration)
+        try:
+            shape = tuple(int(resolve(d, model_spec.data)) for d in declaration["shape"])
+        except (ValueError, NameError, SyntaxError) as e:
+            report[param] = "dropped: %s" % e
+            continue
+        if (declaration["datatype"], declaration["constraint"]) != (old_declaration["datatype"], old_declaration["constraint"]):
+            report[param] = "dropped: declared %s%s, was %s%s" % (declaration["datatype"], declaration["constraint"] or "",
+                                                                old_declaration["datatype"], old_declaration["constraint"] or "")
+            continue
+        if shape == old_shape and (param not in old_labels or old_labels.get(param) == new_labels.get(param)):
+            for init, value in zip(inits, old):
+                init[param] = value
+            report[param] = "copied"
+            continue
+        if len(shape) != len(old_shape) or declaration["datatype"] not in resizable_types:
+            report[param] = "dropped: shape %s, was %s" % (shape, old_shape)
+            continue
+        new_idx, old_idx = label_index(old_labels.get(param), new_labels.get(param), old_shape[0], shape[0])
+        rest = tuple(slice(0, min(a, b)) for a, b in zip(old_shape[1:], shape[1:]))
+        size = int(np.prod(shape))
+        for init, value in zip(inits, old):
+            fill = model_spec.warm_start_prior(param, size)
+            if fill is None:
+                fill = default_prior(declaration, model_spec.data, size)
+            init[param] = np.asarray(fill, dtype=float).reshape(shape)
+            init[param][(new_idx,) + rest] = value[(old_idx,) + rest]
+        n_copied = len(new_idx) * int(np.prod([s.stop for s in rest]))
+        report[param] = "resized %s -> %s: %d of %d entries copied" % (old_shape, shape, n_copied, size)
+    return inits, report
@@ -1,10 +1,46 @@
-from pkg.models.hkjc.v001.stan import main as hkjc001
-# import other models ...
+import argparse
+import multiprocessing
+from pkg.scheduler import Job, Scheduler
+from pkg.registry import discover, select
 
-models = [
-    hkjc001, 
+# models `run` runs when none are named; others are found under pkg/models/, see `list`
+default_models = [
+    "hkjc/v001",
 ]
+commands = ["list", "run"]
 
-if __name__ == "__main__":
+def list_models(models):
     for model in models:
-        model()
+        print "%-40s %s" % (model.name, model.notes())
+
+def run_models(models, cpus, report_fn):
+    # each model's module is imported in its job's process, when the job builds its analysis
+    jobs = [Job(model.name, model.build_analysis) for model in models]
+    Scheduler(jobs, cpus=cpus, report_fn=report_fn).run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List models, or run their analyses concurrently within a CPU budget.",
+                                     usage="%(prog)s [list | run] [model ...] [--category CATEGORY] [--cpus CPUS] [--report REPORT]")
+    # one positional list, so the command can be left out: `runner.py hkjc/v001` runs hkjc/v001
+    parser.add_argument("models", nargs="*", metavar="model",
+                        help="command (default: run), then <category>/<model_name> of models, or shell-style patterns "
+                        "like 'hkjc/*' (run default: %s)" % ", ".join(default_models))
+    parser.add_argument("--category", action="append", default=None, help="only models in this category (repeatable)")
+    parser.add_argument("--cpus", type=int, default=multiprocessing.cpu_count(),
+                        help="total cores shared by all jobs (default: all)")
+    parser.add_argument("--report", default=None, help="where to write the per-job status and timing report")
+    args = parser.parse_args()
+    command = "run"
+    if args.models and args.models[0] in commands:
+        command = args.models.pop(0)
+
+    patterns = args.models
+    if command == "run" and not patterns and not args.category:
+        patterns = default_models
+    models = select(discover(), patterns=patterns, categories=args.category)
+    if not models:
+        parser.error("no models match")
+    if command == "list":
+        list_models(models)
+    else:
+        run_models(models, args.cpus, args.report)